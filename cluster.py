@@ -0,0 +1,490 @@
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import socketio
+
+
+BASE = Path(__file__).resolve().parent
+logger = logging.getLogger("pistat-cluster")
+
+# Frames on the local bus: 4-byte big-endian length, then one JSON object.
+_HEADER = struct.Struct("!I")
+
+
+def _send_frame(sock: socket.socket, lock: threading.Lock, message: Dict[str, Any]) -> None:
+    data = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    with lock:
+        sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _read_frames(sock: socket.socket) -> Iterator[Dict[str, Any]]:
+    stream = sock.makefile("rb")
+    while True:
+        header = stream.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        (size,) = _HEADER.unpack(header)
+        data = stream.read(size)
+        if len(data) < size:
+            return
+        yield json.loads(data)
+
+
+class MessageBus:
+    """Publish/subscribe channels and shared tables for the controller workers.
+
+    Messages and table values must be JSON-serialisable. Subscribers are not
+    sent their own messages, and callbacks run one at a time in publish order.
+    """
+
+    def publish(self, channel: str, message: Any) -> None:
+        raise NotImplementedError
+
+    def subscribe(self, channel: str, callback: Callable[[Any], None]) -> None:
+        raise NotImplementedError
+
+    def table(self, name: str) -> "SharedTable":
+        return SharedTable(self, name)
+
+    def socketio_manager(self) -> socketio.PubSubManager:
+        """Client manager that relays Socket.IO emits to the other workers."""
+        return BusManager(self)
+
+    def table_op(self, op: str, table: str, key: Optional[str] = None, value: Any = None) -> Any:
+        """Run ``get``, ``set``, ``pop``, ``len`` or ``keys`` against a shared table."""
+        raise NotImplementedError
+
+
+class SharedTable(MutableMapping):
+    """Dict-like view of a table held by the bus, seen alike by every worker.
+
+    Every operation is a round trip to the bus except ``__setitem__``, which is
+    sent without waiting; the bus applies one connection's operations in order.
+    """
+
+    def __init__(self, bus: MessageBus, name: str) -> None:
+        self._bus = bus
+        self.name = name
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self._bus.table_op("get", self.name, key)
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._bus.table_op("set", self.name, key, value)
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        value = self._bus.table_op("pop", self.name, key)
+        return default if value is None else value
+
+    def __delitem__(self, key: str) -> None:
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        return self.get(str(key)) is not None
+
+    def __len__(self) -> int:
+        return int(self._bus.table_op("len", self.name))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._bus.table_op("keys", self.name) or [])
+
+
+class SocketBus(MessageBus):
+    """Client for :class:`BusBroker`, the bus cluster.py runs when no external queue is set.
+
+    One reader thread matches table replies to their requests; subscription
+    callbacks run on a separate thread so they may use the tables themselves.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float = 10.0) -> None:
+        self._timeout = timeout
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._sock.settimeout(None)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._replies: Dict[int, "queue.Queue[Any]"] = {}
+        self._replies_lock = threading.Lock()
+        self._callbacks: Dict[str, List[Callable[[Any], None]]] = {}
+        self._inbox: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+        threading.Thread(target=self._read, daemon=True, name="bus-reader").start()
+        threading.Thread(target=self._dispatch, daemon=True, name="bus-dispatch").start()
+
+    def publish(self, channel: str, message: Any) -> None:
+        _send_frame(self._sock, self._send_lock, {"op": "pub", "ch": channel, "msg": message})
+
+    def subscribe(self, channel: str, callback: Callable[[Any], None]) -> None:
+        first = channel not in self._callbacks
+        self._callbacks.setdefault(channel, []).append(callback)
+        if first:
+            _send_frame(self._sock, self._send_lock, {"op": "sub", "ch": channel})
+
+    def table_op(self, op: str, table: str, key: Optional[str] = None, value: Any = None) -> Any:
+        frame = {"op": op, "t": table, "k": key, "v": value}
+        if op == "set":
+            _send_frame(self._sock, self._send_lock, frame)
+            return None
+        frame["id"] = request_id = next(self._ids)
+        reply: "queue.Queue[Any]" = queue.Queue(maxsize=1)
+        with self._replies_lock:
+            self._replies[request_id] = reply
+        try:
+            _send_frame(self._sock, self._send_lock, frame)
+            return reply.get(timeout=self._timeout)
+        except queue.Empty:
+            raise TimeoutError(f"Message bus did not answer '{op}' on '{table}'") from None
+        finally:
+            with self._replies_lock:
+                self._replies.pop(request_id, None)
+
+    def _read(self) -> None:
+        for frame in _read_frames(self._sock):
+            if "id" in frame:
+                with self._replies_lock:
+                    reply = self._replies.get(frame["id"])
+                if reply is not None:
+                    reply.put(frame.get("v"))
+            else:
+                self._inbox.put((frame["ch"], frame.get("msg")))
+        # Without the bus this worker would silently diverge from the others;
+        # exit so the launcher starts a fresh one.
+        logger.error("Lost connection to the message bus; exiting")
+        os._exit(3)
+
+    def _dispatch(self) -> None:
+        while True:
+            channel, message = self._inbox.get()
+            for callback in list(self._callbacks.get(channel, [])):
+                try:
+                    callback(message)
+                except Exception:  # pragma: no cover - one bad message must not stop the bus
+                    logger.exception("Handler for bus channel '%s' failed", channel)
+
+
+class BusBroker:
+    """In-process message broker that cluster.py starts when no queue URL is given.
+
+    Listens on localhost; relays published messages to every other connection
+    subscribed to the channel and keeps the shared tables in memory.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self._server = socket.create_server((host, port))
+        self.address: Tuple[str, int] = self._server.getsockname()[:2]
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[socket.socket]] = {}
+        self._send_locks: Dict[socket.socket, threading.Lock] = {}
+        self._tables: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def url(self) -> str:
+        return f"local://{self.address[0]}:{self.address[1]}"
+
+    def start(self) -> None:
+        threading.Thread(target=self._accept, daemon=True, name="bus-broker").start()
+
+    def _accept(self) -> None:
+        while True:
+            conn, _ = self._server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self._send_locks[conn] = threading.Lock()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True, name="bus-peer").start()
+
+    def _serve(self, conn: socket.socket) -> None:
+        try:
+            for frame in _read_frames(conn):
+                op = frame.get("op")
+                if op == "pub":
+                    self._relay(conn, frame["ch"], frame.get("msg"))
+                elif op == "sub":
+                    with self._lock:
+                        self._subscribers.setdefault(frame["ch"], set()).add(conn)
+                else:
+                    result = self._table_op(op, frame.get("t"), frame.get("k"), frame.get("v"))
+                    if "id" in frame:
+                        _send_frame(conn, self._send_locks[conn], {"id": frame["id"], "v": result})
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                for subscribers in self._subscribers.values():
+                    subscribers.discard(conn)
+                self._send_locks.pop(conn, None)
+            conn.close()
+
+    def _relay(self, sender: socket.socket, channel: str, message: Any) -> None:
+        with self._lock:
+            targets = [
+                (peer, self._send_locks[peer]) for peer in self._subscribers.get(channel, ()) if peer is not sender
+            ]
+        frame = {"ch": channel, "msg": message}
+        for peer, lock in targets:
+            try:
+                _send_frame(peer, lock, frame)
+            except OSError:
+                pass
+
+    def _table_op(self, op: Optional[str], name: Optional[str], key: Optional[str], value: Any) -> Any:
+        with self._lock:
+            table = self._tables.setdefault(str(name), {})
+            if op == "get":
+                return table.get(key)
+            if op == "set":
+                if value is None:
+                    table.pop(key, None)
+                else:
+                    table[key] = value
+                return None
+            if op == "pop":
+                return table.pop(key, None)
+            if op == "len":
+                return len(table)
+            if op == "keys":
+                return list(table)
+        return None
+
+
+class RedisBus(MessageBus):
+    """Message bus on a Redis server, for workers spread over several hosts.
+
+    Channels are Redis pub/sub channels and tables are Redis hashes, both
+    prefixed with ``pistat:``. Needs the ``redis`` package.
+    """
+
+    def __init__(self, url: str) -> None:
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("redis:// message queues need the redis package (pip install redis)") from None
+        self._url = url
+        self._redis = redis.Redis.from_url(url)
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._sender = uuid.uuid4().hex
+        self._callbacks: Dict[str, List[Callable[[Any], None]]] = {}
+        self._listening = False
+
+    def publish(self, channel: str, message: Any) -> None:
+        data = json.dumps({"from": self._sender, "msg": message}, separators=(",", ":"))
+        self._redis.publish(f"pistat:{channel}", data)
+
+    def subscribe(self, channel: str, callback: Callable[[Any], None]) -> None:
+        first = channel not in self._callbacks
+        self._callbacks.setdefault(channel, []).append(callback)
+        if first:
+            self._pubsub.subscribe(f"pistat:{channel}")
+        if not self._listening:
+            self._listening = True
+            threading.Thread(target=self._listen, daemon=True, name="bus-redis").start()
+
+    def socketio_manager(self) -> socketio.PubSubManager:
+        return socketio.RedisManager(self._url, channel="pistat:socketio")
+
+    def table_op(self, op: str, table: str, key: Optional[str] = None, value: Any = None) -> Any:
+        name = f"pistat:{table}"
+        if op == "get":
+            raw = self._redis.hget(name, key)
+        elif op == "set":
+            if value is None:
+                self._redis.hdel(name, key)
+            else:
+                self._redis.hset(name, key, json.dumps(value))
+            return None
+        elif op == "pop":
+            pipe = self._redis.pipeline()
+            pipe.hget(name, key)
+            pipe.hdel(name, key)
+            raw = pipe.execute()[0]
+        elif op == "len":
+            return self._redis.hlen(name)
+        elif op == "keys":
+            return [key.decode("utf-8") for key in self._redis.hkeys(name)]
+        else:
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    def _listen(self) -> None:
+        for item in self._pubsub.listen():
+            data = json.loads(item["data"])
+            if data.get("from") == self._sender:
+                continue
+            channel = item["channel"].decode("utf-8")[len("pistat:") :]
+            for callback in list(self._callbacks.get(channel, [])):
+                try:
+                    callback(data.get("msg"))
+                except Exception:  # pragma: no cover - one bad message must not stop the bus
+                    logger.exception("Handler for bus channel '%s' failed", channel)
+
+
+class BusManager(socketio.PubSubManager):
+    """Socket.IO client manager that forwards emits through a :class:`MessageBus`."""
+
+    name = "pistat-bus"
+
+    def __init__(self, bus: MessageBus, channel: str = "socketio") -> None:
+        super().__init__(channel=channel)
+        self._bus = bus
+        self._inbox: "queue.Queue[Any]" = queue.Queue()
+        bus.subscribe(channel, self._inbox.put)
+
+    def _publish(self, data: Any) -> None:
+        self._bus.publish(self.channel, data)
+
+    def _listen(self) -> Iterator[Any]:
+        while True:
+            yield self._inbox.get()
+
+
+class ReplicatedMapping:
+    """Label/task store wrapper that keeps the other workers' caches current.
+
+    Writes go to the wrapped :class:`~state_store.SqliteMapping` (the database is
+    shared) and are announced on ``channel``; announcements from other workers
+    only refresh the local cache.
+    """
+
+    def __init__(self, inner: Any, bus: MessageBus, channel: str) -> None:
+        self._inner = inner
+        self._bus = bus
+        self._channel = channel
+        bus.subscribe(channel, self._apply)
+
+    def get(self, pi_id: str) -> Optional[str]:
+        return self._inner.get(pi_id)
+
+    def has(self, pi_id: str) -> bool:
+        return self._inner.has(pi_id)
+
+    def set(self, pi_id: str, value: Optional[str]) -> None:
+        self._inner.set(pi_id, value)
+        self._bus.publish(self._channel, {"pi_id": pi_id, "value": value})
+
+    def remove(self, pi_id: str) -> None:
+        self.set(pi_id, None)
+
+    def _apply(self, message: Dict[str, Any]) -> None:
+        self._inner.cache(message["pi_id"], message.get("value"))
+
+
+def open_bus(url: str) -> MessageBus:
+    """Connect to the bus at ``url`` (``local://host:port`` or ``redis://...``)."""
+    if url.startswith("local://"):
+        host, _, port = url[len("local://") :].rpartition(":")
+        return SocketBus(host, int(port))
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBus(url)
+    raise ValueError(f"Unsupported message queue URL '{url}' (expected local:// or redis://).")
+
+
+def serve_worker(app: Any, host: str, port: int, async_mode: str) -> None:
+    """Serve ``app`` on ``host:port`` alongside the other workers (SO_REUSEPORT)."""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # The kernel spreads new connections across every worker bound to the port.
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(1024)
+    if async_mode == "gevent":  # pragma: no cover - optional dependency
+        from gevent import pywsgi
+
+        try:
+            from geventwebsocket.handler import WebSocketHandler
+        except ImportError:
+            pywsgi.WSGIServer(listener, app, log=None).serve_forever()
+        else:
+            pywsgi.WSGIServer(listener, app, log=None, handler_class=WebSocketHandler).serve_forever()
+        return
+    from werkzeug.serving import make_server
+
+    make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run several controller processes behind one port")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("PISTAT_CLUSTER_WORKERS", os.cpu_count() or 2)), help="Controller worker processes (default: one per CPU)")
+    parser.add_argument("--host", default=os.environ.get("PISTAT_HOST", "0.0.0.0"), help="Address to listen on (default 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PISTAT_PORT", 8000)), help="Port to listen on (default 8000)")
+    parser.add_argument(
+        "--message-queue",
+        default=os.environ.get("PISTAT_MESSAGE_QUEUE", ""),
+        help="redis:// URL shared by the workers; by default a local broker is started in this process",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("Cluster mode needs SO_REUSEPORT (Linux or BSD).")
+    url = args.message_queue
+    if not url:
+        broker = BusBroker()
+        broker.start()
+        url = broker.url
+    workers = max(1, args.workers)
+    stopping = threading.Event()
+
+    def spawn(index: int) -> subprocess.Popen:
+        env = dict(
+            os.environ,
+            PISTAT_CLUSTER_BUS=url,
+            PISTAT_WORKER_INDEX=str(index),
+            PISTAT_CLUSTER_WORKERS=str(workers),
+            PISTAT_HOST=args.host,
+            PISTAT_PORT=str(args.port),
+        )
+        return subprocess.Popen([sys.executable, str(BASE / "main.py")], env=env, cwd=str(BASE))
+
+    def handle_signal(signum: int, _frame: Any) -> None:
+        stopping.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    processes = [spawn(index) for index in range(workers)]
+    logger.info("Started %d controller workers on %s:%d (bus %s)", workers, args.host, args.port, url)
+    while not stopping.wait(1.0):
+        for index, process in enumerate(processes):
+            if process.poll() is not None:
+                logger.warning("Worker %d exited with %s; restarting it", index, process.returncode)
+                processes[index] = spawn(index)
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    deadline = time.monotonic() + 10
+    for process in processes:
+        try:
+            process.wait(max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
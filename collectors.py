@@ -0,0 +1,491 @@
+from __future__ import annotations
+
+import glob
+import heapq
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import psutil
+
+
+# Collectors the agent runs unless --collectors says otherwise.
+DEFAULT_COLLECTORS = "cpu,memory,load,net,disk,thermal"
+GIB = 1024**3
+SECTOR_BYTES = 512
+# Block devices that are never real disks.
+IGNORED_DISK_PREFIXES = ("loop", "ram", "zram", "dm-", "md")
+# Columns of each row in a process table snapshot.
+PROCESS_COLUMNS = ("pid", "name", "cpu_percent", "memory_percent", "rss_mb", "threads")
+
+
+class ProcFile:
+    """A /proc or /sys file kept open and reread from offset 0 with ``os.pread``.
+
+    Reopening a file on every tick costs an open/close pair of syscalls plus a
+    Python file object; with a persistent descriptor each reread is one pread.
+    The read size grows until a whole file fits in one call.
+    """
+
+    def __init__(self, path: str, size: int = 4096) -> None:
+        self.path = path
+        self._size = size
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def read(self) -> bytes:
+        while True:
+            data = os.pread(self._fd, self._size, 0)
+            if len(data) < self._size:
+                return data
+            self._size *= 2
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class Collector:
+    """One source of sample fields, read at most every ``interval`` seconds.
+
+    :meth:`collect` returns the fields to merge into the sample. Collectors
+    that report rates keep the previous counters and return nothing on their
+    first call.
+    """
+
+    name = ""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.next_due = 0.0
+        self.values: Dict[str, Any] = {}
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class _RateMixin:
+    """Turn monotonically increasing counters into per-second rates."""
+
+    _previous: Optional[Tuple[float, Tuple[int, ...]]] = None
+
+    def _rates(self, now: float, counters: Tuple[int, ...]) -> Optional[Tuple[float, ...]]:
+        previous, self._previous = self._previous, (now, counters)
+        if previous is None or now <= previous[0]:
+            return None
+        elapsed = now - previous[0]
+        # Counters reset when an interface or disk goes away; report zero, not a negative rate.
+        return tuple(max(0, new - old) / elapsed for new, old in zip(counters, previous[1]))
+
+
+class ProcStatCollector(Collector):
+    """CPU busy and iowait percentages from the ``cpu`` line of /proc/stat."""
+
+    name = "cpu"
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(interval)
+        self._file = ProcFile("/proc/stat")
+        self._previous = self._read()
+
+    def _read(self) -> Tuple[int, int, int]:
+        line = self._file.read().split(b"\n", 1)[0]
+        # user nice system idle iowait irq softirq steal (guest time is already in user/nice).
+        fields = [int(value) for value in line.split()[1:9]]
+        idle, iowait = fields[3], fields[4]
+        return sum(fields), idle + iowait, iowait
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        total, idle, iowait = self._read()
+        previous, self._previous = self._previous, (total, idle, iowait)
+        elapsed = total - previous[0]
+        if elapsed <= 0:
+            return dict(self.values)
+        return {
+            "cpu_percent": round(100.0 * (1.0 - (idle - previous[1]) / elapsed), 1),
+            "cpu_iowait_percent": round(100.0 * (iowait - previous[2]) / elapsed, 1),
+        }
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class MeminfoCollector(Collector):
+    """RAM and swap usage from /proc/meminfo, computed the way psutil does."""
+
+    name = "memory"
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(interval)
+        self._file = ProcFile("/proc/meminfo")
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        fields: Dict[bytes, int] = {}
+        for line in self._file.read().splitlines():
+            key, _, rest = line.partition(b":")
+            if key in (b"MemTotal", b"MemAvailable", b"MemFree", b"SwapTotal", b"SwapFree"):
+                fields[key] = int(rest.split()[0]) * 1024
+        total = fields.get(b"MemTotal", 0)
+        available = fields.get(b"MemAvailable", fields.get(b"MemFree", 0))
+        swap_total = fields.get(b"SwapTotal", 0)
+        used = total - available
+        return {
+            "ram_percent": round(100.0 * used / total, 1) if total else 0.0,
+            "ram_used_gb": used / GIB,
+            "ram_total_gb": total / GIB,
+            "swap_percent": round(100.0 * (swap_total - fields.get(b"SwapFree", 0)) / swap_total, 1) if swap_total else 0.0,
+        }
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class LoadavgCollector(Collector):
+    name = "load"
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(interval)
+        self._file = ProcFile("/proc/loadavg")
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        one, five, fifteen = (float(value) for value in self._file.read().split()[:3])
+        return {"load_1": one, "load_5": five, "load_15": fifteen}
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class NetDevCollector(_RateMixin, Collector):
+    """Received and sent bytes per second over every interface except loopback, from /proc/net/dev."""
+
+    name = "net"
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(interval)
+        self._file = ProcFile("/proc/net/dev")
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        received = sent = 0
+        for line in self._file.read().splitlines()[2:]:
+            interface, _, counters = line.partition(b":")
+            if interface.strip() == b"lo":
+                continue
+            fields = counters.split()
+            received += int(fields[0])
+            sent += int(fields[8])
+        rates = self._rates(now, (received, sent))
+        if rates is None:
+            return {}
+        return {"net_rx_bytes_per_sec": round(rates[0]), "net_tx_bytes_per_sec": round(rates[1])}
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class DiskstatsCollector(_RateMixin, Collector):
+    """Bytes read and written per second across whole disks (not partitions), from /proc/diskstats."""
+
+    name = "disk"
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(interval)
+        self._file = ProcFile("/proc/diskstats")
+        self._disks = {
+            name.encode()
+            for name in os.listdir("/sys/block")
+            if not name.startswith(IGNORED_DISK_PREFIXES)
+        }
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        read = written = 0
+        for line in self._file.read().splitlines():
+            fields = line.split()
+            if len(fields) > 9 and fields[2] in self._disks:
+                read += int(fields[5])
+                written += int(fields[9])
+        rates = self._rates(now, (read, written))
+        if rates is None:
+            return {}
+        return {
+            "disk_read_bytes_per_sec": round(rates[0] * SECTOR_BYTES),
+            "disk_write_bytes_per_sec": round(rates[1] * SECTOR_BYTES),
+        }
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ThermalCollector(Collector):
+    """Hottest thermal zone in /sys/class/thermal, plus the Raspberry Pi firmware's throttling flags."""
+
+    name = "thermal"
+    # Undervoltage/frequency-capping/throttling bits, as `vcgencmd get_throttled` reports them.
+    THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(interval)
+        self._zones: List[ProcFile] = []
+        for path in sorted(glob.glob("/sys/class/thermal/thermal_zone*/temp")):
+            try:
+                self._zones.append(ProcFile(path, size=64))
+            except OSError:
+                continue
+        self._throttled: Optional[ProcFile] = None
+        try:
+            self._throttled = ProcFile(self.THROTTLED_PATH, size=64)
+        except OSError:
+            pass
+        if not self._zones and self._throttled is None:
+            raise FileNotFoundError("no thermal zones")
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        values: Dict[str, Any] = {}
+        temperatures = []
+        for zone in self._zones:
+            try:
+                temperatures.append(int(zone.read()) / 1000.0)
+            except (OSError, ValueError):
+                # Some zones fail to read while their sensor is powered down.
+                continue
+        if temperatures:
+            values["temp_c"] = round(max(temperatures), 1)
+        if self._throttled is not None:
+            try:
+                values["throttled"] = int(self._throttled.read(), 16)
+            except (OSError, ValueError):
+                pass
+        return values
+
+    def close(self) -> None:
+        for zone in self._zones:
+            zone.close()
+        if self._throttled is not None:
+            self._throttled.close()
+
+
+class PsutilCpuCollector(Collector):
+    name = "cpu"
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(interval)
+        psutil.cpu_percent(interval=None)  # primes the counters
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        return {"cpu_percent": psutil.cpu_percent(interval=None)}
+
+
+class PsutilMemoryCollector(Collector):
+    name = "memory"
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        memory = psutil.virtual_memory()
+        return {
+            "ram_percent": memory.percent,
+            "ram_used_gb": (memory.total - memory.available) / GIB,
+            "ram_total_gb": memory.total / GIB,
+        }
+
+
+class PsutilLoadCollector(Collector):
+    name = "load"
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        one, five, fifteen = psutil.getloadavg()
+        return {"load_1": one, "load_5": five, "load_15": fifteen}
+
+
+class PsutilNetCollector(_RateMixin, Collector):
+    name = "net"
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        counters = psutil.net_io_counters()
+        rates = self._rates(now, (counters.bytes_recv, counters.bytes_sent))
+        if rates is None:
+            return {}
+        return {"net_rx_bytes_per_sec": round(rates[0]), "net_tx_bytes_per_sec": round(rates[1])}
+
+
+class PsutilDiskCollector(_RateMixin, Collector):
+    name = "disk"
+
+    def collect(self, now: float) -> Dict[str, Any]:
+        counters = psutil.disk_io_counters()
+        if counters is None:
+            return {}
+        rates = self._rates(now, (counters.read_bytes, counters.write_bytes))
+        if rates is None:
+            return {}
+        return {"disk_read_bytes_per_sec": round(rates[0]), "disk_write_bytes_per_sec": round(rates[1])}
+
+
+# name -> implementations in order of preference; the first that can start is used.
+COLLECTORS: Dict[str, Tuple[Callable[[float], Collector], ...]] = {
+    "cpu": (ProcStatCollector, PsutilCpuCollector),
+    "memory": (MeminfoCollector, PsutilMemoryCollector),
+    "load": (LoadavgCollector, PsutilLoadCollector),
+    "net": (NetDevCollector, PsutilNetCollector),
+    "disk": (DiskstatsCollector, PsutilDiskCollector),
+    "thermal": (ThermalCollector,),
+}
+
+
+def parse_collectors(spec: str, default_interval: float) -> List[Tuple[str, float]]:
+    """Parse ``"cpu,memory,net:5,thermal:10"`` into ``(name, interval)`` pairs.
+
+    Raises ValueError for unknown names or bad intervals.
+    """
+    parsed: List[Tuple[str, float]] = []
+    for item in spec.split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        name, _, interval_text = item.partition(":")
+        if name not in COLLECTORS:
+            raise ValueError(f"unknown collector '{name}' (choose from {', '.join(COLLECTORS)})")
+        try:
+            interval = float(interval_text) if interval_text else default_interval
+        except ValueError:
+            raise ValueError(f"collector '{name}' has an invalid interval '{interval_text}'") from None
+        parsed.append((name, max(default_interval, interval)))
+    return parsed
+
+
+class CollectorSet:
+    """Runs the configured collectors for each stats sample.
+
+    Each collector runs when its interval is due; in between, its last values
+    are repeated so every sample carries the full metric set. ``collect_cpu_ms``
+    in each sample is the CPU time this tick's collection took.
+    """
+
+    def __init__(self, spec: str, default_interval: float, logger: Optional[logging.Logger] = None) -> None:
+        self.logger = logger or logging.getLogger("pi-agent")
+        self.collectors: List[Collector] = []
+        for name, interval in parse_collectors(spec, default_interval):
+            collector = self._start(name, interval)
+            if collector is not None:
+                self.collectors.append(collector)
+        self.logger.info(
+            "Collectors: %s",
+            ", ".join(f"{c.name}/{type(c).__name__} every {c.interval:g}s" for c in self.collectors) or "none",
+        )
+
+    def _start(self, name: str, interval: float) -> Optional[Collector]:
+        for factory in COLLECTORS[name]:
+            try:
+                return factory(interval)
+            except (OSError, AttributeError, NotImplementedError) as exc:
+                # AttributeError: os.pread or a psutil call this platform lacks.
+                self.logger.debug("Collector %s unavailable via %s: %s", name, factory.__name__, exc)
+        self.logger.info("Collector %s is not available on this system", name)
+        return None
+
+    def sample(self) -> Dict[str, Any]:
+        started = time.thread_time()
+        now = time.monotonic()
+        sample: Dict[str, Any] = {"ts": time.time()}
+        for collector in self.collectors:
+            if now >= collector.next_due:
+                collector.next_due = now + collector.interval
+                try:
+                    collector.values = collector.collect(now)
+                except (OSError, ValueError, IndexError) as exc:
+                    self.logger.debug("Collector %s failed: %s", collector.name, exc)
+                    collector.values = {}
+            sample.update(collector.values)
+        sample["collect_cpu_ms"] = round((time.thread_time() - started) * 1000.0, 3)
+        return sample
+
+    def close(self) -> None:
+        for collector in self.collectors:
+            collector.close()
+
+
+class ProcessTable:
+    """Top CPU and memory consumers plus per-core utilization, refreshed incrementally.
+
+    ``psutil.process_iter`` keeps one Process object per pid between calls, so
+    a refresh only builds objects for new processes and each ``cpu_percent`` is
+    measured since the previous refresh (or since the table was created); the
+    requested attributes are read in one ``oneshot()`` pass per process.
+    Per-core busy time comes from the ``cpuN`` lines of /proc/stat (psutil
+    elsewhere), over the same period.
+
+    :meth:`snapshot` returns a compact payload: ``processes`` holds rows of
+    :data:`PROCESS_COLUMNS`, the union of the ``top`` busiest by CPU and the
+    ``top`` largest by resident memory.
+    """
+
+    ATTRS = ["name", "cpu_percent", "memory_info", "num_threads"]
+
+    def __init__(self, top: int = 10) -> None:
+        self.top = max(1, top)
+        self._lock = threading.Lock()
+        self._stat: Optional[ProcFile] = None
+        try:
+            self._stat = ProcFile("/proc/stat")
+        except (OSError, AttributeError):
+            pass
+        self._cores = self._core_times()
+        # Primes each process's CPU counters so the first snapshot has real numbers.
+        for _process in psutil.process_iter(["cpu_percent"]):
+            pass
+
+    def _core_times(self) -> List[Tuple[float, float]]:
+        """(total, idle) jiffies or seconds for each core."""
+        if self._stat is not None:
+            cores = []
+            for line in self._stat.read().splitlines()[1:]:
+                if not line.startswith(b"cpu"):
+                    break
+                fields = [int(value) for value in line.split()[1:9]]
+                cores.append((float(sum(fields)), float(fields[3] + fields[4])))
+            return cores
+        return [(sum(times), times.idle + getattr(times, "iowait", 0.0)) for times in psutil.cpu_times(percpu=True)]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            started = time.thread_time()
+            cores = self._core_times()
+            previous, self._cores = self._cores, cores
+            core_percent = []
+            for (total, idle), (old_total, old_idle) in zip(cores, previous):
+                elapsed = total - old_total
+                core_percent.append(round(100.0 * (1.0 - (idle - old_idle) / elapsed), 1) if elapsed > 0 else 0.0)
+
+            memory_total = psutil.virtual_memory().total
+            rows = []
+            for process in psutil.process_iter(self.ATTRS, ad_value=None):
+                info = process.info
+                memory = info["memory_info"]
+                rss = memory.rss if memory is not None else 0
+                rows.append(
+                    (
+                        process.pid,
+                        info["name"] or "?",
+                        round(info["cpu_percent"] or 0.0, 1),
+                        round(100.0 * rss / memory_total, 1) if memory_total else 0.0,
+                        round(rss / 1048576, 1),
+                        info["num_threads"] or 0,
+                    )
+                )
+            busiest = heapq.nlargest(self.top, rows, key=lambda row: row[2])
+            largest = heapq.nlargest(self.top, rows, key=lambda row: row[4])
+            chosen = {row[0]: row for row in busiest + largest}
+            return {
+                "ts": time.time(),
+                "cores": core_percent,
+                "columns": list(PROCESS_COLUMNS),
+                "processes": [list(row) for row in sorted(chosen.values(), key=lambda row: (-row[2], -row[4]))],
+                "process_count": len(rows),
+                "collect_cpu_ms": round((time.thread_time() - started) * 1000.0, 3),
+            }
+
+    def close(self) -> None:
+        if self._stat is not None:
+            self._stat.close()
@@ -0,0 +1,352 @@
+from __future__ import annotations
+
+import bisect
+import contextlib
+import inspect
+import json
+import threading
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+# Bucket upper bounds: seconds for latencies, bytes for payload sizes.
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+SIZE_BUCKETS: Tuple[float, ...] = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+Labels = Tuple[Tuple[str, str], ...]
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Histogram:
+    """Fixed-bucket histogram; :meth:`observe` is one bisect and three increments.
+
+    ``synchronized=False`` skips the histogram's own lock for callers that
+    already serialise observations (see :class:`TimedLock`).
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS, synchronized: bool = True) -> None:
+        self.bounds = tuple(bounds)
+        # One slot per bound plus the +Inf overflow; not cumulative.
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock: Any = threading.Lock() if synchronized else contextlib.nullcontext()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def copy(self) -> "Histogram":
+        clone = Histogram(self.bounds, synchronized=False)
+        with self._lock:
+            clone.counts = list(self.counts)
+            clone.sum = self.sum
+            clone.count = self.count
+        return clone
+
+    def merge(self, other: "Histogram") -> None:
+        for index, value in enumerate(other.counts):
+            self.counts[index] += value
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the ``fraction`` quantile (the largest bound if it overflowed)."""
+        if not self.count:
+            return 0.0
+        target = self.count * fraction
+        seen = 0
+        for index, value in enumerate(self.counts):
+            seen += value
+            if seen >= target:
+                return self.bounds[min(index, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self) -> None:
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class TimedLock:
+    """Drop-in ``threading.Lock`` that records how often callers had to wait, and for how long.
+
+    An uncontended acquire costs one extra non-blocking attempt. Statistics are
+    updated while the lock is held, so they need no lock of their own.
+    """
+
+    __slots__ = ("_lock", "acquired", "contended", "wait")
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.contended = 0
+        self.wait = Histogram(LATENCY_BUCKETS, synchronized=False)
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self._lock.acquire(False):
+            self.acquired += 1
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        if not self._lock.acquire(True, timeout):
+            return False
+        self.acquired += 1
+        self.contended += 1
+        self.wait.observe(time.perf_counter() - started)
+        return True
+
+    def release(self) -> None:
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._lock.release()
+
+
+class Instruments:
+    """Registry of counters, histograms, timed locks and gauges for one process.
+
+    Metrics are created once, up front, and recorded through the returned
+    objects, so the hot path never looks anything up. Gauges are callables read
+    only when the metrics are collected. :meth:`render` produces the Prometheus
+    text format and :meth:`snapshot` a JSON-friendly summary.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[Tuple[str, Labels], Counter] = {}
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._locks: List[Tuple[str, TimedLock]] = []
+        self._gauges: List[Tuple[str, Labels, Callable[[], float]]] = []
+
+    def _declare(self, name: str, kind: str, help_text: str) -> None:
+        if name not in self._help:
+            self._help[name] = (kind, help_text)
+
+    def counter(self, name: str, help_text: str, **labels: str) -> Counter:
+        key = (name, tuple(sorted(labels.items())))
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                self._declare(name, "counter", help_text)
+                counter = self._counters.setdefault(key, Counter())
+        return counter
+
+    def histogram(
+        self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS, **labels: str
+    ) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                self._declare(name, "histogram", help_text)
+                histogram = self._histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def lock(self, name: str) -> TimedLock:
+        """A new :class:`TimedLock`; locks sharing a name are reported together."""
+        timed_lock = TimedLock()
+        with self._lock:
+            self._locks.append((name, timed_lock))
+        return timed_lock
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], float], **labels: str) -> None:
+        with self._lock:
+            self._declare(name, "gauge", help_text)
+            self._gauges.append((name, tuple(sorted(labels.items())), read))
+
+    def timed(self, label: Optional[str] = None) -> Callable[[F], F]:
+        """Decorator recording calls, errors and duration under ``handler=<label or function name>``."""
+
+        def decorator(fn: F) -> F:
+            handler = label or fn.__name__
+            durations = self.histogram(
+                "pistat_handler_seconds", "Time spent in Socket.IO handlers, relays and stats broadcasts.", handler=handler
+            )
+            errors = self.counter(
+                "pistat_handler_errors_total", "Handler calls that raised an exception.", handler=handler
+            )
+            # Flask-SocketIO retries connect/disconnect handlers without arguments
+            # when they raise TypeError; call argument-less handlers that way up
+            # front so the retry is not counted as an error.
+            code = fn.__code__
+            takes_args = code.co_argcount > 0 or bool(code.co_flags & inspect.CO_VARARGS)
+
+            @wraps(fn)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                if not takes_args:
+                    args = ()
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    durations.observe(time.perf_counter() - started)
+
+            return wrapper  # type: ignore[return-value]
+
+        return decorator
+
+    def _collect(self) -> Iterator[Tuple[str, str, str, List[Tuple[Labels, Any]]]]:
+        """Yield ``(name, kind, help, [(labels, value)])`` for every metric family."""
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = list(self._histograms.items())
+            locks = list(self._locks)
+            gauges = list(self._gauges)
+            help_texts = dict(self._help)
+        families: Dict[str, List[Tuple[Labels, Any]]] = {}
+        for (name, labels), counter in counters:
+            families.setdefault(name, []).append((labels, counter.value))
+        for (name, labels), histogram in histograms:
+            families.setdefault(name, []).append((labels, histogram.copy()))
+        for name, labels, read in gauges:
+            try:
+                value = float(read())
+            except Exception:  # pragma: no cover - a broken gauge must not break the scrape
+                continue
+            families.setdefault(name, []).append((labels, value))
+        for name, samples in families.items():
+            kind, help_text = help_texts[name]
+            yield name, kind, help_text, samples
+
+        acquired: Dict[str, int] = {}
+        contended: Dict[str, int] = {}
+        waits: Dict[str, Histogram] = {}
+        for name, timed_lock in locks:
+            acquired[name] = acquired.get(name, 0) + timed_lock.acquired
+            contended[name] = contended.get(name, 0) + timed_lock.contended
+            waits.setdefault(name, Histogram(LATENCY_BUCKETS, synchronized=False)).merge(timed_lock.wait)
+        if locks:
+            yield "pistat_lock_acquired_total", "counter", "Lock acquisitions.", [
+                ((("lock", name),), value) for name, value in acquired.items()
+            ]
+            yield "pistat_lock_contended_total", "counter", "Lock acquisitions that had to wait.", [
+                ((("lock", name),), value) for name, value in contended.items()
+            ]
+            yield "pistat_lock_wait_seconds", "histogram", "Time spent waiting for a held lock.", [
+                ((("lock", name),), value) for name, value in waits.items()
+            ]
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for name, kind, help_text, samples in self._collect():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.bounds, value.counts):
+                    cumulative += count
+                    le = _format_labels(labels + (("le", _format_number(bound)),))
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {value.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(value.sum)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Every metric as ``{name: [{labels, value}]}``; histograms become count/sum/p50/p99."""
+        result: Dict[str, List[Dict[str, Any]]] = {}
+        for name, kind, _help, samples in self._collect():
+            rows = []
+            for labels, value in samples:
+                row: Dict[str, Any] = {"labels": dict(labels)}
+                if kind == "histogram":
+                    row.update(
+                        count=value.count, sum=value.sum, p50=value.quantile(0.5), p99=value.quantile(0.99)
+                    )
+                else:
+                    row["value"] = value
+                rows.append(row)
+            result[name] = rows
+        return result
+
+
+class MeteredJSON:
+    """``json`` stand-in for Socket.IO that records packet sizes per event as they are encoded.
+
+    Pass an instance as ``SocketIO(json=...)``. Sizes come from the strings the
+    server builds anyway, so metering adds no serialisation work. At most
+    ``max_events`` event names get their own series; the rest are reported as
+    ``other``.
+    """
+
+    def __init__(self, instruments: Instruments, max_events: int = 100) -> None:
+        self._instruments = instruments
+        self._max_events = max_events
+        self._series: Dict[Tuple[str, str], Histogram] = {}
+
+    def _record(self, direction: str, data: Any, size: int) -> None:
+        if isinstance(data, list):
+            event = data[0] if data and isinstance(data[0], str) else "ack"
+        else:
+            event = "connect"  # handshake payloads are plain objects
+        histogram = self._series.get((direction, event))
+        if histogram is None:
+            if len(self._series) >= self._max_events:
+                # Clients choose event names; never let them grow the series without bound.
+                event = "other"
+                histogram = self._series.get((direction, event))
+            if histogram is None:
+                histogram = self._series[(direction, event)] = self._instruments.histogram(
+                    "pistat_socketio_packet_bytes",
+                    "Encoded size of Socket.IO packets by direction and event.",
+                    SIZE_BUCKETS,
+                    direction=direction,
+                    event=event,
+                )
+        histogram.observe(size)
+
+    def dumps(self, obj: Any, *args: Any, **kwargs: Any) -> str:
+        text = json.dumps(obj, *args, **kwargs)
+        self._record("out", obj, len(text))
+        return text
+
+    def loads(self, text: Any, *args: Any, **kwargs: Any) -> Any:
+        data = json.loads(text, *args, **kwargs)
+        self._record("in", data, len(text))
+        return data
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_number(value: float) -> str:
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -0,0 +1,527 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import psutil
+import socketio
+
+from wire import WIRE_FEATURE, encode as encode_wire
+
+
+BASE = Path(__file__).resolve().parent
+PI_NAMESPACE = "/pi"
+UI_NAMESPACE = "/ui"
+# Stats reports carry their send time in active_task so the UI side can time
+# them through the registry and stats_delta path.
+STATS_MARK = "lg "
+
+
+class Recorder:
+    """Event counts and latency samples (seconds) collected by one process."""
+
+    def __init__(self) -> None:
+        self.counts: Counter = Counter()
+        self.latencies: Dict[str, List[float]] = {}
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counts[name] += amount
+
+    def latency(self, name: str, seconds: float) -> None:
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"counts": dict(self.counts), "latencies": self.latencies}
+
+    def merge(self, data: Dict[str, Any]) -> None:
+        self.counts.update(data.get("counts") or {})
+        for name, values in (data.get("latencies") or {}).items():
+            self.latencies.setdefault(name, []).extend(values)
+
+
+def _stamped_lines(count: int, line_bytes: int) -> List[str]:
+    stamp = f"{time.time():.6f} "
+    return [stamp + "x" * max(0, line_bytes - len(stamp))] * count
+
+
+class SimulatedAgent:
+    """One fake Pi speaking the real /pi protocol.
+
+    Registers like ``pi_agent.py``, reports stats every ``stats_interval``
+    seconds (as ``stats_batch`` when the controller offers it) and answers
+    ``execute_task``/``execute_terminal`` by streaming timestamped output lines.
+    """
+
+    def __init__(self, url: str, pi_id: str, options: Dict[str, Any], recorder: Recorder) -> None:
+        self.url = url
+        self.pi_id = pi_id
+        self.options = options
+        self.recorder = recorder
+        self.features: List[str] = []
+        self.binary_wire = False
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on("execute_task", self._on_execute_task, namespace=PI_NAMESPACE)
+        self.sio.on("execute_terminal", self._on_execute_terminal, namespace=PI_NAMESPACE)
+
+    async def run(self, deadline: float) -> None:
+        try:
+            await self.sio.connect(self.url, namespaces=[PI_NAMESPACE], transports=["websocket"], wait_timeout=60)
+            reply = await self.sio.call(
+                "register",
+                {
+                    "pi_id": self.pi_id,
+                    "label": self.pi_id,
+                    "ram_total_gb": 1.0,
+                    "active_task": "Idle",
+                    "hostname": self.pi_id,
+                    "platform": "loadgen",
+                    "cpu_count": 4,
+                },
+                namespace=PI_NAMESPACE,
+                timeout=60,
+            )
+        except Exception:
+            self.recorder.count("agents_failed")
+            return
+        if isinstance(reply, dict) and reply.get("error"):
+            self.recorder.count("agents_refused")
+            await self.sio.disconnect()
+            return
+        self.features = list(reply.get("features") or []) if isinstance(reply, dict) else []
+        self.binary_wire = self.options["wire"] != "json" and WIRE_FEATURE in self.features
+        self.recorder.count("agents_registered")
+        interval = self.options["stats_interval"]
+        try:
+            # Spread the first reports over one interval so agents do not report in lockstep.
+            await asyncio.sleep(random.uniform(0.0, interval))
+            while time.monotonic() < deadline:
+                await self._report_stats()
+                await asyncio.sleep(interval)
+        except Exception:
+            self.recorder.count("agent_errors")
+        finally:
+            try:
+                await self.sio.disconnect()
+            except Exception:
+                pass
+
+    async def _report_stats(self) -> None:
+        now = time.time()
+        sample = {
+            "ts": now,
+            "cpu_percent": random.uniform(0.0, 100.0),
+            "ram_percent": random.uniform(10.0, 90.0),
+            "ram_used_gb": 0.5,
+            "ram_total_gb": 1.0,
+        }
+        active_task = f"{STATS_MARK}{now:.6f}"
+        if "stats_batch" in self.features:
+            started = time.monotonic()
+            await self.sio.call(
+                "stats_batch",
+                self._frame({"pi_id": self.pi_id, "active_task": active_task, "samples": [sample]}),
+                namespace=PI_NAMESPACE,
+                timeout=60,
+            )
+            self.recorder.latency("stats_ack", time.monotonic() - started)
+        else:
+            await self.sio.emit("stats_report", dict(sample, pi_id=self.pi_id, active_task=active_task), namespace=PI_NAMESPACE)
+        self.recorder.count("stats_sent")
+
+    def _frame(self, payload: Dict[str, Any]) -> Any:
+        return encode_wire(payload, omit=("pi_id",)) if self.binary_wire else payload
+
+    async def _on_execute_task(self, payload: Dict[str, Any]) -> None:
+        base = {"request_id": payload.get("request_id"), "task_id": payload.get("task_id"), "pi_id": self.pi_id}
+        await self._stream("task", base, self.options["task_lines"])
+
+    async def _on_execute_terminal(self, payload: Dict[str, Any]) -> None:
+        base = {"request_id": payload.get("request_id"), "pi_id": self.pi_id}
+        await self._stream("terminal", base, self.options["terminal_lines"])
+
+    async def _stream(self, kind: str, base: Dict[str, Any], lines: int) -> None:
+        await self.sio.emit(f"{kind}_started", dict(base), namespace=PI_NAMESPACE)
+        batch = 100 if "output_batch" in self.features else 1
+        sent = 0
+        while sent < lines:
+            size = min(batch, lines - sent)
+            chunk = _stamped_lines(size, self.options["line_bytes"])
+            if "output_batch" in self.features:
+                payload = self._frame(dict(base, lines=chunk))
+            else:
+                payload = dict(base, line=chunk[0])
+            await self.sio.emit(f"{kind}_output", payload, namespace=PI_NAMESPACE)
+            self.recorder.count("output_events_sent")
+            self.recorder.count("output_lines_sent", size)
+            sent += size
+            # Yield so one burst does not monopolise the loop.
+            await asyncio.sleep(0)
+        await self.sio.emit(f"{kind}_finished", dict(base, exit_code=0), namespace=PI_NAMESPACE)
+
+
+class SimulatedUI:
+    """A dashboard client on /ui that acknowledges stats deltas and times what it receives.
+
+    Every ``task_interval`` seconds it runs a task on a random simulated agent,
+    and every ``terminal_interval`` seconds it sends ``terminal_burst`` terminal
+    commands at once.
+    """
+
+    def __init__(self, url: str, pi_ids: List[str], options: Dict[str, Any], recorder: Recorder) -> None:
+        self.url = url
+        self.pi_ids = pi_ids
+        self.options = options
+        self.recorder = recorder
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on("stats_delta", self._on_stats_delta, namespace=UI_NAMESPACE)
+        for event in ("task_output", "terminal_output"):
+            self.sio.on(event, self._on_output, namespace=UI_NAMESPACE)
+        for event in ("task_finished", "terminal_finished", "task_error", "terminal_error"):
+            self.sio.on(event, lambda _payload, event=event: self.recorder.count(f"ui_{event}"), namespace=UI_NAMESPACE)
+
+    async def run(self, deadline: float) -> None:
+        try:
+            await self.sio.connect(self.url, namespaces=[UI_NAMESPACE], transports=["websocket"], wait_timeout=60)
+        except Exception:
+            self.recorder.count("ui_failed")
+            return
+        self.recorder.count("ui_connected")
+        loops = []
+        if self.options["task_interval"] > 0:
+            loops.append(self._every(self.options["task_interval"], deadline, self._run_task))
+        if self.options["terminal_interval"] > 0:
+            loops.append(self._every(self.options["terminal_interval"], deadline, self._terminal_burst))
+        loops.append(asyncio.sleep(max(0.0, deadline - time.monotonic())))
+        try:
+            await asyncio.gather(*loops)
+            # Let the last output drain before disconnecting.
+            await asyncio.sleep(1.0)
+        finally:
+            await self.sio.disconnect()
+
+    async def _every(self, interval: float, deadline: float, action: Any) -> None:
+        await asyncio.sleep(random.uniform(0.0, interval))
+        while time.monotonic() < deadline:
+            if self.pi_ids:
+                try:
+                    await action(random.choice(self.pi_ids))
+                except Exception:
+                    self.recorder.count("ui_errors")
+            await asyncio.sleep(interval)
+
+    async def _run_task(self, pi_id: str) -> None:
+        reply = await self.sio.call("run_task", {"task": "uptime", "pi_id": pi_id}, namespace=UI_NAMESPACE, timeout=30)
+        self.recorder.count("ui_run_task" if isinstance(reply, dict) and not reply.get("error") else "ui_rejected")
+
+    async def _terminal_burst(self, _pi_id: str) -> None:
+        for _ in range(self.options["terminal_burst"]):
+            pi_id = random.choice(self.pi_ids)
+            reply = await self.sio.call(
+                "terminal_command", {"pi_id": pi_id, "command": "loadgen"}, namespace=UI_NAMESPACE, timeout=30
+            )
+            self.recorder.count("ui_terminal_command" if isinstance(reply, dict) and not reply.get("error") else "ui_rejected")
+
+    async def _on_stats_delta(self, payload: Dict[str, Any]) -> None:
+        now = time.time()
+        self.recorder.count("ui_stats_delta")
+        for entry in payload.get("entries") or []:
+            active = entry.get("active_task")
+            if isinstance(active, str) and active.startswith(STATS_MARK):
+                self.recorder.count("ui_stats_entries")
+                if not payload.get("full"):
+                    self.recorder.latency("stats_to_ui", now - float(active[len(STATS_MARK) :]))
+        try:
+            await self.sio.emit("stats_ack", {"version": payload.get("version")}, namespace=UI_NAMESPACE)
+        except socketio.exceptions.BadNamespaceError:
+            pass  # Delta arrived while disconnecting.
+
+    def _on_output(self, payload: Dict[str, Any]) -> None:
+        now = time.time()
+        lines = payload.get("lines")
+        if not isinstance(lines, list):
+            lines = [payload.get("line", "")]
+        self.recorder.count("ui_output_events")
+        self.recorder.count("ui_output_lines", len(lines))
+        try:
+            self.recorder.latency("output_to_ui", now - float(str(lines[0]).split(" ", 1)[0]))
+        except (IndexError, ValueError):
+            pass
+
+
+async def _run_agents(url: str, pi_ids: List[str], options: Dict[str, Any], recorder: Recorder) -> None:
+    deadline = time.monotonic() + options["ramp_seconds"] + options["duration"]
+    tasks = []
+    delay = 1.0 / options["ramp"] if options["ramp"] > 0 else 0.0
+    for pi_id in pi_ids:
+        tasks.append(asyncio.create_task(SimulatedAgent(url, pi_id, options, recorder).run(deadline)))
+        if delay:
+            await asyncio.sleep(delay)
+    await asyncio.gather(*tasks)
+
+
+def _agent_process(url: str, pi_ids: List[str], options: Dict[str, Any], results: Any) -> None:
+    recorder = Recorder()
+    try:
+        asyncio.run(_run_agents(url, pi_ids, options, recorder))
+    finally:
+        results.put(recorder.to_dict())
+
+
+class ControllerMonitor:
+    """Sample CPU and RSS of a controller process (and its children) once a second."""
+
+    def __init__(self, pid: int) -> None:
+        self._root = psutil.Process(pid)
+        self._procs: Dict[int, psutil.Process] = {}
+        self.cpu: List[float] = []
+        self.rss: List[int] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="controller-monitor")
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=2.0)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            cpu = 0.0
+            rss = 0
+            try:
+                current = [self._root] + self._root.children(recursive=True)
+            except psutil.Error:
+                return
+            for proc in current:
+                # Reuse Process objects: cpu_percent() measures since the previous call.
+                proc = self._procs.setdefault(proc.pid, proc)
+                try:
+                    cpu += proc.cpu_percent(interval=None)
+                    rss += proc.memory_info().rss
+                except psutil.Error:
+                    self._procs.pop(proc.pid, None)
+            if len(self.rss) or cpu:
+                self.cpu.append(cpu)
+            self.rss.append(rss)
+            self._stop.wait(1.0)
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_controller(args: argparse.Namespace) -> Tuple[str, subprocess.Popen, tempfile.TemporaryDirectory]:
+    """Start main.py (or cluster.py) on a free port with throwaway state."""
+    port = _free_port()
+    state = tempfile.TemporaryDirectory(prefix="pistat-loadgen-")
+    env = dict(
+        os.environ,
+        PISTAT_HOST="127.0.0.1",
+        PISTAT_PORT=str(port),
+        PISTAT_STATE_DIR=state.name,
+        PISTAT_DEBUG="0",
+        PISTAT_MAX_AGENTS=str(max(args.agents, 1)),
+    )
+    if args.async_mode:
+        env["PISTAT_ASYNC_MODE"] = args.async_mode
+    if args.cluster_workers:
+        command = [sys.executable, str(BASE / "cluster.py"), "--workers", str(args.cluster_workers)]
+        command += ["--host", "127.0.0.1", "--port", str(port)]
+    else:
+        command = [sys.executable, str(BASE / "main.py")]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Controller exited with {process.returncode} during startup.")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                break
+        except OSError:
+            time.sleep(0.2)
+    # Cluster workers bind one after another; give them all a moment.
+    time.sleep(2.0 if args.cluster_workers else 0.5)
+    return f"http://127.0.0.1:{port}", process, state
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000.0, 1)
+
+    return {"n": len(ordered), "p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99), "max_ms": pick(1.0)}
+
+
+def build_report(recorder: Recorder, monitor: Optional[ControllerMonitor], args: argparse.Namespace, elapsed: float) -> Dict[str, Any]:
+    counts = recorder.counts
+    sent = counts["stats_sent"] + counts["output_events_sent"]
+    received = counts["ui_stats_delta"] + counts["ui_output_events"]
+    report: Dict[str, Any] = {
+        "agents": args.agents,
+        "agents_registered": counts["agents_registered"],
+        "agents_failed": counts["agents_failed"] + counts["agents_refused"],
+        "ui_clients": counts["ui_connected"],
+        "seconds": round(elapsed, 1),
+        "agent_events_per_sec": round(sent / elapsed, 1),
+        "ui_events_per_sec": round(received / elapsed, 1),
+        "output_lines_per_sec": round(counts["ui_output_lines"] / elapsed, 1),
+        "counts": dict(sorted(counts.items())),
+        "latency": {name: _percentiles(values) for name, values in sorted(recorder.latencies.items())},
+    }
+    if monitor is not None and monitor.rss:
+        report["controller"] = {
+            "cpu_avg_percent": round(sum(monitor.cpu) / len(monitor.cpu), 1) if monitor.cpu else 0.0,
+            "cpu_max_percent": round(max(monitor.cpu), 1) if monitor.cpu else 0.0,
+            "rss_max_mb": round(max(monitor.rss) / 1024**2, 1),
+            "rss_end_mb": round(monitor.rss[-1] / 1024**2, 1),
+        }
+    return report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(
+        f"agents: {report['agents_registered']}/{report['agents']} registered"
+        f" ({report['agents_failed']} failed), ui clients: {report['ui_clients']}, {report['seconds']}s"
+    )
+    print(
+        f"events/s: {report['agent_events_per_sec']} from agents, {report['ui_events_per_sec']} to UIs"
+        f" ({report['output_lines_per_sec']} output lines/s)"
+    )
+    for name, stats in report["latency"].items():
+        if stats:
+            print(
+                f"{name:>13}: p50 {stats['p50_ms']} ms  p90 {stats['p90_ms']} ms"
+                f"  p99 {stats['p99_ms']} ms  max {stats['max_ms']} ms  (n={stats['n']})"
+            )
+    controller = report.get("controller")
+    if controller:
+        print(
+            f"   controller: cpu avg {controller['cpu_avg_percent']}% max {controller['cpu_max_percent']}%,"
+            f" rss max {controller['rss_max_mb']} MB"
+        )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Simulate many agents and dashboards against a controller and report its limits")
+    parser.add_argument("--url", help="Controller to test; by default a fresh main.py is started on a free port")
+    parser.add_argument("--controller-pid", type=int, help="PID of the controller given with --url, to sample its CPU/RSS")
+    parser.add_argument("--async-mode", choices=["threading", "gevent"], help="PISTAT_ASYNC_MODE for the started controller")
+    parser.add_argument("--cluster-workers", type=int, default=0, help="Start cluster.py with this many workers instead of main.py")
+    parser.add_argument("--agents", type=int, default=100, help="Simulated agents (default 100)")
+    parser.add_argument("--processes", type=int, default=1, help="Processes the agents are split across; 0 runs them in this process (default 1)")
+    parser.add_argument("--ramp", type=float, default=200.0, help="Agents connected per second (default 200)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run once every agent has connected (default 30)")
+    parser.add_argument("--stats-interval", type=float, default=5.0, help="Seconds between each agent's stats reports (default 5)")
+    parser.add_argument("--ui-clients", type=int, default=2, help="Simulated dashboard clients (default 2)")
+    parser.add_argument("--task-interval", type=float, default=2.0, help="Seconds between run_task requests per UI client; 0 disables (default 2)")
+    parser.add_argument("--task-lines", type=int, default=200, help="Output lines per task (default 200)")
+    parser.add_argument("--terminal-interval", type=float, default=5.0, help="Seconds between terminal bursts per UI client; 0 disables (default 5)")
+    parser.add_argument("--terminal-burst", type=int, default=10, help="Terminal commands sent per burst (default 10)")
+    parser.add_argument("--terminal-lines", type=int, default=50, help="Output lines per terminal command (default 50)")
+    parser.add_argument("--line-bytes", type=int, default=80, help="Bytes per output line (default 80)")
+    parser.add_argument("--wire", choices=["auto", "json"], default="auto", help="Agent encoding: auto uses binary frames when the controller offers them (default auto)")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    return parser.parse_args(argv)
+
+
+async def _run_uis(url: str, pi_ids: List[str], options: Dict[str, Any], recorder: Recorder) -> None:
+    # UI clients start once the agents are up and stop with them.
+    await asyncio.sleep(options["ramp_seconds"])
+    deadline = time.monotonic() + options["duration"]
+    await asyncio.gather(*(SimulatedUI(url, pi_ids, options, recorder).run(deadline) for _ in range(options["ui_clients"])))
+
+
+async def _run_local(url: str, pi_ids: List[str], options: Dict[str, Any], recorder: Recorder, with_agents: bool) -> None:
+    jobs = [_run_uis(url, pi_ids, options, recorder)]
+    if with_agents:
+        jobs.append(_run_agents(url, pi_ids, options, recorder))
+    await asyncio.gather(*jobs)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    options = {
+        "duration": max(1.0, args.duration),
+        "stats_interval": max(0.1, args.stats_interval),
+        "ramp": args.ramp,
+        "ramp_seconds": args.agents / args.ramp if args.ramp > 0 else 0.0,
+        "ui_clients": max(0, args.ui_clients),
+        "task_interval": max(0.0, args.task_interval),
+        "task_lines": max(0, args.task_lines),
+        "terminal_interval": max(0.0, args.terminal_interval),
+        "terminal_burst": max(1, args.terminal_burst),
+        "terminal_lines": max(0, args.terminal_lines),
+        "line_bytes": max(20, args.line_bytes),
+        "wire": args.wire,
+    }
+    controller: Optional[subprocess.Popen] = None
+    state: Optional[tempfile.TemporaryDirectory] = None
+    if args.url:
+        url = args.url.rstrip("/")
+        pid = args.controller_pid
+    else:
+        url, controller, state = start_controller(args)
+        pid = controller.pid
+    monitor = ControllerMonitor(pid) if pid else None
+    if monitor is not None:
+        monitor.start()
+
+    pi_ids = [f"loadgen-{index:05d}" for index in range(max(0, args.agents))]
+    recorder = Recorder()
+    results: Any = multiprocessing.Queue()
+    workers: List[multiprocessing.Process] = []
+    if args.processes > 0:
+        for index in range(args.processes):
+            share = pi_ids[index :: args.processes]
+            if share:
+                worker = multiprocessing.Process(target=_agent_process, args=(url, share, options, results), daemon=True)
+                worker.start()
+                workers.append(worker)
+    started = time.monotonic()
+    try:
+        asyncio.run(_run_local(url, pi_ids, options, recorder, with_agents=not workers))
+        for _ in workers:
+            recorder.merge(results.get(timeout=options["duration"] + options["ramp_seconds"] + 120))
+        for worker in workers:
+            worker.join(timeout=5)
+    finally:
+        elapsed = time.monotonic() - started
+        if monitor is not None:
+            monitor.stop()
+        if controller is not None:
+            controller.terminate()
+            try:
+                controller.wait(10)
+            except subprocess.TimeoutExpired:
+                controller.kill()
+        if state is not None:
+            state.cleanup()
+    # Rates cover the measured window, not the ramp-up.
+    report = build_report(recorder, monitor, args, max(1.0, elapsed - options["ramp_seconds"]))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
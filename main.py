@@ -1,23 +1,104 @@
 from __future__ import annotations
 
+import os
+
+# Server concurrency model: "threading" (Werkzeug, one OS thread per connection)
+# or "gevent" (one greenlet per connection, for large fleets). gevent has to
+# patch the standard library before anything else imports it.
+ASYNC_MODE = os.environ.get("PISTAT_ASYNC_MODE", "threading").strip().lower()
+if ASYNC_MODE == "gevent":  # pragma: no cover - optional dependency
+    from gevent import monkey
+
+    monkey.patch_all()
+
+import bisect
+import fnmatch
+import heapq
 import json
+import random
 import subprocess
 import time
 import uuid
+from collections import OrderedDict, deque
 from datetime import datetime
 from pathlib import Path
-from threading import Lock, Thread
-from typing import Any, Dict, List, Optional, Tuple
+from threading import Condition, Lock
+from typing import Any, Callable, Dict, List, MutableMapping, Optional, Tuple
 
 import psutil
-from flask import Flask, render_template, request
-from flask_socketio import SocketIO, disconnect
+from flask import Flask, jsonify, render_template, request
+from flask_socketio import SocketIO, disconnect, join_room
+
+from cluster import ReplicatedMapping, open_bus, serve_worker
+from collectors import ProcessTable
+from instrumentation import SIZE_BUCKETS, Instruments, MeteredJSON
+from metrics_store import MetricsSegmentStore, MetricsStore
+from output_batcher import OutputBatcher
+from sampling_profiler import SamplingProfiler
+from state_store import StateMapping, open_state_backend
+from worker_pool import PoolFull, PoolJob, WorkerPool, popen_group_kwargs
+from wire import WIRE_FEATURE, decode as decode_wire
 
 
 BASE = Path(__file__).resolve().parent
-STATE_DIR = BASE / "state"
+STATE_DIR = Path(os.environ.get("PISTAT_STATE_DIR") or BASE / "state")
 TEMPLATES_DIR = BASE / "templates"
 STATIC_DIR = BASE / "static"
+# Address the controller listens on, and whether `python main.py` runs Flask's
+# debugger and reloader (only possible with the threading server).
+HOST = os.environ.get("PISTAT_HOST", "0.0.0.0")
+PORT = int(os.environ.get("PISTAT_PORT", 8000))
+DEBUG = ASYNC_MODE == "threading" and os.environ.get("PISTAT_DEBUG", "1").strip().lower() not in {"0", "false", "no", "off"}
+# Upper bound on full-fleet stats_snapshot emits per second; changes in between are merged.
+SNAPSHOT_MAX_RATE = max(0.1, float(os.environ.get("PISTAT_SNAPSHOT_RATE", 4.0)))
+# On-disk metrics history: raw samples are averaged per minute after this many hours...
+METRICS_COMPACT_HOURS = float(os.environ.get("PISTAT_METRICS_COMPACT_HOURS", 24))
+# ...and minute averages are deleted after this many days.
+METRICS_RETENTION_DAYS = float(os.environ.get("PISTAT_METRICS_RETENTION_DAYS", 30))
+# Task/terminal output kept per Pi for scrollback:request, in kilobytes.
+SCROLLBACK_KB_PER_PI = max(16, int(os.environ.get("PISTAT_SCROLLBACK_KB", 512)))
+# Label/task changes are written to disk at most this often (milliseconds)...
+STATE_FLUSH_MS = max(10.0, float(os.environ.get("PISTAT_STATE_FLUSH_MS", 250)))
+# ...and fsync'd before the rename unless this is set to 0.
+STATE_FSYNC = os.environ.get("PISTAT_STATE_FSYNC", "1").strip().lower() not in {"0", "false", "no", "off"}
+# Upper bound for how many agents a fleet-wide run_task job drives at once.
+FANOUT_MAX_CONCURRENCY = max(1, int(os.environ.get("PISTAT_FANOUT_CONCURRENCY", 32)))
+# Controller-side task execution: concurrent processes, waiting requests, and the
+# default per-task timeout in seconds (0 disables it).
+TASK_WORKERS = max(1, int(os.environ.get("PISTAT_TASK_WORKERS", 4)))
+TASK_QUEUE = max(0, int(os.environ.get("PISTAT_TASK_QUEUE", 100)))
+TASK_TIMEOUT = max(0.0, float(os.environ.get("PISTAT_TASK_TIMEOUT", 300)))
+# Seconds a stopped task's process group gets between SIGTERM and SIGKILL.
+TASK_KILL_GRACE = max(0.0, float(os.environ.get("PISTAT_KILL_GRACE", 5)))
+# Shortest interval accepted for controller-side recurring tasks, in seconds.
+SCHEDULE_MIN_INTERVAL = max(1.0, float(os.environ.get("PISTAT_SCHEDULE_MIN_INTERVAL", 5)))
+# Seconds between refreshes of the controller's own per-core/top-process view (0: on request only).
+PROCESS_INTERVAL = max(0.0, float(os.environ.get("PISTAT_PROCESS_INTERVAL", 30)))
+# Set by cluster.py in each controller worker: the message queue shared by the
+# workers, this worker's index and how many there are. Worker 0 leads: only it
+# samples the controller's own stats, compacts metrics history and fires schedules.
+CLUSTER_BUS_URL = os.environ.get("PISTAT_CLUSTER_BUS", "").strip()
+WORKER_INDEX = max(0, int(os.environ.get("PISTAT_WORKER_INDEX", 0)))
+CLUSTER_WORKERS = max(1, int(os.environ.get("PISTAT_CLUSTER_WORKERS", 1)))
+IS_LEADER = WORKER_INDEX == 0
+# Agents allowed to be connected at once; further registrations are refused.
+# Defaults are the most agents one vCPU kept under a 0.5 s p99 stats
+# acknowledgement in each ASYNC_MODE (see "Large Fleets" in the README).
+MAX_AGENTS = max(
+    1, int(os.environ.get("PISTAT_MAX_AGENTS", (1000 if ASYNC_MODE == "gevent" else 500) * CLUSTER_WORKERS))
+)
+# "sqlite" (state/state.db) or "json" (state/labels.json + state/tasks.json).
+STATE_BACKEND = os.environ.get("PISTAT_STATE_BACKEND", "sqlite")
+
+# Sample fields the registry stores on their own; other numeric fields an agent's
+# collectors report are kept together as the Pi's latest "telemetry".
+CORE_SAMPLE_FIELDS = {"ts", "pi_id", "active_task", "workers", "cpu_percent", "ram_percent", "ram_used_gb", "ram_total_gb"}
+MAX_TELEMETRY_FIELDS = 32
+# Largest per-core/top-process view kept for a Pi.
+MAX_PROCESS_ROWS = 64
+MAX_CORES = 256
+# Optional /pi protocol extensions advertised to agents in the register acknowledgement.
+CONTROLLER_FEATURES: List[str] = ["stats_batch", "output_batch", "processes", WIRE_FEATURE]
 
 app = Flask(
     __name__,
@@ -26,122 +107,49 @@ app = Flask(
     static_url_path="/static",
 )
 
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
-
-
-class LabelStore:
-    """Minimal JSON-backed storage for Pi labels."""
-
-    def __init__(self, storage_path: Path) -> None:
-        self._path = storage_path
-        self._lock = Lock()
-        self._labels: Dict[str, str] = {}
-        self._path.parent.mkdir(parents=True, exist_ok=True)
-        self._load()
-
-    def _load(self) -> None:
-        if not self._path.exists():
-            self._labels = {}
-            return
-        try:
-            raw = self._path.read_text(encoding="utf-8")
-            self._labels = json.loads(raw) if raw else {}
-            if not isinstance(self._labels, dict):
-                self._labels = {}
-        except (OSError, json.JSONDecodeError):
-            self._labels = {}
-
-    def _save(self) -> None:
-        tmp_path = self._path.with_suffix(".tmp")
-        data = json.dumps(self._labels, indent=2, sort_keys=True)
-        try:
-            tmp_path.write_text(data, encoding="utf-8")
-            tmp_path.replace(self._path)
-        except OSError:
-            # Best-effort persistence; keep in-memory state even if disk write fails.
-            pass
-
-    def get(self, pi_id: str) -> Optional[str]:
-        with self._lock:
-            return self._labels.get(pi_id)
-
-    def set(self, pi_id: str, label: str) -> None:
-        with self._lock:
-            self._labels[pi_id] = label
-            self._save()
-
-    def remove(self, pi_id: str) -> None:
-        with self._lock:
-            if pi_id in self._labels:
-                self._labels.pop(pi_id)
-                self._save()
-
-
-class TaskStore:
-    """JSON-backed storage for operator-assigned task labels."""
+# Handler timings, lock waits and packet sizes, served at /metrics.
+instruments = Instruments()
 
-    def __init__(self, storage_path: Path) -> None:
-        self._path = storage_path
-        self._lock = Lock()
-        self._tasks: Dict[str, str] = {}
-        self._path.parent.mkdir(parents=True, exist_ok=True)
-        self._load()
-
-    def _load(self) -> None:
-        if not self._path.exists():
-            self._tasks = {}
-            return
-        try:
-            raw = self._path.read_text(encoding="utf-8")
-            data = json.loads(raw) if raw else {}
-            if isinstance(data, dict):
-                self._tasks = {str(k): str(v) for k, v in data.items()}
-            else:
-                self._tasks = {}
-        except (OSError, json.JSONDecodeError):
-            self._tasks = {}
-
-    def _save(self) -> None:
-        tmp_path = self._path.with_suffix(".tmp")
-        data = json.dumps(self._tasks, indent=2, sort_keys=True)
-        try:
-            tmp_path.write_text(data, encoding="utf-8")
-            tmp_path.replace(self._path)
-        except OSError:
-            # Persistence is best effort; avoid killing the controller on failure.
-            pass
-
-    def get(self, pi_id: str) -> Optional[str]:
-        with self._lock:
-            return self._tasks.get(pi_id)
-
-    def has(self, pi_id: str) -> bool:
-        with self._lock:
-            return pi_id in self._tasks
-
-    def set(self, pi_id: str, task_label: Optional[str]) -> None:
-        with self._lock:
-            if task_label is None:
-                self._tasks.pop(pi_id, None)
-            else:
-                value = str(task_label).strip()
-                if value:
-                    self._tasks[pi_id] = value
-                else:
-                    self._tasks.pop(pi_id, None)
-            self._save()
+cluster_bus = open_bus(CLUSTER_BUS_URL) if CLUSTER_BUS_URL else None
+# Each client's events are handled in arrival order (async_handlers=False);
+# otherwise output, and binary_wire frames in particular since they take longer
+# to decode, could be relayed after task_finished and be dropped.
+if cluster_bus is None:
+    socketio = SocketIO(
+        app, cors_allowed_origins="*", async_mode=ASYNC_MODE, async_handlers=False, json=MeteredJSON(instruments)
+    )
+else:
+    # Emits for clients connected to other workers travel over the bus. Only
+    # WebSocket is offered: long-polling requests could land on any worker.
+    # Request lookups going to the bus make the ordering above matter even more.
+    socketio = SocketIO(
+        app,
+        cors_allowed_origins="*",
+        async_mode=ASYNC_MODE,
+        client_manager=cluster_bus.socketio_manager(),
+        transports=["websocket"],
+        async_handlers=False,
+        json=MeteredJSON(instruments),
+    )
 
 
+# Optional per-task limits: "timeout" is wall-clock seconds (defaults to
+# PISTAT_TASK_TIMEOUT) and "max_output_bytes" stops the task once it has
+# printed that much. Both apply on the controller and on agents.
 REGISTERED_TASKS: Dict[str, Dict[str, Any]] = {
     "uptime": {
         "label": "System Uptime",
         "description": "Show controller uptime and load averages.",
         "command": ["uptime"],
+        "timeout": 30,
+        "max_output_bytes": 64 * 1024,
     },
     "disk-usage": {
         "label": "Disk Utilization",
         "description": "Summarize disk usage across mounted volumes.",
         "command": ["df", "-h"],
+        "timeout": 60,
+        "max_output_bytes": 256 * 1024,
     },
     "top-processes": {
         "label": "Top Processes",
@@ -151,29 +159,70 @@ REGISTERED_TASKS: Dict[str, Dict[str, Any]] = {
             "-lc",
             "ps -eo pid,comm,%cpu,%mem --sort=-%cpu | head -n 6",
         ],
+        "timeout": 30,
+        "max_output_bytes": 64 * 1024,
     },
 }
 
 
+_MISSING = object()
+
+
 class PiRegistry:
-    """Thread-safe registry of Pi telemetry."""
+    """Thread-safe registry of Pi telemetry.
+
+    Writers lock only the shard that owns the Pi, so reports from different
+    agents are ingested concurrently. Each change is published as a fresh copy of
+    the entry (copy-on-write); readers such as :meth:`snapshot` work from the
+    published copies and never wait for a writer.
+
+    Every change to an entry bumps a registry-wide version counter. The entry and
+    each field it touched are stamped with that version so UI clients can be sent
+    only what changed since the last version they acknowledged.
+
+    Pi ids and case-folded labels are also kept in a lookup index, updated as
+    entries change and guarded by its own lock, so :meth:`resolve_ref` never
+    waits on the stats path.
+
+    ``on_change(pi_id, fields, removed)`` is called with every change, under the
+    Pi's shard lock, so other controller workers can :meth:`apply_changes` it.
+    """
 
     def __init__(
         self,
-        label_store: Optional[LabelStore] = None,
-        task_store: Optional[TaskStore] = None,
+        label_store: Optional[StateMapping] = None,
+        task_store: Optional[StateMapping] = None,
+        shards: int = 16,
+        on_change: Optional[Callable[[str, Dict[str, Any], List[str]], None]] = None,
     ) -> None:
+        # Working entries; each one is only mutated under its shard lock.
         self._entries: Dict[str, Dict[str, Any]] = {}
-        self._lock = Lock()
+        self._shards = [instruments.lock("registry_shard") for _ in range(max(1, shards))]
+        # pi_id -> (entry copy, field versions copy). Published values are never
+        # mutated; new Pis replace the whole mapping so readers can iterate freely.
+        self._published: Dict[str, Tuple[Dict[str, Any], Dict[str, int]]] = {}
+        self._field_versions: Dict[str, Dict[str, int]] = {}
+        self._version = 0
+        # Held only to assign a version and publish, never while doing I/O.
+        self._publish_lock = instruments.lock("registry_publish")
         self._label_store = label_store
         self._task_store = task_store
+        self._on_change = on_change
+        # Lookup index: folded label -> pi ids, pi id -> folded label, folded
+        # pi id -> pi id, and every folded id/label in sorted order for prefixes.
+        self._index_lock = instruments.lock("registry_index")
+        self._by_label: Dict[str, List[str]] = {}
+        self._label_of: Dict[str, str] = {}
+        self._id_keys: Dict[str, str] = {}
+        self._ref_keys: List[str] = []
 
     def upsert(self, pi_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
         now = time.time()
         has_assigned = "assigned_task" in payload
         assigned_value = payload.get("assigned_task") if has_assigned else None
-        with self._lock:
+        with self._lock_for(pi_id):
             entry = self._entries.get(pi_id)
+            before = dict(entry) if entry is not None else {}
             stored_label = self._label_store.get(pi_id) if self._label_store else None
             stored_task = self._task_store.get(pi_id) if self._task_store else None
 
@@ -225,6 +274,12 @@ class PiRegistry:
                         else:
                             entry.pop("assigned_task", None)
 
+            if payload.get("workers") is not None:
+                # Worker pool stats: running/queued counts and queue wait times.
+                entry["workers"] = payload["workers"]
+            if payload.get("telemetry") is not None:
+                # Extra collector readings (load, temperature, I/O rates, collection cost).
+                entry["telemetry"] = payload["telemetry"]
             if stored_label:
                 entry["label"] = stored_label
             if self._task_store and self._task_store.has(pi_id):
@@ -234,19 +289,22 @@ class PiRegistry:
                 else:
                     entry.pop("assigned_task", None)
 
+            self._stamp(pi_id, entry, before)
             return dict(entry)
 
     def set_assigned_task(self, pi_id: str, task_label: Optional[str]) -> Optional[Dict[str, Any]]:
         normalized = self._normalize_task_label(task_label)
-        with self._lock:
+        with self._lock_for(pi_id):
             entry = self._entries.get(pi_id)
             if not entry:
                 return None
+            before = dict(entry)
             if normalized is not None:
                 entry["assigned_task"] = normalized
             else:
                 entry.pop("assigned_task", None)
             entry["last_seen"] = time.time()
+            self._stamp(pi_id, entry, before)
             if self._task_store:
                 self._task_store.set(pi_id, normalized)
             return dict(entry)
@@ -259,133 +317,399 @@ class PiRegistry:
         return text or None
 
     def mark_offline(self, pi_id: str) -> Optional[Dict[str, Any]]:
-        with self._lock:
+        with self._lock_for(pi_id):
             entry = self._entries.get(pi_id)
             if not entry:
                 return None
+            before = dict(entry)
             entry["online"] = False
             entry["active_task"] = "Offline"
             entry["last_seen"] = time.time()
+            self._stamp(pi_id, entry, before)
             return dict(entry)
 
+    def apply_changes(self, pi_id: str, fields: Dict[str, Any], removed: List[str]) -> None:
+        """Merge a change made by another controller worker; ``on_change`` is not called."""
+        with self._lock_for(pi_id):
+            before = self._entries.get(pi_id) or {}
+            entry = {**before, **fields, "pi_id": pi_id}
+            for key in removed:
+                entry.pop(key, None)
+            self._entries[pi_id] = entry
+            self._stamp(pi_id, entry, before, notify=False)
+
+    def _lock_for(self, pi_id: str) -> Lock:
+        return self._shards[hash(pi_id) % len(self._shards)]
+
+    def _stamp(self, pi_id: str, entry: Dict[str, Any], before: Dict[str, Any], notify: bool = True) -> None:
+        """Version the fields of ``entry`` that differ from ``before`` and publish it.
+
+        Called with the Pi's shard lock held.
+        """
+        changed = [
+            key
+            for key in set(entry) | set(before)
+            if key != "version" and entry.get(key, _MISSING) != before.get(key, _MISSING)
+        ]
+        if not changed:
+            return
+        with self._publish_lock:
+            self._version += 1
+            fields = self._field_versions.setdefault(pi_id, {})
+            for key in changed:
+                fields[key] = self._version
+            entry["version"] = self._version
+            published = (dict(entry), dict(fields))
+            if pi_id in self._published:
+                self._published[pi_id] = published
+            else:
+                self._published = {**self._published, pi_id: published}
+        if not before or "label" in changed:
+            self._index(pi_id, str(entry.get("label") or ""), is_new=not before)
+        if notify and self._on_change is not None:
+            self._on_change(
+                pi_id,
+                {key: entry[key] for key in changed if key in entry},
+                [key for key in changed if key not in entry],
+            )
+
+    def _index(self, pi_id: str, label: str, is_new: bool) -> None:
+        folded = label.casefold()
+        with self._index_lock:
+            if is_new:
+                self._id_keys[pi_id.casefold()] = pi_id
+                self._add_ref_key(pi_id.casefold())
+            previous = self._label_of.get(pi_id)
+            if previous == folded:
+                return
+            if previous:
+                owners = self._by_label.get(previous, [])
+                if pi_id in owners:
+                    owners.remove(pi_id)
+                if not owners:
+                    self._by_label.pop(previous, None)
+                    if previous not in self._id_keys:
+                        self._remove_ref_key(previous)
+            self._label_of[pi_id] = folded
+            if folded:
+                owners = self._by_label.setdefault(folded, [])
+                if not owners:
+                    self._add_ref_key(folded)
+                owners.append(pi_id)
+
+    def _add_ref_key(self, key: str) -> None:
+        index = bisect.bisect_left(self._ref_keys, key)
+        if index == len(self._ref_keys) or self._ref_keys[index] != key:
+            self._ref_keys.insert(index, key)
+
+    def _remove_ref_key(self, key: str) -> None:
+        index = bisect.bisect_left(self._ref_keys, key)
+        if index < len(self._ref_keys) and self._ref_keys[index] == key:
+            del self._ref_keys[index]
+
+    def _owners_locked(self, key: str) -> List[str]:
+        owners = list(self._by_label.get(key, []))
+        pi_id = self._id_keys.get(key)
+        if pi_id is not None and pi_id not in owners:
+            owners.append(pi_id)
+        return owners
+
+    def _lookup(self, ref: str) -> Optional[str]:
+        """Map ``ref`` to a pi id using only the lookup index.
+
+        Tries an exact id, then an exact label (case-insensitive), then a unique
+        id or label prefix, and finally a unique label substring.
+        """
+        folded = ref.casefold()
+        with self._index_lock:
+            if ref in self._label_of:
+                return ref
+            owners = self._by_label.get(folded)
+            if owners:
+                return owners[0]
+            matches: List[str] = []
+            index = bisect.bisect_left(self._ref_keys, folded)
+            while index < len(self._ref_keys) and self._ref_keys[index].startswith(folded):
+                for pi_id in self._owners_locked(self._ref_keys[index]):
+                    if pi_id not in matches:
+                        matches.append(pi_id)
+                if len(matches) > 1:
+                    return None
+                index += 1
+            if matches:
+                return matches[0]
+            # Substring matching has no index to lean on; labels are short and
+            # this only runs when nothing matched exactly or by prefix.
+            for label, owners in self._by_label.items():
+                if folded in label:
+                    matches.extend(pi_id for pi_id in owners if pi_id not in matches)
+                    if len(matches) > 1:
+                        return None
+            return matches[0] if matches else None
+
+    def __len__(self) -> int:
+        return len(self._published)
+
+    def _published_view(self) -> Tuple[int, Dict[str, Tuple[Dict[str, Any], Dict[str, int]]]]:
+        # Every change up to the returned version is already in the mapping.
+        with self._publish_lock:
+            return self._version, self._published
+
     def snapshot(self) -> List[Dict[str, Any]]:
-        with self._lock:
-            snapshot: List[Dict[str, Any]] = []
-            for key, item in self._entries.items():
-                clone = dict(item)
-                if self._label_store:
-                    stored_label = self._label_store.get(key)
-                    if stored_label:
-                        clone["label"] = stored_label
-                if self._task_store:
-                    if self._task_store.has(key):
-                        stored_task = self._task_store.get(key)
-                        if stored_task is not None:
-                            clone["assigned_task"] = stored_task
-                        else:
-                            clone.pop("assigned_task", None)
-                    else:
-                        clone.pop("assigned_task", None)
-                snapshot.append(clone)
-            return snapshot
+        return self.versioned_snapshot()[1]
+
+    def versioned_snapshot(self) -> Tuple[int, List[Dict[str, Any]]]:
+        version, published = self._published_view()
+        return version, [dict(entry) for entry, _ in list(published.values())]
+
+    def changes_since(self, version: int) -> Tuple[int, List[Dict[str, Any]]]:
+        """Return the current version and the fields changed after ``version``.
+
+        Fields that were removed from an entry are reported with a ``None`` value.
+        """
+        current, published = self._published_view()
+        changes: List[Dict[str, Any]] = []
+        for key, (item, fields) in list(published.items()):
+            if item.get("version", 0) <= version:
+                continue
+            delta: Dict[str, Any] = {"pi_id": key, "version": item["version"]}
+            for field, field_version in fields.items():
+                if field_version > version:
+                    delta[field] = item.get(field)
+            changes.append(delta)
+        return current, changes
 
     def get(self, pi_id: str) -> Optional[Dict[str, Any]]:
-        with self._lock:
-            entry = self._entries.get(pi_id)
-            if not entry:
-                return None
-            cloned = dict(entry)
-            if self._label_store:
-                stored_label = self._label_store.get(pi_id)
-                if stored_label:
-                    cloned["label"] = stored_label
-            if self._task_store:
-                if self._task_store.has(pi_id):
-                    stored_task = self._task_store.get(pi_id)
-                    if stored_task is not None:
-                        cloned["assigned_task"] = stored_task
-                    else:
-                        cloned.pop("assigned_task", None)
-                else:
-                    cloned.pop("assigned_task", None)
-            return cloned
+        published = self._published.get(pi_id)
+        if published is None:
+            return None
+        return dict(published[0])
 
     def resolve_ref(self, ref: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Resolve a Pi id or label (exact, prefix or substring) to ``(pi_id, entry)``.
+
+        Ambiguous prefixes and substrings resolve to nothing.
+        """
         if not ref:
             return None
+        pi_id = self._lookup(ref)
+        if pi_id is None:
+            return None
+        entry = self.get(pi_id)
+        if entry is None:
+            return None
+        return pi_id, entry
+
+
+class ScrollbackStore:
+    """Bounded per-Pi output history stored as newline-joined UTF-8 chunks.
+
+    Every stored line gets a per-Pi sequence number. Lines are appended to the
+    newest chunk until it reaches ``chunk_bytes`` or the request id changes, so a
+    chunk always holds consecutive lines of one request. Once a Pi exceeds
+    ``max_bytes_per_pi`` its oldest chunks are dropped; at most ``max_pis`` Pis
+    are kept, least recently written first out.
+    """
+
+    def __init__(self, max_bytes_per_pi: int = 512 * 1024, chunk_bytes: int = 32 * 1024, max_pis: int = 1024) -> None:
+        self.max_bytes_per_pi = max(1024, max_bytes_per_pi)
+        self.chunk_bytes = max(256, min(chunk_bytes, self.max_bytes_per_pi))
+        self.max_pis = max(1, max_pis)
+        # pi_id -> {"chunks": deque([request_id, first_seq, line_count, data]), "bytes": int, "next_seq": int}
+        self._pis: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = Lock()
+
+    def append(
+        self,
+        pi_id: str,
+        request_id: Optional[str],
+        lines: List[str],
+        first_seq: Optional[int] = None,
+    ) -> Optional[int]:
+        """Store ``lines`` and return the sequence number of the first one.
+
+        ``first_seq`` moves numbering forward to match the copy this append was
+        replicated from; a worker that missed earlier lines then skips their numbers.
+        """
+        if not lines:
+            return None
         with self._lock:
-            if ref in self._entries:
-                entry = self._entries[ref]
-                label = self._label_store.get(ref) if self._label_store else None
-                cloned = dict(entry)
-                if label:
-                    cloned["label"] = label
-                if self._task_store:
-                    if self._task_store.has(ref):
-                        stored_task = self._task_store.get(ref)
-                        if stored_task is not None:
-                            cloned["assigned_task"] = stored_task
-                        else:
-                            cloned.pop("assigned_task", None)
-                    else:
-                        cloned.pop("assigned_task", None)
-                return ref, cloned
-            lowered = ref.lower()
-            for key, entry in self._entries.items():
-                label_value = entry.get("label") or ""
-                if self._label_store:
-                    stored_label = self._label_store.get(key)
-                    if stored_label:
-                        label_value = stored_label
-                label = str(label_value).lower()
-                if label and label == lowered:
-                    cloned = dict(entry)
-                    if label_value:
-                        cloned["label"] = label_value
-                    if self._task_store:
-                        if self._task_store.has(key):
-                            stored_task = self._task_store.get(key)
-                            if stored_task is not None:
-                                cloned["assigned_task"] = stored_task
-                            else:
-                                cloned.pop("assigned_task", None)
-                        else:
-                            cloned.pop("assigned_task", None)
-                    return key, cloned
-        return None
+            state = self._pis.get(pi_id)
+            if state is None:
+                state = {"chunks": deque(), "bytes": 0, "next_seq": 0}
+                self._pis[pi_id] = state
+                while len(self._pis) > self.max_pis:
+                    self._pis.popitem(last=False)
+            else:
+                self._pis.move_to_end(pi_id)
+            chunks = state["chunks"]
+            if first_seq is not None and first_seq > state["next_seq"]:
+                state["next_seq"] = first_seq
+                if chunks and isinstance(chunks[-1][3], bytearray):
+                    # Seal the open chunk: a chunk's lines must be numbered consecutively.
+                    chunks[-1][3] = bytes(chunks[-1][3])
+            first_seq = state["next_seq"]
+            for line in lines:
+                encoded = str(line).encode("utf-8", "replace")
+                chunk = chunks[-1] if chunks else None
+                if (
+                    chunk is None
+                    or chunk[0] != request_id
+                    or not isinstance(chunk[3], bytearray)
+                    or len(chunk[3]) + len(encoded) + 1 > self.chunk_bytes
+                ):
+                    if chunk is not None and isinstance(chunk[3], bytearray):
+                        chunk[3] = bytes(chunk[3])
+                    chunk = [request_id, state["next_seq"], 0, bytearray()]
+                    chunks.append(chunk)
+                    added = len(encoded)
+                    chunk[3] += encoded
+                else:
+                    added = len(encoded) + 1
+                    chunk[3] += b"\n" + encoded
+                chunk[2] += 1
+                state["bytes"] += added
+                state["next_seq"] += 1
+            while state["bytes"] > self.max_bytes_per_pi and len(chunks) > 1:
+                state["bytes"] -= len(chunks.popleft()[3])
+            return first_seq
+
+    def page(
+        self,
+        pi_id: str,
+        before: Optional[int] = None,
+        limit: int = 200,
+        request_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Return up to ``limit`` lines older than ``before`` (newest page when omitted)."""
+        limit = max(1, min(int(limit), 5000))
+        result: List[Dict[str, Any]] = []
+        remaining = limit
+        more = False
+        with self._lock:
+            state = self._pis.get(pi_id)
+            chunks = list(state["chunks"]) if state else []
+            next_seq = state["next_seq"] if state else 0
+        for chunk_request, first_seq, count, data in reversed(chunks):
+            if request_id is not None and chunk_request != request_id:
+                continue
+            end = first_seq + count if before is None else min(first_seq + count, before)
+            if end <= first_seq:
+                continue
+            if remaining <= 0:
+                more = True
+                break
+            start = max(first_seq, end - remaining)
+            lines = bytes(data).decode("utf-8", "replace").split("\n")[start - first_seq : end - first_seq]
+            result.append({"request_id": chunk_request, "first_seq": start, "lines": lines})
+            remaining -= len(lines)
+            if start > first_seq:
+                more = True
+                break
+        result.reverse()
+        return {"pi_id": pi_id, "chunks": result, "more": more, "next_seq": next_seq}
 
 
 class TaskRunner:
-    """Launch whitelisted commands and stream output over Socket.IO."""
+    """Launch whitelisted commands and stream output over Socket.IO.
 
-    def __init__(self, registry: PiRegistry) -> None:
-        self._registry = registry
-        self._threads: Dict[str, Thread] = {}
-        self._lock = Lock()
+    Commands run on a bounded :class:`WorkerPool`; requests beyond its worker
+    count wait in FIFO order and the requester is sent ``task_queued``.
+    """
 
-    def start_local_task(self, task_id: str, origin_sid: str) -> str:
+    def __init__(
+        self,
+        registry: PiRegistry,
+        max_workers: int = 4,
+        max_queue: int = 100,
+        timeout: float = 300.0,
+        kill_grace: float = 5.0,
+    ) -> None:
+        self._registry = registry
+        self._timeout = timeout
+        self._pool = WorkerPool(max_workers, max_queue, name="local-task", kill_grace=kill_grace, logger=app.logger)
+        # Requests still waiting for a worker: request_id -> (task_id, origin_sid, on_finished).
+        self._waiting: Dict[str, Tuple[str, str, Optional[Callable[[Optional[int]], None]]]] = {}
+        self._waiting_lock = Lock()
+        self._output = OutputBatcher(_emit_to_ui, spawn=socketio.start_background_task, logger=app.logger)
+
+    def start_local_task(
+        self,
+        task_id: str,
+        origin_sid: str,
+        on_finished: Optional[Callable[[Optional[int]], None]] = None,
+    ) -> str:
+        """Queue ``task_id`` for execution; raises :class:`PoolFull` when the queue is full."""
         task = REGISTERED_TASKS.get(task_id)
         if not task:
             raise KeyError(task_id)
         request_id = str(uuid.uuid4())
-        worker = Thread(
-            target=self._execute,
-            args=(request_id, task_id, task, origin_sid),
-            daemon=True,
-        )
-        with self._lock:
-            self._threads[request_id] = worker
-        worker.start()
+        with self._waiting_lock:
+            self._waiting[request_id] = (task_id, origin_sid, on_finished)
+        try:
+            position = self._pool.submit(
+                request_id,
+                lambda job: self._execute(job, request_id, task_id, task, origin_sid, on_finished),
+                timeout=float(task.get("timeout", self._timeout)),
+                max_output_bytes=task.get("max_output_bytes"),
+                on_error=lambda exc: self._output.close(
+                    request_id,
+                    "task_error",
+                    {"request_id": request_id, "task_id": task_id, "pi_id": "local", "error": str(exc), "exit_code": -1},
+                    target=origin_sid,
+                ),
+            )
+        except PoolFull:
+            with self._waiting_lock:
+                self._waiting.pop(request_id, None)
+            raise
+        if position:
+            socketio.emit(
+                "task_queued",
+                {"request_id": request_id, "task_id": task_id, "pi_id": "local", "position": position},
+                room=origin_sid,
+                namespace="/ui",
+            )
         return request_id
 
+    def cancel(self, request_id: str) -> Optional[str]:
+        """Stop ``request_id``; a queued request is reported as cancelled right away."""
+        state = self._pool.cancel(request_id)
+        if state != "queued":
+            return state
+        with self._waiting_lock:
+            waiting = self._waiting.pop(request_id, None)
+        if waiting is None:
+            return state
+        task_id, origin_sid, on_finished = waiting
+        error = {"request_id": request_id, "task_id": task_id, "pi_id": "local", "error": "Cancelled", "exit_code": None}
+        self._output.close(request_id, "task_error", error, target=origin_sid)
+        self._output.close(
+            request_id,
+            "task_finished",
+            {"request_id": request_id, "task_id": task_id, "pi_id": "local", "exit_code": None},
+            target=origin_sid,
+        )
+        if on_finished is not None:
+            on_finished(None)
+        return state
+
+    def pool_stats(self) -> Dict[str, Any]:
+        return self._pool.stats()
+
     def _execute(
         self,
+        job: PoolJob,
         request_id: str,
         task_id: str,
         task: Dict[str, Any],
         origin_sid: str,
+        on_finished: Optional[Callable[[Optional[int]], None]] = None,
     ) -> None:
+        with self._waiting_lock:
+            self._waiting.pop(request_id, None)
         label = task.get("label", task_id)
+        started = time.time()
         self._registry.upsert("local", {"active_task": label, "source": "controller"})
         broadcast_snapshot()
 
@@ -406,21 +730,17 @@ class TaskRunner:
                 stderr=subprocess.STDOUT,
                 text=True,
                 bufsize=1,
+                **popen_group_kwargs(),
             )
+            job.attach(process)
             assert process.stdout is not None
-            for line in process.stdout:
-                socketio.emit(
-                    "task_output",
-                    {
-                        "request_id": request_id,
-                        "task_id": task_id,
-                        "pi_id": "local",
-                        "line": line.rstrip("\n"),
-                    },
-                    room=origin_sid,
-                    namespace="/ui",
-                )
+            base = {"request_id": request_id, "task_id": task_id, "pi_id": "local"}
+            for line in job.read_lines(process):
+                # Keep draining after a stop so the child never blocks on a full pipe.
+                if job.count_output(len(line.encode("utf-8", "replace"))):
+                    self._output.write(request_id, "task_output", base, line.rstrip("\n"), target=origin_sid)
             exit_code = process.wait()
+            error_text = job.stop_message()
         except FileNotFoundError:
             exit_code = -1
             error_text = "Executable not found."
@@ -430,11 +750,20 @@ class TaskRunner:
         finally:
             self._registry.upsert("local", {"active_task": "Idle"})
             broadcast_snapshot()
-            with self._lock:
-                self._threads.pop(request_id, None)
 
+        state_backend.record_task_run(
+            {
+                "request_id": request_id,
+                "pi_id": "local",
+                "task_id": task_id,
+                "exit_code": exit_code,
+                "error": error_text,
+                "started": started,
+            }
+        )
         if error_text:
-            socketio.emit(
+            self._output.close(
+                request_id,
                 "task_error",
                 {
                     "request_id": request_id,
@@ -443,11 +772,11 @@ class TaskRunner:
                     "error": error_text,
                     "exit_code": exit_code,
                 },
-                room=origin_sid,
-                namespace="/ui",
+                target=origin_sid,
             )
 
-        socketio.emit(
+        self._output.close(
+            request_id,
             "task_finished",
             {
                 "request_id": request_id,
@@ -455,24 +784,514 @@ class TaskRunner:
                 "pi_id": "local",
                 "exit_code": exit_code,
             },
-            room=origin_sid,
-            namespace="/ui",
+            target=origin_sid,
         )
+        if on_finished is not None:
+            on_finished(exit_code)
+
+    def output_stats(self) -> Dict[str, int]:
+        return self._output.stats()
+
+
+def _emit_to_ui(event_name: str, payload: Dict[str, Any], target_sid: Optional[str]) -> None:
+    if event_name == "task_output":
+        seq = append_scrollback(payload.get("pi_id") or "local", payload.get("request_id"), payload.get("lines") or [])
+        if seq is not None:
+            payload["seq"] = seq
+    socketio.emit(event_name, payload, room=target_sid, namespace="/ui")
+
+
+class SnapshotScheduler:
+    """Coalesce registry changes into rate-limited stats_snapshot broadcasts."""
+
+    def __init__(self, flush: Callable[[], None], max_rate: float) -> None:
+        self._flush = flush
+        self._interval = 1.0 / max_rate
+        self._dirty = False
+        self._lock = Lock()
+        self._started = False
+
+    def mark_dirty(self) -> None:
+        with self._lock:
+            self._dirty = True
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._run)
+
+    def _take_dirty(self) -> bool:
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = False
+            return dirty
+
+    def _run(self) -> None:
+        while True:
+            socketio.sleep(self._interval)
+            if not self._take_dirty():
+                continue
+            try:
+                self._flush()
+            except Exception:  # pragma: no cover - keep the scheduler alive
+                app.logger.exception("Snapshot flush failed")
+
+
+class FanoutDispatcher:
+    """Run one registered task on many Pis with a bounded number in flight.
+
+    A job keeps at most ``concurrency`` agents busy; each completion dispatches
+    the next pending Pi. Per-Pi output only goes to scrollback. The requesting
+    UI receives throttled ``job_progress`` events and a single ``job_finished``
+    event with every Pi's exit code.
+    """
+
+    def __init__(self, max_concurrency: int, progress_interval: float = 0.25) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self._progress_interval = progress_interval
+        self._lock = Lock()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._requests: Dict[str, str] = {}
+
+    def start(
+        self,
+        task_id: str,
+        task: Dict[str, Any],
+        pi_ids: List[str],
+        origin_sid: str,
+        concurrency: Optional[int] = None,
+        on_finished: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Dict[str, Any]:
+        job_id = str(uuid.uuid4())
+        limit = self.max_concurrency if not concurrency else max(1, min(int(concurrency), self.max_concurrency))
+        job = {
+            "job_id": job_id,
+            "task_id": task_id,
+            "task": task,
+            "origin": origin_sid,
+            "pending": deque(pi_ids),
+            "running": {},
+            "results": {},
+            "total": len(pi_ids),
+            "concurrency": limit,
+            "started": time.time(),
+            "last_progress": 0.0,
+            "on_finished": on_finished,
+            "done": False,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+        self._pump(job)
+        return {"job_id": job_id, "total": job["total"], "concurrency": limit}
+
+    def owns(self, request_id: str) -> bool:
+        with self._lock:
+            return request_id in self._requests
+
+    def complete(self, request_id: str, exit_code: Optional[int], error: Optional[str] = None) -> None:
+        with self._lock:
+            job_id = self._requests.pop(request_id, None)
+            job = self._jobs.get(job_id) if job_id else None
+            if job is None:
+                return
+            pi_id = job["running"].pop(request_id, None)
+            if pi_id is not None:
+                job["results"][pi_id] = {"exit_code": exit_code, "error": error or None}
+        with pi_sessions_lock:
+            online = pi_id is not None and pi_id in pi_sessions
+        # Disconnected Pis are marked offline instead.
+        if online:
+            registry.upsert(pi_id, {"active_task": "Idle"})
+        self._pump(job, changed=online)
+
+    def pi_lost(self, pi_id: str) -> None:
+        with self._lock:
+            lost = [
+                request_id
+                for request_id, job_id in self._requests.items()
+                if self._jobs[job_id]["running"].get(request_id) == pi_id
+            ]
+        for request_id in lost:
+            with remote_lock:
+                remote_requests.pop(request_id, None)
+                remote_meta.pop(request_id, None)
+            self.complete(request_id, None, "Pi disconnected.")
+
+    def _pump(self, job: Dict[str, Any], changed: bool = False) -> None:
+        """Dispatch pending Pis up to the job's concurrency, then send one snapshot if any card changed."""
+        task = job["task"]
+        launches: List[Tuple[str, str, Optional[str]]] = []
+        with self._lock:
+            while job["pending"] and len(job["running"]) < job["concurrency"]:
+                pi_id = job["pending"].popleft()
+                with pi_sessions_lock:
+                    target_sid = pi_sessions.get(pi_id)
+                if not target_sid:
+                    job["results"][pi_id] = {"exit_code": None, "error": "Pi is offline."}
+                    continue
+                request_id = str(uuid.uuid4())
+                job["running"][request_id] = pi_id
+                self._requests[request_id] = job["job_id"]
+                launches.append((pi_id, request_id, target_sid))
+            # The last two agents of a job can complete at once; only one
+            # of their pumps may finish it.
+            finished = not job["pending"] and not job["running"] and not job["done"]
+            if finished:
+                job["done"] = True
+                self._jobs.pop(job["job_id"], None)
+
+        for pi_id, request_id, target_sid in launches:
+            with remote_lock:
+                remote_requests[request_id] = job["origin"]
+                remote_meta[request_id] = {
+                    "task_id": job["task_id"],
+                    "pi_id": pi_id,
+                    "started": time.time(),
+                    "job_id": job["job_id"],
+                }
+            socketio.emit(
+                "execute_task",
+                {
+                    "request_id": request_id,
+                    "task_id": job["task_id"],
+                    "command": task.get("command", []),
+                    "label": task.get("label", job["task_id"]),
+                    "timeout": task.get("timeout"),
+                    "max_output_bytes": task.get("max_output_bytes"),
+                },
+                to=target_sid,
+                namespace="/pi",
+            )
+            registry.upsert(pi_id, {"active_task": task.get("label", job["task_id"])})
+        if launches or changed:
+            broadcast_snapshot()
+
+        if finished:
+            self._emit_finished(job)
+        elif not job["done"]:
+            self._emit_progress(job)
+
+    def _summary(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        results = job["results"]
+        ok = sum(1 for result in results.values() if result["exit_code"] == 0)
+        return {
+            "job_id": job["job_id"],
+            "task_id": job["task_id"],
+            "total": job["total"],
+            "done": len(results),
+            "ok": ok,
+            "failed": len(results) - ok,
+            "running": len(job["running"]),
+        }
 
+    def _emit_progress(self, job: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - job["last_progress"] < self._progress_interval:
+                return
+            job["last_progress"] = now
+            summary = self._summary(job)
+        socketio.emit("job_progress", summary, room=job["origin"], namespace="/ui")
 
-label_store = LabelStore(STATE_DIR / "labels.json")
-task_store = TaskStore(STATE_DIR / "tasks.json")
-registry = PiRegistry(label_store=label_store, task_store=task_store)
+    def _emit_finished(self, job: Dict[str, Any]) -> None:
+        with self._lock:
+            summary = self._summary(job)
+            summary["results"] = dict(job["results"])
+        summary["duration"] = time.time() - job["started"]
+        socketio.emit("job_finished", summary, room=job["origin"], namespace="/ui")
+        socketio.emit(
+            "log",
+            {
+                "level": "info" if not summary["failed"] else "warning",
+                "message": (
+                    f"Task '{job['task_id']}' finished on {summary['ok']}/{summary['total']} Pis"
+                    f" in {summary['duration']:.1f}s."
+                ),
+            },
+            room=job["origin"],
+            namespace="/ui",
+        )
+        if job["on_finished"] is not None:
+            job["on_finished"](summary)
+
+
+def select_fanout_targets(targets: Any) -> List[str]:
+    """Resolve a fan-out target spec to online Pi ids.
+
+    ``targets`` is ``"all"`` or a dict with one of ``all``, ``label`` (a glob
+    matched against labels and ids, case-insensitive), ``assigned_task`` or
+    ``pi_ids`` (ids or labels).
+    """
+    if targets == "all":
+        targets = {"all": True}
+    if not isinstance(targets, dict):
+        raise ValueError("Targets must be 'all' or an object.")
+    entries = [entry for entry in registry.snapshot() if entry.get("pi_id") != "local" and entry.get("online", True)]
+    if targets.get("all"):
+        return [entry["pi_id"] for entry in entries]
+    if targets.get("label"):
+        pattern = str(targets["label"]).casefold()
+        return [
+            entry["pi_id"]
+            for entry in entries
+            if fnmatch.fnmatchcase(str(entry.get("label") or "").casefold(), pattern)
+            or fnmatch.fnmatchcase(entry["pi_id"].casefold(), pattern)
+        ]
+    if targets.get("assigned_task"):
+        wanted = str(targets["assigned_task"]).strip().casefold()
+        return [entry["pi_id"] for entry in entries if str(entry.get("assigned_task") or "").casefold() == wanted]
+    if isinstance(targets.get("pi_ids"), list):
+        selected: List[str] = []
+        for ref in targets["pi_ids"]:
+            resolved = registry.resolve_ref(str(ref))
+            if resolved and resolved[0] != "local" and resolved[0] not in selected:
+                selected.append(resolved[0])
+        return selected
+    raise ValueError("Targets need one of 'all', 'label', 'assigned_task' or 'pi_ids'.")
+
+
+class TaskScheduler:
+    """Run registered tasks on a fixed interval from the controller.
+
+    Schedules wait in a heap ordered by their next run time. Each run is pushed
+    back by a random delay of up to ``jitter`` seconds so schedules sharing an
+    interval do not fire together. A run is skipped while the previous run of
+    the same schedule is still going. Schedules are stored in the state backend,
+    and results go to UI clients that joined the ``schedules`` room.
+
+    In a cluster every worker keeps the schedule list (see :meth:`apply`) but
+    only the leader runs them.
+    """
+
+    ROOM = "schedules"
+
+    def __init__(self, min_interval: float = 5.0) -> None:
+        self.min_interval = min_interval
+        self._cond = Condition()
+        self._heap: List[Tuple[float, str]] = []
+        self._schedules: Dict[str, Dict[str, Any]] = {}
+        self._started = False
+
+    def load(self) -> None:
+        for spec in state_backend.load_schedules():
+            try:
+                self._add(spec)
+            except (KeyError, ValueError, TypeError):
+                app.logger.warning("Ignoring invalid stored schedule %s", spec)
+
+    def add(
+        self,
+        task_id: str,
+        interval: float,
+        jitter: float = 0.0,
+        pi_id: Optional[str] = None,
+        targets: Any = None,
+    ) -> Dict[str, Any]:
+        spec = {
+            "schedule_id": uuid.uuid4().hex[:8],
+            "task_id": task_id,
+            "interval": interval,
+            "jitter": jitter,
+            "pi_id": pi_id if targets is None else None,
+            "targets": targets,
+        }
+        schedule = self._add(spec)
+        state_backend.save_schedule(spec["schedule_id"], spec)
+        cluster_publish("schedules", {"op": "add", "spec": spec})
+        return schedule
+
+    def _add(self, spec: Dict[str, Any]) -> Dict[str, Any]:
+        if spec["task_id"] not in REGISTERED_TASKS:
+            raise KeyError(spec["task_id"])
+        interval = float(spec["interval"])
+        if interval < self.min_interval:
+            raise ValueError(f"Interval must be at least {self.min_interval:g} seconds.")
+        schedule = dict(spec, interval=interval, jitter=max(0.0, float(spec.get("jitter") or 0.0)))
+        schedule.update({"running": False, "runs": 0, "skipped": 0, "last_run": None, "last_result": None})
+        with self._cond:
+            schedule["next_run"] = time.time() + random.uniform(0.0, schedule["jitter"])
+            self._schedules[schedule["schedule_id"]] = schedule
+            heapq.heappush(self._heap, (schedule["next_run"], schedule["schedule_id"]))
+            self._cond.notify()
+        return dict(schedule)
+
+    def cancel(self, schedule_id: str) -> bool:
+        with self._cond:
+            # The heap entry is dropped lazily when it comes due.
+            removed = self._schedules.pop(schedule_id, None) is not None
+        if removed:
+            state_backend.delete_schedule(schedule_id)
+            cluster_publish("schedules", {"op": "cancel", "schedule_id": schedule_id})
+        return removed
+
+    def apply(self, message: Dict[str, Any]) -> None:
+        """Apply a schedule change published by another controller worker."""
+        op = message.get("op")
+        if op == "add":
+            try:
+                self._add(message["spec"])
+            except (KeyError, ValueError, TypeError):
+                app.logger.warning("Ignoring invalid replicated schedule %s", message)
+            return
+        with self._cond:
+            if op == "cancel":
+                self._schedules.pop(message.get("schedule_id"), None)
+            elif op == "state":
+                schedule = self._schedules.get(message.get("schedule_id"))
+                if schedule is not None:
+                    schedule.update(message.get("state") or {})
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._cond:
+            return [dict(schedule) for schedule in self._schedules.values()]
+
+    def start(self) -> None:
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        socketio.start_background_task(self._run)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                now = time.time()
+                while not self._heap or self._heap[0][0] > now:
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                    now = time.time()
+                due_at, schedule_id = heapq.heappop(self._heap)
+                schedule = self._schedules.get(schedule_id)
+                if schedule is None or schedule["next_run"] != due_at:
+                    continue
+                schedule["next_run"] = now + schedule["interval"] + random.uniform(0.0, schedule["jitter"])
+                heapq.heappush(self._heap, (schedule["next_run"], schedule_id))
+                overlapping = schedule["running"]
+                if overlapping:
+                    schedule["skipped"] += 1
+                else:
+                    schedule["running"] = True
+                    schedule["runs"] += 1
+                    schedule["last_run"] = now
+            if overlapping:
+                self._emit(schedule, "skipped", reason="Previous run still in progress.")
+                continue
+            try:
+                self._fire(schedule)
+            except Exception as exc:  # pragma: no cover - keep the scheduler alive
+                app.logger.exception("Scheduled task %s failed to start", schedule_id)
+                self._finished(schedule, {"error": str(exc)})
+
+    def _fire(self, schedule: Dict[str, Any]) -> None:
+        task_id = schedule["task_id"]
+        task = REGISTERED_TASKS[task_id]
+        self._emit(schedule, "started")
+        if schedule["targets"] is None and (schedule["pi_id"] or "local") == "local":
+            task_runner.start_local_task(
+                task_id,
+                self.ROOM,
+                on_finished=lambda exit_code: self._finished(schedule, {"exit_code": exit_code}),
+            )
+            return
+        pi_ids = [schedule["pi_id"]] if schedule["targets"] is None else select_fanout_targets(schedule["targets"])
+        if not pi_ids:
+            self._finished(schedule, {"error": "No online Pis match the targets."})
+            return
+        fanout.start(task_id, task, pi_ids, self.ROOM, on_finished=lambda summary: self._finished(schedule, summary))
+
+    def _finished(self, schedule: Dict[str, Any], result: Dict[str, Any]) -> None:
+        with self._cond:
+            schedule["running"] = False
+            schedule["last_result"] = result
+        self._emit(schedule, "finished", result=result)
+
+    def _emit(self, schedule: Dict[str, Any], status: str, **extra: Any) -> None:
+        payload = {"schedule_id": schedule["schedule_id"], "task_id": schedule["task_id"], "status": status}
+        payload.update(extra)
+        socketio.emit("schedule_run", payload, room=self.ROOM, namespace="/ui")
+        with self._cond:
+            state = {key: schedule[key] for key in ("running", "runs", "skipped", "last_run", "last_result", "next_run")}
+        cluster_publish("schedules", {"op": "state", "schedule_id": schedule["schedule_id"], "state": state})
+
+
+def cluster_publish(channel: str, message: Dict[str, Any]) -> None:
+    """Tell the other controller workers about a change; a no-op outside cluster mode."""
+    if cluster_bus is not None:
+        cluster_bus.publish(channel, message)
+
+
+def _shared_table(name: str) -> MutableMapping[str, Any]:
+    """A plain dict, or the table every cluster worker sees when clustered."""
+    return cluster_bus.table(name) if cluster_bus is not None else {}
+
+
+def _publish_registry_change(pi_id: str, fields: Dict[str, Any], removed: List[str]) -> None:
+    cluster_publish("registry", {"op": "change", "pi_id": pi_id, "fields": fields, "removed": removed})
+
+
+if cluster_bus is not None and STATE_BACKEND.strip().lower() != "sqlite":
+    raise SystemExit("Cluster mode shares state through SQLite; unset PISTAT_STATE_BACKEND.")
+state_backend = open_state_backend(STATE_BACKEND, STATE_DIR, STATE_FLUSH_MS / 1000.0, STATE_FSYNC)
+label_store: StateMapping = state_backend.labels
+task_store: StateMapping = state_backend.tasks
+if cluster_bus is not None:
+    label_store = ReplicatedMapping(label_store, cluster_bus, "labels")
+    task_store = ReplicatedMapping(task_store, cluster_bus, "tasks")
+registry = PiRegistry(
+    label_store=label_store,
+    task_store=task_store,
+    on_change=_publish_registry_change if cluster_bus is not None else None,
+)
 registry.upsert("local", {"label": "Controller", "active_task": "Idle", "source": "controller"})
-task_runner = TaskRunner(registry)
-pi_sessions: Dict[str, str] = {}
-pi_sessions_lock = Lock()
-remote_requests: Dict[str, str] = {}
-remote_meta: Dict[str, Dict[str, Any]] = {}
-remote_lock = Lock()
-terminal_requests: Dict[str, str] = {}
-terminal_meta: Dict[str, Dict[str, Any]] = {}
-terminal_lock = Lock()
+scrollback = ScrollbackStore(max_bytes_per_pi=SCROLLBACK_KB_PER_PI * 1024)
+task_runner = TaskRunner(registry, TASK_WORKERS, TASK_QUEUE, TASK_TIMEOUT, TASK_KILL_GRACE)
+fanout = FanoutDispatcher(FANOUT_MAX_CONCURRENCY)
+scheduler = TaskScheduler(SCHEDULE_MIN_INTERVAL)
+metrics_store = MetricsStore()
+metrics_segments = MetricsSegmentStore(
+    STATE_DIR / "metrics",
+    compact_after=METRICS_COMPACT_HOURS * 3600,
+    retention=METRICS_RETENTION_DAYS * 24 * 3600,
+)
+# Agent sessions and in-flight requests are routed by whichever worker the
+# agent or UI happens to be connected to, so in a cluster they live on the bus.
+pi_sessions: MutableMapping[str, str] = _shared_table("pi_sessions")
+pi_sessions_lock = instruments.lock("pi_sessions")
+# sid -> pi_id for agents connected to this process, and pi_id -> the index of
+# the worker each agent is connected to.
+local_agents: Dict[str, str] = {}
+agent_workers: MutableMapping[str, int] = _shared_table("agent_workers")
+remote_requests: MutableMapping[str, str] = _shared_table("remote_requests")
+remote_meta: MutableMapping[str, Dict[str, Any]] = _shared_table("remote_meta")
+remote_lock = instruments.lock("remote")
+terminal_requests: MutableMapping[str, str] = _shared_table("terminal_requests")
+terminal_meta: MutableMapping[str, Dict[str, Any]] = _shared_table("terminal_meta")
+terminal_lock = instruments.lock("terminal")
+# request id -> UI sid for profiler commands relayed to agents.
+profile_requests: MutableMapping[str, str] = _shared_table("profile_requests")
+# Started and stopped with `profile start local` in the dashboard terminal.
+profiler = SamplingProfiler()
+# pi id -> latest per-core/top-process view an agent sent, and request id -> UI
+# sid for views the dashboard asked an agent to refresh.
+process_views: MutableMapping[str, Dict[str, Any]] = _shared_table("process_views")
+process_requests: MutableMapping[str, str] = _shared_table("process_requests")
+# The controller's own view, refreshed by local_stats_loop and on request.
+process_table = ProcessTable()
+ui_versions: Dict[str, int] = {}
+ui_versions_lock = instruments.lock("ui_versions")
+for _name, _table in (
+    ("pi_sessions", pi_sessions),
+    ("local_agents", local_agents),
+    ("remote_requests", remote_requests),
+    ("terminal_requests", terminal_requests),
+    ("profile_requests", profile_requests),
+    ("process_requests", process_requests),
+    ("ui_clients", ui_versions),
+):
+    instruments.gauge(
+        "pistat_inflight", "Entries in the controller's session and in-flight request maps.", _table.__len__, map=_name
+    )
 
 
 def safe_command_preview(command: List[str]) -> str:
@@ -493,12 +1312,56 @@ def serialize_task_catalog() -> List[Dict[str, Any]]:
     return catalog
 
 
+@instruments.timed("stats_resync")
+def send_stats_resync(target_sid: str) -> None:
+    """Send the full fleet to one UI client and reset its acknowledged version."""
+    version, entries = registry.versioned_snapshot()
+    payload = {
+        "full": True,
+        "version": version,
+        "entries": [entry for entry in entries if entry.get("pi_id") != "local"],
+    }
+    with ui_versions_lock:
+        ui_versions[target_sid] = version
+    # UI clients in ui_versions are connected to this process; skip the cluster bus.
+    socketio.emit("stats_delta", payload, room=target_sid, namespace="/ui", ignore_queue=True)
+
+
+@instruments.timed("broadcast_snapshot")
+def _emit_stats_deltas() -> None:
+    """Send each UI client the fields changed since its last acknowledged version."""
+    with ui_versions_lock:
+        clients = dict(ui_versions)
+    by_version: Dict[int, List[str]] = {}
+    for sid, acked in clients.items():
+        by_version.setdefault(acked, []).append(sid)
+    fleet_size: Optional[int] = None
+    for acked, sids in by_version.items():
+        version, changes = registry.changes_since(acked)
+        changes = [item for item in changes if item.get("pi_id") != "local"]
+        if not changes:
+            continue
+        if fleet_size is None:
+            fleet_size = len(registry) - 1  # the controller's own "local" entry is never sent
+        if len(changes) >= fleet_size:
+            # The client is behind on every entry; a full resync costs no more.
+            for sid in sids:
+                send_stats_resync(sid)
+            continue
+        payload = {"full": False, "base": acked, "version": version, "entries": changes}
+        for sid in sids:
+            socketio.emit("stats_delta", payload, room=sid, namespace="/ui", ignore_queue=True)
+
+
+snapshot_scheduler = SnapshotScheduler(_emit_stats_deltas, SNAPSHOT_MAX_RATE)
+
+
 def broadcast_snapshot(target_sid: Optional[str] = None) -> None:
-    payload = [entry for entry in registry.snapshot() if entry.get("pi_id") != "local"]
+    """Resync one UI client now, or schedule a coalesced delta broadcast."""
     if target_sid:
-        socketio.emit("stats_snapshot", payload, room=target_sid, namespace="/ui")
+        send_stats_resync(target_sid)
     else:
-        socketio.emit("stats_snapshot", payload, namespace="/ui")
+        snapshot_scheduler.mark_dirty()
 
 
 def emit_pi_console(pi_id: str, message: str, *, level: str = "INFO", event: Optional[str] = None) -> None:
@@ -512,6 +1375,36 @@ def emit_pi_console(pi_id: str, message: str, *, level: str = "INFO", event: Opt
     socketio.emit("pi_console", payload, namespace="/ui")
 
 
+def append_scrollback(pi_id: str, request_id: Optional[str], lines: List[str]) -> Optional[int]:
+    """Keep ``lines`` in the Pi's scrollback, on every worker when clustered."""
+    seq = scrollback.append(pi_id, request_id, lines)
+    if seq is not None:
+        cluster_publish("scrollback", {"pi_id": pi_id, "request_id": request_id, "lines": lines, "seq": seq})
+    return seq
+
+
+def _forward_output(payload: Dict[str, Any], forward: Dict[str, Any]) -> None:
+    """Copy single-line or batched output (plus drop accounting) into ``forward``.
+
+    The lines are also kept in the Pi's scrollback; ``seq`` is the scrollback
+    sequence number of the first line so clients can stitch history and live output.
+    """
+    lines = payload.get("lines")
+    if isinstance(lines, list):
+        forward["lines"] = [str(line) for line in lines]
+        stored = forward["lines"]
+    else:
+        forward["line"] = payload.get("line", "")
+        stored = [forward["line"]] if forward["line"] else []
+    for key in ("dropped", "truncated"):
+        if payload.get(key):
+            forward[key] = payload[key]
+    seq = append_scrollback(forward["pi_id"], forward["request_id"], stored)
+    if seq is not None:
+        forward["seq"] = seq
+
+
+@instruments.timed()
 def relay_terminal_to_ui(event_name: str, payload: Dict[str, Any]) -> None:
     request_id = payload.get("request_id")
     if not request_id:
@@ -532,12 +1425,16 @@ def relay_terminal_to_ui(event_name: str, payload: Dict[str, Any]) -> None:
     if event_name == "terminal_started":
         forward["command"] = payload.get("command")
     if event_name == "terminal_output":
-        forward["line"] = payload.get("line", "")
+        _forward_output(payload, forward)
+    if event_name == "terminal_queued":
+        forward["position"] = payload.get("position")
     if event_name == "terminal_finished":
         forward["exit_code"] = payload.get("exit_code")
     if event_name == "terminal_error":
         forward["error"] = payload.get("error", "")
         forward["exit_code"] = payload.get("exit_code")
+    if event_name in {"terminal_finished", "terminal_error"} and payload.get("dropped"):
+        forward["dropped"] = payload["dropped"]
 
     socketio.emit(event_name, forward, room=origin_sid, namespace="/ui")
 
@@ -557,17 +1454,144 @@ def collect_local_stats() -> Dict[str, Any]:
         "ram_total_gb": total_gb,
         "active_task": entry.get("active_task", "Idle"),
         "source": "controller",
+        "workers": task_runner.pool_stats(),
+    }
+
+
+def sample_telemetry(sample: Dict[str, Any]) -> Optional[Dict[str, float]]:
+    telemetry: Dict[str, float] = {}
+    for key, value in sample.items():
+        if key in CORE_SAMPLE_FIELDS or isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        telemetry[key] = value
+        if len(telemetry) >= MAX_TELEMETRY_FIELDS:
+            break
+    return telemetry or None
+
+
+# Binary frames arrive as Socket.IO attachments, which MeteredJSON never sees.
+wire_frame_bytes = {
+    event: instruments.histogram(
+        "pistat_wire_frame_bytes", "Size of binary_wire frames received from agents.", SIZE_BUCKETS, event=event
+    )
+    for event in ("stats_batch", "task_output", "terminal_output")
+}
+wire_errors = instruments.counter("pistat_wire_errors_total", "binary_wire frames that failed to decode.")
+
+
+def agent_payload(event: str, payload: Any) -> Any:
+    """Decode a binary_wire frame from an agent; JSON payloads are returned unchanged."""
+    if not isinstance(payload, (bytes, bytearray)):
+        return payload
+    wire_frame_bytes[event].observe(len(payload))
+    try:
+        decoded = decode_wire(payload)
+    except ValueError as exc:
+        wire_errors.inc()
+        app.logger.warning("Dropping undecodable %s frame from %s: %s", event, request.sid, exc)
+        return None
+    # Frames leave pi_id out: it is the id this agent registered with.
+    decoded["pi_id"] = local_agents.get(request.sid)
+    return decoded
+
+
+def process_view(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The per-core/top-process fields of an agent's processes_report, bounded in size."""
+    cores = payload.get("cores")
+    columns = payload.get("columns")
+    rows = payload.get("processes")
+    if not isinstance(cores, list) or not isinstance(columns, list) or not isinstance(rows, list):
+        return None
+    width = len(columns)
+    return {
+        "ts": payload.get("ts"),
+        "received": time.time(),
+        "cores": [value for value in cores[:MAX_CORES] if isinstance(value, (int, float))],
+        "columns": [str(column) for column in columns],
+        "processes": [row[:width] for row in rows[:MAX_PROCESS_ROWS] if isinstance(row, list)],
+        "process_count": payload.get("process_count"),
+        "collect_cpu_ms": payload.get("collect_cpu_ms"),
     }
 
 
+def record_metrics(pi_id: str, sample: Dict[str, Any]) -> None:
+    timestamp = time.time()
+    metrics_store.record(pi_id, sample, timestamp)
+    # Cluster workers all keep the in-memory history; only the leader writes segments.
+    if IS_LEADER:
+        metrics_segments.append(pi_id, sample, timestamp)
+    cluster_publish("metrics", {"pi_id": pi_id, "samples": [[timestamp, sample]]})
+
+
+def record_metric_samples(pi_id: str, samples: List[Tuple[float, Dict[str, Any]]]) -> None:
+    metrics_store.record_many(pi_id, samples)
+    if IS_LEADER:
+        metrics_segments.append_many(pi_id, samples)
+    cluster_publish("metrics", {"pi_id": pi_id, "samples": samples})
+
+
+def backfill_metrics(hours: float = 24.0) -> None:
+    """Replay recent on-disk history into the in-memory rings after a restart."""
+    for timestamp, pi_id, values in metrics_segments.read(time.time() - hours * 3600):
+        metrics_store.record(pi_id, values, timestamp)
+
+
+def metrics_maintenance_loop() -> None:
+    while True:
+        socketio.sleep(5)
+        metrics_segments.maintain()
+
+
 def local_stats_loop() -> None:
+    next_processes = time.monotonic() + PROCESS_INTERVAL
     while True:
         stats = collect_local_stats()
         registry.upsert("local", stats)
+        record_metrics("local", stats)
         broadcast_snapshot()
+        if PROCESS_INTERVAL and time.monotonic() >= next_processes:
+            next_processes = time.monotonic() + PROCESS_INTERVAL
+            process_views["local"] = dict(process_table.snapshot(), received=time.time())
         socketio.sleep(5)
 
 
+def _relay_job_event(
+    event_name: str,
+    payload: Dict[str, Any],
+    request_id: str,
+    task_id: Optional[str],
+    pi_id: str,
+    meta: Dict[str, Any],
+) -> None:
+    """Handle output of a fan-out job member: keep it in scrollback, report completion."""
+    if event_name == "task_output":
+        lines = payload.get("lines")
+        if not isinstance(lines, list):
+            lines = [payload.get("line", "")]
+        append_scrollback(pi_id, request_id, [str(line) for line in lines])
+        return
+    if event_name not in {"task_finished", "task_error"}:
+        return
+    error = payload.get("error") if event_name == "task_error" else None
+    state_backend.record_task_run(
+        {
+            "request_id": request_id,
+            "pi_id": pi_id,
+            "task_id": task_id,
+            "exit_code": payload.get("exit_code"),
+            "error": error,
+            "started": meta.get("started"),
+        }
+    )
+    # The job may belong to another worker; each one ignores requests it does not own.
+    cluster_publish(
+        "fanout",
+        {"op": "complete", "request_id": request_id, "exit_code": payload.get("exit_code"), "error": error},
+    )
+    fanout.complete(request_id, payload.get("exit_code"), error)
+
+
+@instruments.timed()
 def relay_to_ui(event_name: str, payload: Dict[str, Any]) -> None:
     request_id = payload.get("request_id")
     if not request_id:
@@ -583,18 +1607,36 @@ def relay_to_ui(event_name: str, payload: Dict[str, Any]) -> None:
 
     task_id = payload.get("task_id") or meta.get("task_id")
     pi_id = payload.get("pi_id") or meta.get("pi_id") or "unknown"
+    if meta.get("job_id"):
+        _relay_job_event(event_name, payload, request_id, task_id, pi_id, meta)
+        return
     forward: Dict[str, Any] = {
         "request_id": request_id,
         "task_id": task_id,
         "pi_id": pi_id,
     }
     if event_name == "task_output":
-        forward["line"] = payload.get("line", "")
+        _forward_output(payload, forward)
+    if event_name == "task_queued":
+        forward["position"] = payload.get("position")
     if event_name == "task_finished":
         forward["exit_code"] = payload.get("exit_code")
     if event_name == "task_error":
         forward["error"] = payload.get("error", "")
         forward["exit_code"] = payload.get("exit_code")
+    if event_name in {"task_finished", "task_error"}:
+        if payload.get("dropped"):
+            forward["dropped"] = payload["dropped"]
+        state_backend.record_task_run(
+            {
+                "request_id": request_id,
+                "pi_id": pi_id,
+                "task_id": task_id,
+                "exit_code": forward.get("exit_code"),
+                "error": forward.get("error"),
+                "started": meta.get("started"),
+            }
+        )
 
     socketio.emit(event_name, forward, room=origin_sid, namespace="/ui")
 
@@ -605,10 +1647,59 @@ def relay_to_ui(event_name: str, payload: Dict[str, Any]) -> None:
 
 @app.route("/")
 def index() -> str:
-    return render_template("index.html")
+    return render_template("index.html", websocket_only=cluster_bus is not None)
+
+
+@app.route("/api/metrics")
+def api_metrics() -> Any:
+    pi_id = request.args.get("pi", "").strip()
+    metric = request.args.get("metric", "cpu_percent").strip()
+    if not pi_id:
+        return jsonify({"error": "Query parameter 'pi' is required."}), 400
+    try:
+        start = float(request.args.get("from", -3600))
+        end = request.args.get("to", type=float)
+        step = request.args.get("step", type=int)
+    except ValueError:
+        return jsonify({"error": "'from' must be a number."}), 400
+    if start < 0:
+        # Negative values are relative to now, e.g. from=-3600 is the last hour.
+        start += time.time()
+    result = None
+    if request.args.get("source") != "disk":
+        result = metrics_store.query(pi_id, metric, start, end, step)
+    if result is None:
+        result = metrics_segments.query(pi_id, metric, start, end, step)
+    if result is None:
+        return jsonify({"error": f"No '{metric}' history for '{pi_id}'."}), 404
+    return jsonify(result)
+
+
+@app.route("/api/task-runs")
+def api_task_runs() -> Any:
+    since = request.args.get("from", type=float)
+    until = request.args.get("to", type=float)
+    limit = max(1, min(1000, request.args.get("limit", 100, type=int)))
+    if since is not None and since < 0:
+        since += time.time()
+    pi_id = request.args.get("pi", "").strip() or None
+    return jsonify({"runs": state_backend.task_runs(pi_id, since, until, limit)})
+
+
+@app.route("/api/inventory")
+def api_inventory() -> Any:
+    pi_id = request.args.get("pi", "").strip() or None
+    return jsonify({"agents": state_backend.inventory(pi_id)})
+
+
+@app.route("/metrics")
+def prometheus_metrics() -> Any:
+    # In a cluster each scrape reaches whichever worker accepts the connection.
+    return instruments.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 
 @socketio.on("connect", namespace="/ui")
+@instruments.timed()
 def ui_connect() -> None:  # pragma: no cover - event hook
     emit_payload = {
         "level": "info",
@@ -619,12 +1710,198 @@ def ui_connect() -> None:  # pragma: no cover - event hook
     broadcast_snapshot(request.sid)
 
 
+@socketio.on("disconnect", namespace="/ui")
+@instruments.timed()
+def ui_disconnect() -> None:  # pragma: no cover - event hook
+    with ui_versions_lock:
+        ui_versions.pop(request.sid, None)
+
+
+@socketio.on("stats_ack", namespace="/ui")
+@instruments.timed()
+def ui_stats_ack(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
+    if not isinstance(payload, dict):
+        return
+    try:
+        version = int(payload.get("version"))
+    except (TypeError, ValueError):
+        return
+    with ui_versions_lock:
+        if request.sid in ui_versions and version > ui_versions[request.sid]:
+            ui_versions[request.sid] = version
+
+
+@socketio.on("stats_resync", namespace="/ui")
+@instruments.timed()
+def ui_stats_resync() -> None:  # pragma: no cover - event hook
+    send_stats_resync(request.sid)
+
+
 @socketio.on("catalog:request", namespace="/ui")
+@instruments.timed()
 def ui_catalog_request() -> None:  # pragma: no cover - event hook
     socketio.emit("task_catalog", serialize_task_catalog(), room=request.sid, namespace="/ui")
 
 
+@socketio.on("diagnostics", namespace="/ui")
+@instruments.timed()
+def ui_diagnostics() -> Dict[str, Any]:  # pragma: no cover - event hook
+    return {"worker": WORKER_INDEX, "metrics": instruments.snapshot()}
+
+
+@socketio.on("profile", namespace="/ui")
+@instruments.timed()
+def ui_profile(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
+    if not isinstance(payload, dict):
+        return {"error": "Invalid payload."}
+    action = str(payload.get("action") or "").strip().lower()
+    if action not in {"start", "stop", "status"}:
+        return {"error": "Action must be start, stop or status."}
+    target = str(payload.get("target") or "local").strip()
+    if target == "local":
+        # In a cluster this is the worker the dashboard is connected to.
+        return dict(profiler.command(action, payload.get("hz")), pi_id="local", action=action, worker=WORKER_INDEX)
+
+    resolved = registry.resolve_ref(target)
+    if not resolved:
+        return {"error": f"Machine '{target}' is not registered."}
+    pi_id = resolved[0]
+    with pi_sessions_lock:
+        target_sid = pi_sessions.get(pi_id)
+    if not target_sid:
+        return {"error": f"Pi '{pi_id}' is offline."}
+    request_id = str(uuid.uuid4())
+    profile_requests[request_id] = request.sid
+    socketio.emit(
+        "profile",
+        {"request_id": request_id, "action": action, "hz": payload.get("hz")},
+        to=target_sid,
+        namespace="/pi",
+    )
+    return {
+        "status": "forwarded",
+        "request_id": request_id,
+        "pi_id": pi_id,
+        "message": f"Profiler {action} sent to {pi_id}.",
+    }
+
+
+@socketio.on("processes", namespace="/ui")
+@instruments.timed()
+def ui_processes(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
+    if not isinstance(payload, dict):
+        return {"error": "Invalid payload."}
+    target = str(payload.get("target") or "local").strip()
+    if target == "local":
+        view = process_views.get("local")
+        if view is None or payload.get("refresh"):
+            view = dict(process_table.snapshot(), received=time.time())
+        return dict(view, pi_id="local")
+
+    resolved = registry.resolve_ref(target)
+    if not resolved:
+        return {"error": f"Machine '{target}' is not registered."}
+    pi_id = resolved[0]
+    # Agents send a fresh view every --process-interval seconds, so this is
+    # normally answered without a round trip.
+    view = process_views.get(pi_id)
+    if view is not None and not payload.get("refresh"):
+        return dict(view, pi_id=pi_id)
+    with pi_sessions_lock:
+        target_sid = pi_sessions.get(pi_id)
+    if not target_sid:
+        if view is not None:
+            return dict(view, pi_id=pi_id)
+        return {"error": f"Pi '{pi_id}' is offline."}
+    request_id = str(uuid.uuid4())
+    process_requests[request_id] = request.sid
+    socketio.emit("processes", {"request_id": request_id}, to=target_sid, namespace="/pi")
+    return {
+        "status": "forwarded",
+        "request_id": request_id,
+        "pi_id": pi_id,
+        "message": f"Asked {pi_id} for its processes.",
+    }
+
+
+@socketio.on("scrollback:request", namespace="/ui")
+@instruments.timed()
+def ui_scrollback_request(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
+    if not isinstance(payload, dict):
+        return {"error": "Invalid payload."}
+    pi_id = str(payload.get("pi_id") or "").strip()
+    if not pi_id:
+        return {"error": "Pi id required."}
+    try:
+        before = int(payload["before"]) if payload.get("before") is not None else None
+        limit = int(payload.get("limit") or 200)
+    except (TypeError, ValueError):
+        return {"error": "'before' and 'limit' must be integers."}
+    request_id = payload.get("request_id") or None
+    return scrollback.page(pi_id, before=before, limit=limit, request_id=request_id)
+
+
+@socketio.on("schedule:subscribe", namespace="/ui")
+@instruments.timed()
+def ui_schedule_subscribe() -> Dict[str, Any]:  # pragma: no cover - event hook
+    join_room(TaskScheduler.ROOM)
+    return {"status": "ok", "schedules": scheduler.list()}
+
+
+@socketio.on("schedule:list", namespace="/ui")
+@instruments.timed()
+def ui_schedule_list() -> Dict[str, Any]:  # pragma: no cover - event hook
+    return {"status": "ok", "schedules": scheduler.list()}
+
+
+@socketio.on("schedule:create", namespace="/ui")
+@instruments.timed()
+def ui_schedule_create(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
+    if not isinstance(payload, dict):
+        return {"error": "Invalid payload."}
+    task_id = str(payload.get("task") or "").strip()
+    if task_id not in REGISTERED_TASKS:
+        return {"error": f"Task '{task_id}' not recognised."}
+    try:
+        interval = float(payload.get("interval"))
+        jitter = float(payload.get("jitter") or 0.0)
+    except (TypeError, ValueError):
+        return {"error": "'interval' and 'jitter' must be numbers of seconds."}
+    targets = payload.get("targets")
+    pi_id = str(payload.get("pi_id") or "local").strip()
+    if targets is not None:
+        try:
+            select_fanout_targets(targets)
+        except ValueError as exc:
+            return {"error": str(exc)}
+    elif pi_id != "local":
+        resolved = registry.resolve_ref(pi_id)
+        if not resolved:
+            return {"error": f"Machine '{pi_id}' is not registered."}
+        pi_id = resolved[0]
+    try:
+        schedule = scheduler.add(task_id, interval, jitter, pi_id=pi_id, targets=targets)
+    except ValueError as exc:
+        return {"error": str(exc)}
+    join_room(TaskScheduler.ROOM)
+    return {
+        "status": "ok",
+        "schedule": schedule,
+        "message": f"Scheduled '{task_id}' every {interval:g}s as #{schedule['schedule_id']}.",
+    }
+
+
+@socketio.on("schedule:cancel", namespace="/ui")
+@instruments.timed()
+def ui_schedule_cancel(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
+    schedule_id = str((payload or {}).get("schedule_id") or "").strip().lstrip("#")
+    if not scheduler.cancel(schedule_id):
+        return {"error": f"Schedule '{schedule_id}' not found."}
+    return {"status": "ok", "message": f"Schedule #{schedule_id} cancelled."}
+
+
 @socketio.on("run_task", namespace="/ui")
+@instruments.timed()
 def ui_run_task(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
     if not isinstance(payload, dict):
         return {"error": "Invalid payload."}
@@ -636,11 +1913,34 @@ def ui_run_task(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover
     if not task:
         return {"error": f"Task '{task_id}' not recognised."}
 
+    if payload.get("targets") is not None:
+        try:
+            pi_ids = select_fanout_targets(payload["targets"])
+        except ValueError as exc:
+            return {"error": str(exc)}
+        if not pi_ids:
+            return {"error": "No online Pis match those targets."}
+        try:
+            concurrency = int(payload["concurrency"]) if payload.get("concurrency") else None
+        except (TypeError, ValueError):
+            return {"error": "'concurrency' must be an integer."}
+        job = fanout.start(task_id, task, pi_ids, request.sid, concurrency)
+        return {
+            "status": "dispatching",
+            **job,
+            "message": (
+                f"Task '{task_id}' dispatching to {job['total']} Pis, "
+                f"{min(job['total'], job['concurrency'])} at a time."
+            ),
+        }
+
     if pi_id == "local":
         try:
             request_id = task_runner.start_local_task(task_id, request.sid)
         except KeyError:
             return {"error": f"Task '{task_id}' not registered."}
+        except PoolFull:
+            return {"error": "Controller task queue is full; try again shortly."}
         socketio.emit(
             "log",
             {
@@ -664,7 +1964,7 @@ def ui_run_task(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover
     request_id = str(uuid.uuid4())
     with remote_lock:
         remote_requests[request_id] = request.sid
-        remote_meta[request_id] = {"task_id": task_id, "pi_id": pi_id}
+        remote_meta[request_id] = {"task_id": task_id, "pi_id": pi_id, "started": time.time()}
 
     socketio.emit(
         "execute_task",
@@ -673,6 +1973,8 @@ def ui_run_task(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover
             "task_id": task_id,
             "command": task.get("command", []),
             "label": task.get("label", task_id),
+            "timeout": task.get("timeout"),
+            "max_output_bytes": task.get("max_output_bytes"),
         },
         to=target_sid,
         namespace="/pi",
@@ -697,6 +1999,7 @@ def ui_run_task(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover
 
 
 @socketio.on("terminal_command", namespace="/ui")
+@instruments.timed()
 def ui_terminal_command(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
     if not isinstance(payload, dict):
         return {"error": "Invalid payload."}
@@ -735,7 +2038,51 @@ def ui_terminal_command(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: n
     }
 
 
+def _forward_cancel(event: str, request_id: str, meta: Dict[str, Any]) -> Dict[str, Any]:
+    pi_id = meta.get("pi_id")
+    with pi_sessions_lock:
+        target_sid = pi_sessions.get(pi_id) if pi_id else None
+    if not target_sid:
+        return {"error": f"Pi '{pi_id}' is offline."}
+    socketio.emit(event, {"request_id": request_id, "task_id": meta.get("task_id")}, to=target_sid, namespace="/pi")
+    return {"status": "cancelling", "request_id": request_id, "message": f"Cancel sent to {pi_id}."}
+
+
+@socketio.on("cancel_task", namespace="/ui")
+@instruments.timed()
+def ui_cancel_task(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
+    if not isinstance(payload, dict):
+        return {"error": "Invalid payload."}
+    request_id = str(payload.get("request_id") or "").strip()
+    if not request_id:
+        return {"error": "request_id required."}
+    state = task_runner.cancel(request_id)
+    if state:
+        return {"status": "cancelled" if state == "queued" else "cancelling", "request_id": request_id}
+    with remote_lock:
+        meta = dict(remote_meta.get(request_id) or {})
+    if not meta:
+        return {"error": f"No running task '{request_id}'."}
+    return _forward_cancel("cancel_task", request_id, meta)
+
+
+@socketio.on("cancel_terminal", namespace="/ui")
+@instruments.timed()
+def ui_cancel_terminal(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
+    if not isinstance(payload, dict):
+        return {"error": "Invalid payload."}
+    request_id = str(payload.get("request_id") or "").strip()
+    if not request_id:
+        return {"error": "request_id required."}
+    with terminal_lock:
+        meta = dict(terminal_meta.get(request_id) or {})
+    if not meta:
+        return {"error": f"No running command '{request_id}'."}
+    return _forward_cancel("cancel_terminal", request_id, meta)
+
+
 @socketio.on("assign_task", namespace="/ui")
+@instruments.timed()
 def ui_assign_task(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
     if not isinstance(payload, dict):
         return {"error": "Invalid payload."}
@@ -772,6 +2119,7 @@ def ui_assign_task(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cov
 
 
 @socketio.on("assign_name", namespace="/ui")
+@instruments.timed()
 def ui_assign_name(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
     if not isinstance(payload, dict):
         return {"error": "Invalid payload."}
@@ -810,16 +2158,38 @@ def ui_assign_name(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cov
 
 
 @socketio.on("register", namespace="/pi")
-def pi_register(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
+@instruments.timed()
+def pi_register(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:  # pragma: no cover - event hook
     if not isinstance(payload, dict):
         disconnect()
-        return
+        return None
     pi_id = str(payload.get("pi_id") or "").strip()
     if not pi_id:
         disconnect()
-        return
+        return None
+    # pi_sessions_lock is per process, so in cluster mode workers registering
+    # at the same moment can each pass the check; the limit is soft by a few agents.
     with pi_sessions_lock:
-        pi_sessions[pi_id] = request.sid
+        full = pi_id not in pi_sessions and len(pi_sessions) >= MAX_AGENTS
+        if not full:
+            pi_sessions[pi_id] = request.sid
+            local_agents[request.sid] = pi_id
+            agent_workers[pi_id] = WORKER_INDEX
+    if full:
+        socketio.emit(
+            "log",
+            {"level": "warning", "message": f"Refused Pi '{pi_id}': {MAX_AGENTS} agents already connected."},
+            namespace="/ui",
+        )
+        sid = request.sid
+
+        def drop() -> None:
+            # Give the acknowledgement time to reach the agent first.
+            socketio.sleep(1)
+            socketio.server.disconnect(sid, namespace="/pi")
+
+        socketio.start_background_task(drop)
+        return {"error": f"Controller is at its limit of {MAX_AGENTS} agents."}
     assigned = task_store.get(pi_id)
     registry.upsert(
         pi_id,
@@ -831,15 +2201,20 @@ def pi_register(payload: Dict[str, Any]) -> None:  # pragma: no cover - event ho
             "assigned_task": assigned,
         },
     )
+    inventory = {key: value for key, value in payload.items() if key not in {"pi_id", "active_task"}}
+    inventory["address"] = request.remote_addr
+    state_backend.update_inventory(pi_id, inventory)
     broadcast_snapshot()
     socketio.emit(
         "log",
         {"level": "info", "message": f"Pi '{pi_id}' registered."},
         namespace="/ui",
     )
+    return {"features": CONTROLLER_FEATURES}
 
 
 @socketio.on("stats_report", namespace="/pi")
+@instruments.timed()
 def pi_stats_report(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
     if not isinstance(payload, dict):
         return
@@ -856,63 +2231,164 @@ def pi_stats_report(payload: Dict[str, Any]) -> None:  # pragma: no cover - even
             "active_task": payload.get("active_task"),
             "source": "pi",
             "assigned_task": task_store.get(pi_id),
+            "workers": payload.get("workers"),
+            "telemetry": sample_telemetry(payload),
         },
     )
+    record_metrics(pi_id, payload)
     broadcast_snapshot()
     emit_pi_console(pi_id, 'Emitting event "stats_report" [/pi]', event="stats_report")
 
 
+@socketio.on("stats_batch", namespace="/pi")
+@instruments.timed()
+def pi_stats_batch(payload: Dict[str, Any]) -> Dict[str, Any]:  # pragma: no cover - event hook
+    payload = agent_payload("stats_batch", payload)
+    if not isinstance(payload, dict):
+        return {"error": "Invalid payload."}
+    pi_id = payload.get("pi_id")
+    raw_samples = payload.get("samples")
+    if not pi_id or not isinstance(raw_samples, list):
+        return {"error": "pi_id and samples are required."}
+    now = time.time()
+    samples: List[Tuple[float, Dict[str, Any]]] = []
+    for sample in raw_samples:
+        if not isinstance(sample, dict):
+            continue
+        try:
+            timestamp = float(sample.get("ts"))
+        except (TypeError, ValueError):
+            timestamp = now
+        # Trust agent clocks for ordering, but never record samples from the future.
+        samples.append((min(timestamp, now), sample))
+    if not samples:
+        return {"status": "ok", "accepted": 0}
+    samples.sort(key=lambda item: item[0])
+    record_metric_samples(pi_id, samples)
+    latest = samples[-1][1]
+    registry.upsert(
+        pi_id,
+        {
+            "cpu_percent": latest.get("cpu_percent"),
+            "ram_percent": latest.get("ram_percent"),
+            "ram_used_gb": latest.get("ram_used_gb"),
+            "ram_total_gb": latest.get("ram_total_gb"),
+            "active_task": payload.get("active_task"),
+            "source": "pi",
+            "assigned_task": task_store.get(pi_id),
+            "workers": payload.get("workers"),
+            "telemetry": sample_telemetry(latest),
+        },
+    )
+    broadcast_snapshot()
+    emit_pi_console(pi_id, f'Received "stats_batch" with {len(samples)} samples [/pi]', event="stats_batch")
+    return {"status": "ok", "accepted": len(samples)}
+
+
+@socketio.on("task_queued", namespace="/pi")
+@instruments.timed()
+def pi_task_queued(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
+    relay_to_ui("task_queued", payload)
+
+
 @socketio.on("task_started", namespace="/pi")
+@instruments.timed()
 def pi_task_started(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
     relay_to_ui("task_started", payload)
 
 
 @socketio.on("task_output", namespace="/pi")
+@instruments.timed()
 def pi_task_output(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
-    relay_to_ui("task_output", payload)
+    payload = agent_payload("task_output", payload)
+    if isinstance(payload, dict):
+        relay_to_ui("task_output", payload)
 
 
 @socketio.on("task_finished", namespace="/pi")
+@instruments.timed()
 def pi_task_finished(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
     relay_to_ui("task_finished", payload)
 
 
 @socketio.on("task_error", namespace="/pi")
+@instruments.timed()
 def pi_task_error(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
     relay_to_ui("task_error", payload)
 
 
+@socketio.on("terminal_queued", namespace="/pi")
+@instruments.timed()
+def pi_terminal_queued(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
+    relay_terminal_to_ui("terminal_queued", payload)
+
+
 @socketio.on("terminal_started", namespace="/pi")
+@instruments.timed()
 def pi_terminal_started(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
     relay_terminal_to_ui("terminal_started", payload)
 
 
 @socketio.on("terminal_output", namespace="/pi")
+@instruments.timed()
 def pi_terminal_output(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
-    relay_terminal_to_ui("terminal_output", payload)
+    payload = agent_payload("terminal_output", payload)
+    if isinstance(payload, dict):
+        relay_terminal_to_ui("terminal_output", payload)
 
 
 @socketio.on("terminal_finished", namespace="/pi")
+@instruments.timed()
 def pi_terminal_finished(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
     relay_terminal_to_ui("terminal_finished", payload)
 
 
 @socketio.on("terminal_error", namespace="/pi")
+@instruments.timed()
 def pi_terminal_error(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
     relay_terminal_to_ui("terminal_error", payload)
 
 
+@socketio.on("profile_result", namespace="/pi")
+@instruments.timed()
+def pi_profile_result(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
+    if not isinstance(payload, dict):
+        return
+    origin_sid = profile_requests.pop(str(payload.get("request_id") or ""), None)
+    if origin_sid:
+        socketio.emit("profile_result", payload, room=origin_sid, namespace="/ui")
+
+
+@socketio.on("processes_report", namespace="/pi")
+@instruments.timed()
+def pi_processes_report(payload: Dict[str, Any]) -> None:  # pragma: no cover - event hook
+    if not isinstance(payload, dict):
+        return
+    pi_id = str(payload.get("pi_id") or "")
+    view = process_view(payload)
+    if not pi_id or view is None:
+        return
+    process_views[pi_id] = view
+    origin_sid = process_requests.pop(str(payload.get("request_id") or ""), None)
+    if origin_sid:
+        socketio.emit("processes_result", dict(view, pi_id=pi_id), room=origin_sid, namespace="/ui")
+
+
 @socketio.on("disconnect", namespace="/pi")
+@instruments.timed()
 def pi_disconnect() -> None:  # pragma: no cover - event hook
-    lost: Optional[str] = None
     with pi_sessions_lock:
-        for key, sid in list(pi_sessions.items()):
-            if sid == request.sid:
-                lost = key
-                pi_sessions.pop(key, None)
-                break
+        lost = local_agents.pop(request.sid, None)
+        # The agent may already have reconnected under a new session.
+        if lost and pi_sessions.get(lost) == request.sid:
+            pi_sessions.pop(lost, None)
+            agent_workers.pop(lost, None)
+        else:
+            lost = None
     if not lost:
         return
+    cluster_publish("fanout", {"op": "pi_lost", "pi_id": lost})
+    fanout.pi_lost(lost)
     registry.mark_offline(lost)
     broadcast_snapshot()
     socketio.emit(
@@ -922,8 +2398,65 @@ def pi_disconnect() -> None:  # pragma: no cover - event hook
     )
 
 
-socketio.start_background_task(local_stats_loop)
+def _apply_cluster_message(channel: str, message: Dict[str, Any]) -> None:
+    """Apply a change published by another controller worker."""
+    if channel == "registry":
+        if message.get("op") == "sync":
+            # A worker (re)started: send it the Pis this process is the source for.
+            owned = list(local_agents.values()) + (["local"] if IS_LEADER else [])
+            for pi_id in owned:
+                entry = registry.get(pi_id)
+                if entry is not None:
+                    entry.pop("version", None)
+                    _publish_registry_change(pi_id, entry, [])
+            return
+        registry.apply_changes(message["pi_id"], message.get("fields") or {}, message.get("removed") or [])
+        broadcast_snapshot()
+    elif channel == "scrollback":
+        scrollback.append(message["pi_id"], message.get("request_id"), message.get("lines") or [], message.get("seq"))
+    elif channel == "metrics":
+        samples = [(float(timestamp), sample) for timestamp, sample in message.get("samples") or []]
+        metrics_store.record_many(message["pi_id"], samples)
+        if IS_LEADER:
+            metrics_segments.append_many(message["pi_id"], samples)
+    elif channel == "schedules":
+        scheduler.apply(message)
+    elif channel == "fanout":
+        if message.get("op") == "complete":
+            fanout.complete(message["request_id"], message.get("exit_code"), message.get("error"))
+        elif message.get("op") == "pi_lost":
+            fanout.pi_lost(message["pi_id"])
+
+
+def join_cluster() -> None:
+    for channel in ("registry", "scrollback", "metrics", "schedules", "fanout"):
+        cluster_bus.subscribe(channel, lambda message, channel=channel: _apply_cluster_message(channel, message))
+    # Agents that were connected to the previous process with this index went
+    # away with it unless they have registered elsewhere since.
+    for pi_id in [pi_id for pi_id, index in agent_workers.items() if index == WORKER_INDEX]:
+        agent_workers.pop(pi_id, None)
+        pi_sessions.pop(pi_id, None)
+        _publish_registry_change(pi_id, {"online": False, "active_task": "Offline", "last_seen": time.time()}, [])
+        cluster_publish("fanout", {"op": "pi_lost", "pi_id": pi_id})
+    cluster_publish("registry", {"op": "sync"})
+
+
+if cluster_bus is not None:
+    join_cluster()
+backfill_metrics()
+if IS_LEADER:
+    socketio.start_background_task(local_stats_loop)
+    socketio.start_background_task(metrics_maintenance_loop)
+snapshot_scheduler.start()
+scheduler.load()
+if IS_LEADER:
+    scheduler.start()
 
 
 if __name__ == "__main__":  # pragma: no cover - manual launch
-    socketio.run(app, host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
+    if cluster_bus is not None:
+        serve_worker(app, HOST, PORT, ASYNC_MODE)
+    else:
+        # Werkzeug otherwise refuses to start without a terminal (systemd, loadgen.py).
+        options = {"allow_unsafe_werkzeug": True} if ASYNC_MODE == "threading" else {}
+        socketio.run(app, host=HOST, port=PORT, debug=DEBUG, **options)
\ No newline at end of file
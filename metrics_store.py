@@ -0,0 +1,515 @@
+from __future__ import annotations
+
+import json
+import mmap
+import struct
+import time
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+
+# Metrics recorded from each stats report.
+DEFAULT_METRICS: Tuple[str, ...] = ("cpu_percent", "ram_percent", "ram_used_gb")
+
+# (bucket seconds, slots) per rollup tier: 15 minutes at 1s, 24 hours at 1m, 30 days at 1h.
+DEFAULT_TIERS: Tuple[Tuple[int, int], ...] = ((1, 900), (60, 1440), (3600, 720))
+
+# Bytes per slot: bucket key (int64) + running sum (float32) + sample count (uint32).
+SLOT_BYTES = 8 + 4 + 4
+
+# Minimum seconds between rereads of pis.json when a lookup misses.
+PIS_RESCAN_SECONDS = 5.0
+
+
+class RollupRing:
+    """Fixed-size, direct-mapped ring of averaged buckets for one tier.
+
+    Bucket ``n`` (``timestamp // step``) always lives in slot ``n % slots``; a slot
+    whose key does not match the requested bucket is stale and reads as empty.
+    """
+
+    def __init__(self, step: int, slots: int) -> None:
+        self.step = step
+        self.slots = slots
+        self._keys = array("q", [-1]) * slots
+        self._sums = array("f", [0.0]) * slots
+        self._counts = array("I", [0]) * slots
+
+    def add(self, timestamp: float, value: float) -> None:
+        bucket = int(timestamp // self.step)
+        slot = bucket % self.slots
+        if bucket < self._keys[slot]:
+            # A late sample (replayed, or from a clock that is behind) must
+            # not overwrite the newer bucket sharing its slot.
+            return
+        if self._keys[slot] != bucket:
+            self._keys[slot] = bucket
+            self._sums[slot] = 0.0
+            self._counts[slot] = 0
+        self._sums[slot] += value
+        self._counts[slot] += 1
+
+    def covers(self, start: float, now: float) -> bool:
+        return int(start // self.step) > int(now // self.step) - self.slots
+
+    def read(self, start: float, end: float, step: int) -> List[List[Optional[float]]]:
+        """Average buckets in ``[start, end]`` into points ``step`` seconds apart."""
+        ratio = max(1, step // self.step)
+        first = int(start // self.step)
+        last = int(end // self.step)
+        first -= first % ratio
+        points: List[List[Optional[float]]] = []
+        for group in range(first, last + 1, ratio):
+            total = 0.0
+            count = 0
+            for bucket in range(group, min(group + ratio, last + 1)):
+                slot = bucket % self.slots
+                if self._keys[slot] == bucket and self._counts[slot]:
+                    total += self._sums[slot]
+                    count += self._counts[slot]
+            points.append([group * self.step, total / count if count else None])
+        return points
+
+
+class MetricsStore:
+    """In-memory time series of Pi metrics with bounded, preallocated storage.
+
+    Each Pi gets one :class:`RollupRing` per metric and tier, allocated on its first
+    sample, so memory per Pi is ``bytes_per_pi`` and never grows afterwards. At most
+    ``max_pis`` Pis are tracked; the least recently updated one is evicted first.
+    """
+
+    def __init__(
+        self,
+        metrics: Sequence[str] = DEFAULT_METRICS,
+        tiers: Sequence[Tuple[int, int]] = DEFAULT_TIERS,
+        max_pis: int = 1024,
+        max_points: int = 2000,
+    ) -> None:
+        self.metrics = tuple(metrics)
+        self.tiers = tuple(sorted((int(step), int(slots)) for step, slots in tiers))
+        self.max_pis = max(1, max_pis)
+        self.max_points = max(1, max_points)
+        self._series: "OrderedDict[str, Dict[str, List[RollupRing]]]" = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def bytes_per_pi(self) -> int:
+        slots = sum(slots for _step, slots in self.tiers)
+        return slots * SLOT_BYTES * len(self.metrics)
+
+    def record(self, pi_id: str, sample: Dict[str, Any], timestamp: Optional[float] = None) -> None:
+        ts = time.time() if timestamp is None else float(timestamp)
+        values: List[Tuple[str, float]] = []
+        for metric in self.metrics:
+            try:
+                values.append((metric, float(sample[metric])))
+            except (KeyError, TypeError, ValueError):
+                continue
+        if not values:
+            return
+        with self._lock:
+            series = self._series.get(pi_id)
+            if series is None:
+                series = {
+                    metric: [RollupRing(step, slots) for step, slots in self.tiers]
+                    for metric in self.metrics
+                }
+                self._series[pi_id] = series
+                while len(self._series) > self.max_pis:
+                    self._series.popitem(last=False)
+            else:
+                self._series.move_to_end(pi_id)
+            for metric, value in values:
+                for ring in series[metric]:
+                    ring.add(ts, value)
+
+    def record_many(self, pi_id: str, samples: Iterable[Tuple[float, Dict[str, Any]]]) -> None:
+        for timestamp, sample in samples:
+            self.record(pi_id, sample, timestamp)
+
+    def remove(self, pi_id: str) -> None:
+        with self._lock:
+            self._series.pop(pi_id, None)
+
+    def pis(self) -> List[str]:
+        with self._lock:
+            return list(self._series)
+
+    def query(
+        self,
+        pi_id: str,
+        metric: str,
+        start: float,
+        end: Optional[float] = None,
+        step: Optional[int] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Return averaged points for ``metric`` between ``start`` and ``end``.
+
+        The finest tier that still holds ``start`` is used; ``step`` is rounded up
+        to a multiple of that tier's bucket size and widened if the range would
+        exceed ``max_points``. Returns ``None`` for an unknown Pi or metric.
+        """
+        now = time.time()
+        end = now if end is None else min(float(end), now)
+        start = min(float(start), end)
+        with self._lock:
+            series = self._series.get(pi_id)
+            if series is None or metric not in series:
+                return None
+            rings = series[metric]
+            ring = next((item for item in rings if item.covers(start, now)), rings[-1])
+            wanted = max(ring.step, int(step or ring.step))
+            wanted = -(-wanted // ring.step) * ring.step
+            span = max(1.0, end - start)
+            if span / wanted > self.max_points:
+                wanted = -(-int(span / self.max_points) // ring.step) * ring.step
+            points = ring.read(start, end, wanted)
+        return {
+            "pi_id": pi_id,
+            "metric": metric,
+            "from": start,
+            "to": end,
+            "step": wanted,
+            "tier": ring.step,
+            "points": points,
+        }
+
+
+SEGMENT_MAGIC = b"PSEG"
+SEGMENT_VERSION = 1
+# magic, format version, number of metric columns per record
+SEGMENT_HEADER = struct.Struct("<4sHH")
+RAW_PREFIX = "raw"
+COMPACT_PREFIX = "min"
+
+
+class MetricsSegmentStore:
+    """Append-only, time-bucketed binary segments of metric samples.
+
+    Every segment file starts with :data:`SEGMENT_HEADER` followed by fixed-width
+    records of ``(timestamp: f64, pi index: u32, one f32 per metric)``. Missing
+    values are stored as NaN. Pi ids are mapped to indexes in ``pis.json``.
+
+    Raw samples go to ``raw-<start>.seg`` files covering ``segment_seconds`` each.
+    Once a raw segment is older than ``compact_after`` seconds it is rewritten as
+    one averaged record per Pi and minute (``min-<start>.seg``); samples that
+    would land in such a segment are not stored. Compacted segments are deleted
+    after ``retention`` seconds. Reads map the files with ``mmap`` and
+    decode records in place, so nothing is loaded into the heap wholesale.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        metrics: Sequence[str] = DEFAULT_METRICS,
+        segment_seconds: int = 3600,
+        compact_after: float = 24 * 3600,
+        retention: float = 30 * 24 * 3600,
+    ) -> None:
+        self._dir = directory
+        self.metrics = tuple(metrics)
+        self.segment_seconds = max(60, int(segment_seconds))
+        self.compact_after = max(float(self.segment_seconds), compact_after)
+        self.retention = max(self.compact_after, retention)
+        self._record = struct.Struct("<dI" + "f" * len(self.metrics))
+        self._lock = Lock()
+        self._pis: List[str] = []
+        self._pi_index: Dict[str, int] = {}
+        self._active_start: Optional[int] = None
+        self._active: Optional[BinaryIO] = None
+        self._last_compaction = 0.0
+        self._last_rescan = 0.0
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._pis = self._read_pis()
+        self._pi_index = {pi_id: idx for idx, pi_id in enumerate(self._pis)}
+
+    @property
+    def record_size(self) -> int:
+        return self._record.size
+
+    def _read_pis(self) -> List[str]:
+        path = self._dir / "pis.json"
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            data = []
+        return [str(item) for item in data] if isinstance(data, list) else []
+
+    def _lookup(self, pi_id: str) -> Optional[int]:
+        """Index of ``pi_id``, rereading ``pis.json`` if it is unknown; call with the lock held.
+
+        In cluster mode only the leader appends, so other workers pick up Pis it
+        added since they started from the file, at most every ``PIS_RESCAN_SECONDS``.
+        """
+        idx = self._pi_index.get(pi_id)
+        now = time.monotonic()
+        if idx is not None or now - self._last_rescan < PIS_RESCAN_SECONDS:
+            return idx
+        self._last_rescan = now
+        pis = self._read_pis()
+        # Indexes are only appended; ignore a file that does not extend ours.
+        if len(pis) > len(self._pis) and pis[: len(self._pis)] == self._pis:
+            for index in range(len(self._pis), len(pis)):
+                self._pi_index[pis[index]] = index
+            self._pis = pis
+        return self._pi_index.get(pi_id)
+
+    def _save_pis(self) -> None:
+        path = self._dir / "pis.json"
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            tmp_path.write_text(json.dumps(self._pis), encoding="utf-8")
+            tmp_path.replace(path)
+        except OSError:
+            # Best effort; indexes are only appended, so the next save catches up.
+            pass
+
+    def _index_for(self, pi_id: str) -> int:
+        idx = self._pi_index.get(pi_id)
+        if idx is None:
+            idx = len(self._pis)
+            self._pis.append(pi_id)
+            self._pi_index[pi_id] = idx
+            self._save_pis()
+        return idx
+
+    def _segment_path(self, prefix: str, start: int) -> Path:
+        return self._dir / f"{prefix}-{start}.seg"
+
+    def _segments(self, prefix: str) -> List[Tuple[int, Path]]:
+        found: List[Tuple[int, Path]] = []
+        for path in self._dir.glob(f"{prefix}-*.seg"):
+            try:
+                found.append((int(path.stem.split("-", 1)[1]), path))
+            except ValueError:
+                continue
+        found.sort()
+        return found
+
+    def _header(self) -> bytes:
+        return SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(self.metrics))
+
+    def _pack(self, timestamp: float, idx: int, sample: Dict[str, Any]) -> bytes:
+        values = []
+        for metric in self.metrics:
+            try:
+                values.append(float(sample[metric]))
+            except (KeyError, TypeError, ValueError):
+                values.append(float("nan"))
+        return self._record.pack(timestamp, idx, *values)
+
+    def append(self, pi_id: str, sample: Dict[str, Any], timestamp: Optional[float] = None) -> None:
+        self.append_many(pi_id, [(time.time() if timestamp is None else float(timestamp), sample)])
+
+    def append_many(self, pi_id: str, samples: Iterable[Tuple[float, Dict[str, Any]]]) -> None:
+        # Segments this old may already be compacted; a new raw segment for the
+        # same hour would replace the compacted minutes when it is compacted.
+        oldest = time.time() - self.compact_after
+        with self._lock:
+            idx = self._index_for(pi_id)
+            for timestamp, sample in samples:
+                start = int(timestamp // self.segment_seconds) * self.segment_seconds
+                if start + self.segment_seconds <= oldest:
+                    continue
+                handle = self._open_segment(start)
+                if handle is None:
+                    return
+                try:
+                    handle.write(self._pack(timestamp, idx, sample))
+                except OSError:
+                    return
+
+    def _open_segment(self, start: int) -> Optional[BinaryIO]:
+        if self._active is not None and self._active_start == start:
+            return self._active
+        self._close_active()
+        path = self._segment_path(RAW_PREFIX, start)
+        try:
+            handle = open(path, "ab")
+            if handle.tell() == 0:
+                handle.write(self._header())
+        except OSError:
+            return None
+        self._active = handle
+        self._active_start = start
+        return handle
+
+    def _close_active(self) -> None:
+        if self._active is not None:
+            try:
+                self._active.close()
+            except OSError:
+                pass
+        self._active = None
+        self._active_start = None
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._active is not None:
+                try:
+                    self._active.flush()
+                except OSError:
+                    pass
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_active()
+
+    def _scan(
+        self,
+        path: Path,
+        start: float,
+        end: float,
+        pi_index: Optional[int],
+    ) -> Iterator[Tuple[float, int, Tuple[float, ...]]]:
+        try:
+            with open(path, "rb") as handle:
+                size = handle.seek(0, 2)
+                if size < SEGMENT_HEADER.size + self._record.size:
+                    return
+                with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                    magic, version, columns = SEGMENT_HEADER.unpack_from(view, 0)
+                    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or columns != len(self.metrics):
+                        return
+                    record = self._record
+                    # A crash mid-append can leave a partial trailing record; ignore it.
+                    limit = size - (size - SEGMENT_HEADER.size) % record.size
+                    for offset in range(SEGMENT_HEADER.size, limit, record.size):
+                        timestamp, idx, *values = record.unpack_from(view, offset)
+                        if pi_index is not None and idx != pi_index:
+                            continue
+                        if start <= timestamp <= end:
+                            yield timestamp, idx, tuple(values)
+        except (OSError, ValueError):
+            return
+
+    def _paths_for(self, start: float, end: float) -> List[Path]:
+        paths: List[Path] = []
+        for prefix in (COMPACT_PREFIX, RAW_PREFIX):
+            for seg_start, path in self._segments(prefix):
+                if seg_start + self.segment_seconds >= start and seg_start <= end:
+                    paths.append(path)
+        return paths
+
+    def read(
+        self,
+        start: float,
+        end: Optional[float] = None,
+        pi_id: Optional[str] = None,
+    ) -> Iterator[Tuple[float, str, Dict[str, float]]]:
+        """Yield ``(timestamp, pi_id, values)`` for stored records in ``[start, end]``."""
+        end = time.time() if end is None else float(end)
+        self.flush()
+        with self._lock:
+            pi_index = self._lookup(pi_id) if pi_id is not None else None
+            pis = list(self._pis)
+        if pi_id is not None and pi_index is None:
+            return
+        for path in self._paths_for(start, end):
+            for timestamp, idx, values in self._scan(path, start, end, pi_index):
+                if idx >= len(pis):
+                    continue
+                yield timestamp, pis[idx], {
+                    metric: value for metric, value in zip(self.metrics, values) if value == value
+                }
+
+    def query(
+        self,
+        pi_id: str,
+        metric: str,
+        start: float,
+        end: Optional[float] = None,
+        step: Optional[int] = None,
+        max_points: int = 2000,
+    ) -> Optional[Dict[str, Any]]:
+        """Average stored values of ``metric`` into ``step``-second points.
+
+        Returns ``None`` for a metric or Pi that has never been stored.
+        """
+        with self._lock:
+            known = self._lookup(pi_id) is not None
+        if metric not in self.metrics or not known:
+            return None
+        end = time.time() if end is None else float(end)
+        start = min(float(start), end)
+        wanted = max(1, int(step or 60))
+        wanted = max(wanted, -(-int(end - start) // max(1, max_points)))
+        sums: Dict[int, float] = {}
+        counts: Dict[int, int] = {}
+        for timestamp, _pi, values in self.read(start, end, pi_id):
+            value = values.get(metric)
+            if value is None:
+                continue
+            bucket = int(timestamp // wanted) * wanted
+            sums[bucket] = sums.get(bucket, 0.0) + value
+            counts[bucket] = counts.get(bucket, 0) + 1
+        first = int(start // wanted) * wanted
+        points = [
+            [bucket, sums[bucket] / counts[bucket] if bucket in counts else None]
+            for bucket in range(first, int(end) + 1, wanted)
+        ]
+        return {
+            "pi_id": pi_id,
+            "metric": metric,
+            "from": start,
+            "to": end,
+            "step": wanted,
+            "source": "disk",
+            "points": points,
+        }
+
+    def maintain(self, now: Optional[float] = None, interval: float = 60.0) -> None:
+        """Flush pending appends, then compact and expire segments at most every ``interval``."""
+        now = time.time() if now is None else now
+        self.flush()
+        if now - self._last_compaction < interval:
+            return
+        self._last_compaction = now
+        for seg_start, path in self._segments(RAW_PREFIX):
+            if seg_start + self.segment_seconds > now - self.compact_after:
+                break
+            with self._lock:
+                if self._active_start == seg_start:
+                    self._close_active()
+            self._compact(seg_start, path)
+        for seg_start, path in self._segments(COMPACT_PREFIX):
+            if seg_start + self.segment_seconds > now - self.retention:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def _compact(self, seg_start: int, path: Path) -> None:
+        seg_end = seg_start + self.segment_seconds
+        sums: Dict[Tuple[int, int], List[float]] = {}
+        counts: Dict[Tuple[int, int], List[int]] = {}
+        width = len(self.metrics)
+        for timestamp, idx, values in self._scan(path, seg_start, seg_end, None):
+            key = (int(timestamp // 60) * 60, idx)
+            total = sums.setdefault(key, [0.0] * width)
+            count = counts.setdefault(key, [0] * width)
+            for col, value in enumerate(values):
+                if value == value:
+                    total[col] += value
+                    count[col] += 1
+        target = self._segment_path(COMPACT_PREFIX, seg_start)
+        tmp_path = target.with_suffix(".tmp")
+        nan = float("nan")
+        try:
+            with open(tmp_path, "wb") as handle:
+                handle.write(self._header())
+                for minute, idx in sorted(sums):
+                    total = sums[(minute, idx)]
+                    count = counts[(minute, idx)]
+                    averaged = [total[col] / count[col] if count[col] else nan for col in range(width)]
+                    handle.write(self._record.pack(float(minute), idx, *averaged))
+            tmp_path.replace(target)
+            path.unlink()
+        except OSError:
+            # Leave the raw segment in place; compaction is retried on the next pass.
+            pass
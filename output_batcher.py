@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+
+# emit(event, payload, target); target is whatever the writer passed, e.g. a room sid.
+EmitFn = Callable[[str, Dict[str, Any], Optional[str]], None]
+
+
+class _Batch:
+    __slots__ = ("event", "base", "target", "lines", "started", "dropped", "truncated")
+
+    def __init__(self, event: str, base: Dict[str, Any], target: Optional[str]) -> None:
+        self.event = event
+        self.base = base
+        self.target = target
+        self.lines: List[str] = []
+        self.started = time.monotonic()
+        self.dropped = 0
+        self.truncated = 0
+
+    def payload(self) -> Dict[str, Any]:
+        payload = dict(self.base)
+        payload["lines"] = self.lines
+        if self.dropped:
+            payload["dropped"] = self.dropped
+        if self.truncated:
+            payload["truncated"] = self.truncated
+        return payload
+
+
+class OutputBatcher:
+    """Coalesce streamed output lines into batched events sent from one thread.
+
+    Lines written for a stream (usually a request id) are grouped into one event
+    holding up to ``max_lines`` lines, or whatever arrived within ``max_delay``
+    seconds. At most ``max_buffered_lines`` lines wait to be sent across all
+    streams; anything beyond that is dropped and the count is reported in the
+    next batch as ``dropped``. Batches the emitter fails to send are logged and
+    counted as dropped too. Lines longer than ``max_line_length`` are cut and
+    counted as ``truncated``. Final events passed to :meth:`close` are queued
+    behind the stream's remaining output so ordering is preserved.
+    """
+
+    def __init__(
+        self,
+        emit: EmitFn,
+        max_lines: int = 100,
+        max_delay: float = 0.1,
+        max_buffered_lines: int = 10000,
+        max_line_length: int = 4096,
+        spawn: Optional[Callable[[Callable[[], None]], Any]] = None,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self._emit = emit
+        self.logger = logger or logging.getLogger("pistat-output")
+        self.max_lines = max(1, max_lines)
+        self.max_delay = max(0.01, max_delay)
+        self.max_buffered_lines = max(self.max_lines, max_buffered_lines)
+        self.max_line_length = max(1, max_line_length)
+        self._cond = threading.Condition()
+        self._pending: Dict[str, _Batch] = {}
+        self._ready: Deque[Tuple[str, Dict[str, Any], Optional[str]]] = deque()
+        self._buffered = 0
+        self._dropped: Dict[str, int] = {}
+        self._stats = {"lines": 0, "batches": 0, "dropped": 0, "truncated": 0}
+        self._closed = False
+        if spawn is None:
+            threading.Thread(target=self._run, daemon=True, name="output-batcher").start()
+        else:
+            spawn(self._run)
+
+    def write(
+        self,
+        key: str,
+        event: str,
+        base: Dict[str, Any],
+        line: str,
+        target: Optional[str] = None,
+    ) -> bool:
+        """Queue ``line`` for stream ``key``; returns False if it had to be dropped."""
+        with self._cond:
+            if self._buffered >= self.max_buffered_lines:
+                self._dropped[key] = self._dropped.get(key, 0) + 1
+                self._stats["dropped"] += 1
+                return False
+            batch = self._pending.get(key)
+            if batch is None or batch.event != event:
+                if batch is not None:
+                    self._promote(key)
+                batch = _Batch(event, base, target)
+                batch.dropped = self._dropped.pop(key, 0)
+                self._pending[key] = batch
+            if len(line) > self.max_line_length:
+                line = line[: self.max_line_length]
+                batch.truncated += 1
+                self._stats["truncated"] += 1
+            batch.lines.append(line)
+            self._buffered += 1
+            self._stats["lines"] += 1
+            if len(batch.lines) >= self.max_lines:
+                self._promote(key)
+                self._cond.notify()
+            return True
+
+    def close(
+        self,
+        key: str,
+        event: Optional[str] = None,
+        payload: Optional[Dict[str, Any]] = None,
+        target: Optional[str] = None,
+    ) -> None:
+        """Flush stream ``key`` and optionally queue a final event after its output."""
+        with self._cond:
+            self._promote(key)
+            dropped = self._dropped.pop(key, 0)
+            if event is not None:
+                final = dict(payload or {})
+                if dropped:
+                    final["dropped"] = dropped
+                self._ready.append((event, final, target))
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["buffered"] = self._buffered
+            return stats
+
+    def stop(self) -> None:
+        with self._cond:
+            for key in list(self._pending):
+                self._promote(key)
+            self._closed = True
+            self._cond.notify()
+
+    def _promote(self, key: str) -> None:
+        batch = self._pending.pop(key, None)
+        if batch is None or not batch.lines:
+            return
+        self._ready.append((batch.event, batch.payload(), batch.target))
+
+    def _take(self) -> List[Tuple[str, Dict[str, Any], Optional[str]]]:
+        with self._cond:
+            if not self._ready and not self._closed:
+                self._cond.wait(self.max_delay)
+            now = time.monotonic()
+            for key, batch in list(self._pending.items()):
+                if now - batch.started >= self.max_delay:
+                    self._promote(key)
+            items = list(self._ready)
+            self._ready.clear()
+            return items
+
+    def _run(self) -> None:
+        while True:
+            items = self._take()
+            for event, payload, target in items:
+                lines = payload.get("lines")
+                failed = False
+                try:
+                    self._emit(event, payload, target)
+                except Exception:  # emitter failures must not kill the sender
+                    failed = True
+                    self.logger.exception("Could not send %s", event)
+                if lines is not None:
+                    with self._cond:
+                        self._buffered -= len(lines)
+                        if failed:
+                            self._stats["dropped"] += len(lines)
+                        else:
+                            self._stats["batches"] += 1
+            if self._closed and not items:
+                return
@@ -9,11 +9,18 @@ import subprocess
 import sys
 import threading
 import time
-from typing import Iterable, List, Optional
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional
 
 import psutil
 import socketio
 
+from collectors import DEFAULT_COLLECTORS, CollectorSet, ProcessTable, parse_collectors
+from output_batcher import OutputBatcher
+from sampling_profiler import SamplingProfiler
+from wire import WIRE_FEATURE, encode as encode_wire
+from worker_pool import PoolFull, PoolJob, WorkerPool, popen_group_kwargs
+
 
 PI_NAMESPACE = "/pi"
 # Default controller URL: change this to point at your controller's IP and port
@@ -32,17 +39,62 @@ class PiAgent:
         stats_interval: float = 5.0,
         register_only: bool = False,
         log_level: str = "INFO",
+        sample_interval: float = 1.0,
+        buffer_size: int = 3600,
+        batch_size: int = 300,
+        output_batch_lines: int = 100,
+        output_batch_ms: float = 100.0,
+        output_buffer_lines: int = 10000,
+        max_workers: int = 2,
+        max_queue: int = 50,
+        task_timeout: float = 300.0,
+        kill_grace: float = 5.0,
+        collectors: str = DEFAULT_COLLECTORS,
+        process_interval: float = 30.0,
+        top_processes: int = 10,
+        wire: str = "auto",
     ) -> None:
         self.controller_url = controller_url.rstrip("/")
         self.pi_id = pi_id
         self.label = label or pi_id
         self.stats_interval = max(1.0, stats_interval)
+        self.sample_interval = min(self.stats_interval, max(0.2, sample_interval))
+        self.batch_size = max(1, batch_size)
+        # Samples not yet acknowledged by the controller; oldest are dropped when full.
+        self._samples: Deque[Dict[str, Any]] = deque(maxlen=max(1, buffer_size))
+        self._samples_lock = threading.Lock()
+        self._collector_spec = collectors
+        # Per-core and top-process view, sent every process_interval seconds
+        # (0: only when the dashboard asks) to controllers that support it.
+        self._processes = ProcessTable(top_processes)
+        self.process_interval = max(0.0, process_interval)
+        self._controller_features: List[str] = []
+        # "auto" sends stats and output as binary frames to controllers that
+        # accept them (decided again on every registration); "json" never does.
+        self.wire = wire
+        self._binary_wire = False
+        self._output = OutputBatcher(
+            self._emit_output,
+            max_lines=output_batch_lines,
+            max_delay=output_batch_ms / 1000.0,
+            max_buffered_lines=output_buffer_lines,
+            logger=logging.getLogger("pi-agent"),
+        )
+        # Tasks and terminal commands share one bounded pool; terminal commands
+        # are interactive, so they jump ahead of queued tasks.
+        self._pool = WorkerPool(
+            max_workers, max_queue, name="agent-task", kill_grace=kill_grace, logger=logging.getLogger("pi-agent")
+        )
+        # Started and stopped from the dashboard (``profile start <pi>``).
+        self._profiler = SamplingProfiler()
+        self.task_timeout = max(0.0, task_timeout)
         self.register_only = register_only
         self.logger = logging.getLogger("pi-agent")
         self.active_task = "Idle"
         self._active_lock = threading.Lock()
         self._stop_event = threading.Event()
         self._stats_thread: Optional[threading.Thread] = None
+        self._flush_thread: Optional[threading.Thread] = None
         self._sio = socketio.Client(logger=self.logger, engineio_logger=False)
         self._configure_handlers()
         self._configure_logging(log_level)
@@ -59,6 +111,8 @@ class PiAgent:
         @_self_event(self._sio, "connect")
         def _connect() -> None:
             self.logger.info("Connected to controller; registering as %s", self.pi_id)
+            # JSON until the (possibly different) controller says otherwise.
+            self._binary_wire = False
             self._emit_register()
 
         @_self_event(self._sio, "disconnect")
@@ -79,15 +133,33 @@ class PiAgent:
                 return
             self._handle_terminal_command(payload)
 
+        @_self_event(self._sio, "cancel_task")
+        def _cancel_task(payload: dict) -> None:
+            self._handle_cancel(payload, terminal=False)
+
+        @_self_event(self._sio, "cancel_terminal")
+        def _cancel_terminal(payload: dict) -> None:
+            self._handle_cancel(payload, terminal=True)
+
+        @_self_event(self._sio, "profile")
+        def _profile(payload: dict) -> None:
+            self._handle_profile(payload)
+
+        @_self_event(self._sio, "processes")
+        def _processes(payload: dict) -> None:
+            self._report_processes((payload or {}).get("request_id"))
+
     def _emit_register(self) -> None:
-        vm_info = psutil.virtual_memory()
-        payload = {
-            "pi_id": self.pi_id,
-            "label": self.label,
-            "ram_total_gb": vm_info.total / (1024**3),
-            "active_task": self.active_task,
-        }
-        self._sio.emit("register", payload, namespace=PI_NAMESPACE)
+        payload = register_payload(self.pi_id, self.label, self.active_task)
+        self._sio.emit("register", payload, namespace=PI_NAMESPACE, callback=self._on_registered)
+
+    def _on_registered(self, reply: Any = None) -> None:
+        if isinstance(reply, dict) and reply.get("error"):
+            self.logger.error("Controller refused registration: %s", reply["error"])
+        features = reply.get("features") if isinstance(reply, dict) else None
+        self._controller_features = [str(item) for item in features] if isinstance(features, list) else []
+        self._binary_wire = self.wire != "json" and WIRE_FEATURE in self._controller_features
+        self.logger.debug("Controller features: %s", self._controller_features or "none")
 
     def _handle_execute_task(self, payload: dict) -> None:
         request_id = (payload or {}).get("request_id")
@@ -102,12 +174,26 @@ class PiAgent:
             self._emit_task_error(request_id, label, "Invalid command payload")
             return
         cmd_list = [str(part) for part in command]
-        worker = threading.Thread(
-            target=self._run_task,
-            args=(request_id, task_id or label, label, cmd_list),
-            daemon=True,
-        )
-        worker.start()
+        timeout = _positive_float((payload or {}).get("timeout"), self.task_timeout)
+        try:
+            position = self._pool.submit(
+                request_id,
+                lambda job: self._run_task(job, request_id, task_id or label, label, cmd_list),
+                priority=1,
+                timeout=timeout,
+                max_output_bytes=_positive_int((payload or {}).get("max_output_bytes")),
+                on_error=lambda exc: self._emit_task_error(request_id, task_id or label, str(exc)),
+            )
+        except PoolFull:
+            self.logger.warning("Rejecting task %s: queue is full", request_id)
+            self._emit_task_error(request_id, task_id or label, "Agent task queue is full")
+            return
+        if position:
+            self._sio.emit(
+                "task_queued",
+                {"request_id": request_id, "task_id": task_id or label, "pi_id": self.pi_id, "position": position},
+                namespace=PI_NAMESPACE,
+            )
 
     def _handle_terminal_command(self, payload: dict) -> None:
         request_id = (payload or {}).get("request_id")
@@ -124,14 +210,61 @@ class PiAgent:
         else:
             command_str = str(raw_command)
         self.logger.info("Executing terminal command %s: %s", request_id, command_str)
-        worker = threading.Thread(
-            target=self._run_terminal_command,
-            args=(request_id, command_str),
-            daemon=True,
+        try:
+            position = self._pool.submit(
+                request_id,
+                lambda job: self._run_terminal_command(job, request_id, command_str),
+                priority=0,
+                timeout=_positive_float((payload or {}).get("timeout"), 0.0),
+                on_error=lambda exc: self._emit_terminal_error(request_id, str(exc)),
+            )
+        except PoolFull:
+            self.logger.warning("Rejecting terminal command %s: queue is full", request_id)
+            self._emit_terminal_error(request_id, "Agent task queue is full")
+            return
+        if position:
+            self._sio.emit(
+                "terminal_queued",
+                {"request_id": request_id, "pi_id": self.pi_id, "position": position},
+                namespace=PI_NAMESPACE,
+            )
+
+    def _handle_cancel(self, payload: dict, terminal: bool) -> None:
+        request_id = (payload or {}).get("request_id")
+        if not request_id:
+            return
+        state = self._pool.cancel(str(request_id))
+        self.logger.info("Cancel %s: %s", request_id, state or "not found")
+        # Running jobs report their own error once the process group exits;
+        # queued ones never start, so report them here.
+        if state == "queued":
+            if terminal:
+                self._emit_terminal_error(request_id, "Cancelled")
+            else:
+                self._emit_task_error(request_id, (payload or {}).get("task_id") or "task", "Cancelled")
+
+    def _handle_profile(self, payload: dict) -> None:
+        request_id = (payload or {}).get("request_id")
+        if not request_id:
+            return
+        action = str((payload or {}).get("action") or "")
+        result = self._profiler.command(action, (payload or {}).get("hz"))
+        self.logger.info("Profiler %s: %s", action, result.get("error") or f"{result.get('samples', 0)} samples")
+        self._sio.emit(
+            "profile_result",
+            dict(result, request_id=request_id, pi_id=self.pi_id, action=action),
+            namespace=PI_NAMESPACE,
         )
-        worker.start()
 
-    def _run_task(self, request_id: str, task_id: str, label: str, command: List[str]) -> None:
+    def _report_processes(self, request_id: Optional[str] = None) -> None:
+        if not self._sio.connected:
+            return
+        payload = dict(self._processes.snapshot(), pi_id=self.pi_id)
+        if request_id:
+            payload["request_id"] = request_id
+        self._sio.emit("processes_report", payload, namespace=PI_NAMESPACE)
+
+    def _run_task(self, job: PoolJob, request_id: str, task_id: str, label: str, command: List[str]) -> None:
         self.logger.info("Running task %s: %s", request_id, " ".join(command))
         with self._active_lock:
             self.active_task = label
@@ -148,6 +281,7 @@ class PiAgent:
                 stderr=subprocess.STDOUT,
                 text=True,
                 bufsize=1,
+                **popen_group_kwargs(),
             )
         except FileNotFoundError:
             exit_code = -1
@@ -158,28 +292,28 @@ class PiAgent:
             self.logger.exception("Failed to start task %s", request_id)
             self._emit_task_error(request_id, task_id, str(exc), exit_code)
         else:
+            job.attach(process)
             assert process.stdout is not None
             try:
-                for line in process.stdout:
+                base = {"request_id": request_id, "task_id": task_id, "pi_id": self.pi_id}
+                for line in job.read_lines(process):
                     cleaned = line.rstrip("\n")
-                    if cleaned:
-                        self._sio.emit(
-                            "task_output",
-                            {
-                                "request_id": request_id,
-                                "task_id": task_id,
-                                "pi_id": self.pi_id,
-                                "line": cleaned,
-                            },
-                            namespace=PI_NAMESPACE,
-                        )
+                    # Keep draining after a stop so the child never blocks on a full pipe.
+                    if cleaned and job.count_output(len(line.encode("utf-8", "replace"))):
+                        self._output.write(request_id, "task_output", base, cleaned)
                 exit_code = process.wait()
             except Exception as exc:  # pragma: no cover - runtime safeguard
                 exit_code = -1
                 self.logger.exception("Task %s encountered runtime error", request_id)
                 self._emit_task_error(request_id, task_id, str(exc), exit_code)
             else:
-                self._sio.emit(
+                stopped = job.stop_message()
+                if stopped:
+                    self.logger.warning("Task %s stopped: %s", request_id, stopped)
+                    self._emit_task_error(request_id, task_id, stopped, exit_code)
+                    return
+                self._output.close(
+                    request_id,
                     "task_finished",
                     {
                         "request_id": request_id,
@@ -187,14 +321,14 @@ class PiAgent:
                         "pi_id": self.pi_id,
                         "exit_code": exit_code,
                     },
-                    namespace=PI_NAMESPACE,
                 )
         finally:
             with self._active_lock:
                 self.active_task = "Idle"
 
     def _emit_task_error(self, request_id: str, task_id: str, message: str, exit_code: int = -1) -> None:
-        self._sio.emit(
+        self._output.close(
+            request_id,
             "task_error",
             {
                 "request_id": request_id,
@@ -203,10 +337,9 @@ class PiAgent:
                 "error": message,
                 "exit_code": exit_code,
             },
-            namespace=PI_NAMESPACE,
         )
 
-    def _run_terminal_command(self, request_id: str, command: str) -> None:
+    def _run_terminal_command(self, job: PoolJob, request_id: str, command: str) -> None:
         self._sio.emit(
             "terminal_started",
             {"request_id": request_id, "pi_id": self.pi_id, "command": command},
@@ -221,6 +354,7 @@ class PiAgent:
                 text=True,
                 bufsize=1,
                 shell=True,
+                **popen_group_kwargs(),
             )
         except FileNotFoundError:
             exit_code = -1
@@ -233,38 +367,37 @@ class PiAgent:
             self._emit_terminal_error(request_id, str(exc), exit_code)
             return
 
+        job.attach(process)
         assert process.stdout is not None
+        base = {"request_id": request_id, "pi_id": self.pi_id}
         try:
-            for line in process.stdout:
+            for line in job.read_lines(process):
                 cleaned = line.rstrip("\n")
-                if cleaned:
-                    self._sio.emit(
-                        "terminal_output",
-                        {
-                            "request_id": request_id,
-                            "pi_id": self.pi_id,
-                            "line": cleaned,
-                        },
-                        namespace=PI_NAMESPACE,
-                    )
+                if cleaned and job.count_output(len(line.encode("utf-8", "replace"))):
+                    self._output.write(request_id, "terminal_output", base, cleaned)
             exit_code = process.wait()
         except Exception as exc:  # pragma: no cover - runtime safeguard
             exit_code = -1
             self.logger.exception("Terminal command %s encountered runtime error", request_id)
             self._emit_terminal_error(request_id, str(exc), exit_code)
         else:
-            self._sio.emit(
+            stopped = job.stop_message()
+            if stopped:
+                self._emit_terminal_error(request_id, stopped, exit_code)
+                return
+            self._output.close(
+                request_id,
                 "terminal_finished",
                 {
                     "request_id": request_id,
                     "pi_id": self.pi_id,
                     "exit_code": exit_code,
                 },
-                namespace=PI_NAMESPACE,
             )
 
     def _emit_terminal_error(self, request_id: str, message: str, exit_code: int = -1) -> None:
-        self._sio.emit(
+        self._output.close(
+            request_id,
             "terminal_error",
             {
                 "request_id": request_id,
@@ -272,25 +405,94 @@ class PiAgent:
                 "error": message,
                 "exit_code": exit_code,
             },
-            namespace=PI_NAMESPACE,
         )
 
+    def _emit_output(self, event: str, payload: Dict[str, Any], _target: Optional[str] = None) -> None:
+        """Send a batched output event, expanding it for controllers without batching."""
+        if not self._sio.connected:
+            return
+        lines = payload.get("lines")
+        if lines is None or "output_batch" in self._controller_features:
+            if lines is not None:
+                payload = wire_payload(payload, self._binary_wire)
+            self._sio.emit(event, payload, namespace=PI_NAMESPACE)
+            return
+        base = {key: value for key, value in payload.items() if key not in {"lines", "dropped", "truncated"}}
+        for line in lines:
+            self._sio.emit(event, dict(base, line=line), namespace=PI_NAMESPACE)
+
     def _stats_loop(self) -> None:
-        self.logger.info("Starting stats loop with interval %ss", self.stats_interval)
-        psutil.cpu_percent(interval=None)
-        while not self._stop_event.wait(self.stats_interval):
-            cpu_percent = psutil.cpu_percent(interval=None)
-            vm_info = psutil.virtual_memory()
-            used_gb = (vm_info.total - vm_info.available) / (1024**3)
+        self.logger.info(
+            "Starting stats loop: sampling every %ss, reporting every %ss",
+            self.sample_interval,
+            self.stats_interval,
+        )
+        collectors = CollectorSet(self._collector_spec, self.sample_interval, self.logger)
+        next_report = time.monotonic() + self.stats_interval
+        next_processes = time.monotonic() + self.process_interval
+        try:
+            while not self._stop_event.wait(self.sample_interval):
+                sample = collectors.sample()
+                with self._samples_lock:
+                    self._samples.append(sample)
+                if time.monotonic() >= next_report:
+                    next_report = time.monotonic() + self.stats_interval
+                    # Sampling keeps going while a slow acknowledgement is pending.
+                    if self._flush_thread is None or not self._flush_thread.is_alive():
+                        self._flush_thread = threading.Thread(target=self._report_stats, daemon=True, name="stats-flush")
+                        self._flush_thread.start()
+                if self.process_interval and time.monotonic() >= next_processes:
+                    next_processes = time.monotonic() + self.process_interval
+                    if "processes" in self._controller_features:
+                        self._report_processes()
+        finally:
+            collectors.close()
+
+    def _report_stats(self) -> None:
+        if not self._sio.connected:
+            return
+        if "stats_batch" not in self._controller_features:
+            # Older controllers only understand one stats_report per interval.
+            with self._samples_lock:
+                latest = self._samples[-1] if self._samples else None
+                self._samples.clear()
+            if latest is not None:
+                payload = {key: value for key, value in latest.items() if key != "ts"}
+                payload.update({"pi_id": self.pi_id, "active_task": self.active_task, "workers": self._pool.stats()})
+                self._sio.emit("stats_report", payload, namespace=PI_NAMESPACE)
+            return
+        self._flush_stats_batches()
+
+    def _flush_stats_batches(self) -> None:
+        """Ship buffered samples oldest-first, dropping each batch only once acknowledged."""
+        while not self._stop_event.is_set():
+            with self._samples_lock:
+                batch = [self._samples[idx] for idx in range(min(self.batch_size, len(self._samples)))]
+            if not batch:
+                return
             payload = {
                 "pi_id": self.pi_id,
-                "cpu_percent": cpu_percent,
-                "ram_percent": vm_info.percent,
-                "ram_used_gb": used_gb,
-                "ram_total_gb": vm_info.total / (1024**3),
                 "active_task": self.active_task,
+                "workers": self._pool.stats(),
+                "samples": batch,
             }
-            self._sio.emit("stats_report", payload, namespace=PI_NAMESPACE)
+            frame = wire_payload(payload, self._binary_wire)
+            try:
+                reply = self._sio.call("stats_batch", frame, namespace=PI_NAMESPACE, timeout=10)
+            except (socketio.exceptions.TimeoutError, socketio.exceptions.SocketIOError):
+                self.logger.debug("stats_batch not acknowledged; keeping %s samples buffered", len(batch))
+                return
+            if isinstance(reply, dict) and reply.get("error"):
+                if isinstance(frame, bytes):
+                    self.logger.warning("Controller could not read a binary stats batch (%s); using JSON", reply["error"])
+                    self._binary_wire = False
+                    continue
+                self.logger.warning("Controller rejected stats batch: %s", reply["error"])
+            with self._samples_lock:
+                # The sampler may have evicted some of this batch while we waited.
+                for sample in batch:
+                    if self._samples and self._samples[0] is sample:
+                        self._samples.popleft()
 
     def start(self) -> None:
         self.logger.info(
@@ -300,30 +502,82 @@ class PiAgent:
             self.register_only,
         )
         try:
-            self._sio.connect(self.controller_url, namespaces=[PI_NAMESPACE])
+            # WebSocket first: a clustered controller accepts nothing else, and
+            # it saves the long-polling handshake everywhere else.
+            self._sio.connect(self.controller_url, namespaces=[PI_NAMESPACE], transports=["websocket"])
         except socketio.exceptions.ConnectionError:
-            self.logger.error("Unable to connect to %s", self.controller_url)
-            raise SystemExit(1)
+            try:
+                self._sio.connect(self.controller_url, namespaces=[PI_NAMESPACE])
+            except socketio.exceptions.ConnectionError:
+                self.logger.error("Unable to connect to %s", self.controller_url)
+                raise SystemExit(1)
 
         self._stats_thread = threading.Thread(target=self._stats_loop, daemon=True)
         self._stats_thread.start()
 
         try:
-            while not self._stop_event.is_set():
-                time.sleep(0.5)
+            # Block until stop(); Windows only delivers Ctrl+C between timed waits.
+            while not self._stop_event.wait(None if os.name == "posix" else 1.0):
+                pass
         except KeyboardInterrupt:
             self.logger.info("Keyboard interrupt received; shutting down")
             self.stop()
 
     def stop(self) -> None:
         self._stop_event.set()
-        if self._stats_thread and self._stats_thread.is_alive():
-            self._stats_thread.join(timeout=2.0)
+        self._output.stop()
+        for thread in (self._stats_thread, self._flush_thread):
+            if thread and thread.is_alive():
+                thread.join(timeout=2.0)
         if self._sio.connected:
             self._sio.disconnect()
+        self._processes.close()
         self.logger.info("Agent stopped")
 
 
+def register_payload(pi_id: str, label: str, active_task: str) -> Dict[str, Any]:
+    vm_info = psutil.virtual_memory()
+    return {
+        "pi_id": pi_id,
+        "label": label,
+        "ram_total_gb": vm_info.total / (1024**3),
+        "active_task": active_task,
+        "hostname": platform.node(),
+        "platform": platform.platform(),
+        "cpu_count": psutil.cpu_count(),
+    }
+
+
+def wire_payload(payload: Dict[str, Any], binary: bool) -> Any:
+    """``payload`` as a binary_wire frame if ``binary``, otherwise unchanged.
+
+    Frames leave out pi_id, which the controller knows from the session, and
+    payloads the format cannot carry are sent as JSON.
+    """
+    if binary:
+        try:
+            return encode_wire(payload, omit=("pi_id",))
+        except ValueError:
+            pass
+    return payload
+
+
+def _positive_float(value: Any, default: float) -> float:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return default
+    return number if number > 0 else default
+
+
+def _positive_int(value: Any) -> Optional[int]:
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number > 0 else None
+
+
 def _self_event(sio_client: socketio.Client, event_name: str):
     """Decorator factory for class-bound Socket.IO events."""
 
@@ -344,21 +598,73 @@ def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
     parser.add_argument("--pi-id", default=os.environ.get("PISTAT_ID") or platform.node(), help="Unique identifier for this Pi")
     parser.add_argument("--label", default=os.environ.get("PISTAT_LABEL"), help="Friendly label to show in the dashboard")
     parser.add_argument("--interval", type=float, default=float(os.environ.get("PISTAT_INTERVAL", 5.0)), help="Seconds between stats reports (default 5)")
+    parser.add_argument("--sample-interval", type=float, default=float(os.environ.get("PISTAT_SAMPLE_INTERVAL", 1.0)), help="Seconds between local stats samples (default 1)")
+    parser.add_argument("--buffer-size", type=int, default=int(os.environ.get("PISTAT_BUFFER_SIZE", 3600)), help="Samples kept while the controller is unreachable (default 3600)")
+    parser.add_argument("--output-batch-lines", type=int, default=int(os.environ.get("PISTAT_OUTPUT_BATCH_LINES", 100)), help="Max output lines per task/terminal output event (default 100)")
+    parser.add_argument("--output-batch-ms", type=float, default=float(os.environ.get("PISTAT_OUTPUT_BATCH_MS", 100.0)), help="Max milliseconds output waits before being sent (default 100)")
+    parser.add_argument("--max-workers", type=int, default=int(os.environ.get("PISTAT_MAX_WORKERS", 2)), help="Tasks/commands run at the same time (default 2)")
+    parser.add_argument("--max-queue", type=int, default=int(os.environ.get("PISTAT_MAX_QUEUE", 50)), help="Tasks/commands allowed to wait for a worker (default 50)")
+    parser.add_argument("--task-timeout", type=float, default=float(os.environ.get("PISTAT_TASK_TIMEOUT", 300.0)), help="Seconds before a task is killed; 0 disables (default 300)")
+    parser.add_argument("--kill-grace", type=float, default=float(os.environ.get("PISTAT_KILL_GRACE", 5.0)), help="Seconds between SIGTERM and SIGKILL when stopping a task (default 5)")
+    parser.add_argument(
+        "--collectors",
+        default=os.environ.get("PISTAT_COLLECTORS", DEFAULT_COLLECTORS),
+        help=f"Metrics to sample, each optionally with its own interval in seconds, e.g. cpu,memory,net:5,thermal:10 (default {DEFAULT_COLLECTORS})",
+    )
+    parser.add_argument("--process-interval", type=float, default=float(os.environ.get("PISTAT_PROCESS_INTERVAL", 30.0)), help="Seconds between per-core/top-process reports; 0 sends them only on request (default 30)")
+    parser.add_argument("--top-processes", type=int, default=int(os.environ.get("PISTAT_TOP_PROCESSES", 10)), help="Processes reported by CPU and by memory use (default 10)")
+    parser.add_argument(
+        "--wire",
+        choices=["auto", "json"],
+        default=os.environ.get("PISTAT_WIRE", "auto"),
+        help="auto sends stats and output as compact binary frames when the controller supports them (default auto)",
+    )
+    parser.add_argument(
+        "--async",
+        dest="async_mode",
+        action="store_true",
+        default=os.environ.get("PISTAT_ASYNC", "").strip().lower() in {"1", "true", "yes", "on"},
+        help="Run on one asyncio event loop instead of a thread per task (needs aiohttp)",
+    )
     parser.add_argument("--register-only", action="store_true", help="Register with the controller but do not execute tasks")
     parser.add_argument("--log-level", default=os.environ.get("PISTAT_LOGLEVEL", "INFO"), help="Logging level (DEBUG, INFO, WARNING, ERROR)")
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+    try:
+        parse_collectors(args.collectors, 1.0)
+    except ValueError as exc:
+        parser.error(f"--collectors: {exc}")
+    return args
 
 
 def main(argv: Optional[List[str]] = None) -> None:
     args = parse_args(argv)
-    agent = PiAgent(
+    options = dict(
         controller_url=args.controller_url,
         pi_id=args.pi_id,
         label=args.label,
         stats_interval=args.interval,
         register_only=args.register_only,
         log_level=args.log_level,
+        sample_interval=args.sample_interval,
+        buffer_size=args.buffer_size,
+        output_batch_lines=args.output_batch_lines,
+        output_batch_ms=args.output_batch_ms,
+        max_workers=args.max_workers,
+        max_queue=args.max_queue,
+        task_timeout=args.task_timeout,
+        kill_grace=args.kill_grace,
+        collectors=args.collectors,
+        process_interval=args.process_interval,
+        top_processes=args.top_processes,
+        wire=args.wire,
     )
+    if args.async_mode:
+        from pi_agent_async import AsyncPiAgent
+
+        # Installs its own SIGINT/SIGTERM handlers on the event loop.
+        AsyncPiAgent(**options).start()
+        return
+    agent = PiAgent(**options)
 
     def handle_signal(signum, _frame):
         agent.logger.info("Signal %s received; stopping agent", signum)
@@ -0,0 +1,535 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import signal
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional
+
+import socketio
+
+from collectors import DEFAULT_COLLECTORS, CollectorSet, ProcessTable
+from pi_agent import PI_NAMESPACE, _positive_float, _positive_int, register_payload, wire_payload
+from sampling_profiler import SamplingProfiler
+from worker_pool import KILLED_POLL_SECONDS, AsyncWorkerPool, PoolFull, PoolJob, popen_group_kwargs
+from wire import WIRE_FEATURE
+
+
+# Longest line read from a task in one piece; longer lines are dropped and counted as truncated.
+STREAM_LIMIT = 1024 * 1024
+
+
+class AsyncPiAgent:
+    """asyncio version of :class:`pi_agent.PiAgent` (``pi_agent.py --async``).
+
+    The Socket.IO connection, the stats loop and every running task share one
+    event loop: commands are started with asyncio subprocesses and their output
+    is read without blocking, so a running task costs a coroutine instead of a
+    thread. Events, payloads and options are the same as the threaded agent.
+    """
+
+    def __init__(
+        self,
+        controller_url: str,
+        pi_id: str,
+        label: Optional[str],
+        stats_interval: float = 5.0,
+        register_only: bool = False,
+        log_level: str = "INFO",
+        sample_interval: float = 1.0,
+        buffer_size: int = 3600,
+        batch_size: int = 300,
+        output_batch_lines: int = 100,
+        output_batch_ms: float = 100.0,
+        max_line_length: int = 4096,
+        max_workers: int = 2,
+        max_queue: int = 50,
+        task_timeout: float = 300.0,
+        kill_grace: float = 5.0,
+        collectors: str = DEFAULT_COLLECTORS,
+        process_interval: float = 30.0,
+        top_processes: int = 10,
+        wire: str = "auto",
+    ) -> None:
+        self.controller_url = controller_url.rstrip("/")
+        self.pi_id = pi_id
+        self.label = label or pi_id
+        self.stats_interval = max(1.0, stats_interval)
+        self.sample_interval = min(self.stats_interval, max(0.2, sample_interval))
+        self.batch_size = max(1, batch_size)
+        self.output_batch_lines = max(1, output_batch_lines)
+        self.output_batch_delay = max(0.01, output_batch_ms / 1000.0)
+        self.max_line_length = max(1, max_line_length)
+        # Samples not yet acknowledged by the controller; oldest are dropped when full.
+        self._samples: Deque[Dict[str, Any]] = deque(maxlen=max(1, buffer_size))
+        self._collector_spec = collectors
+        self._processes = ProcessTable(top_processes)
+        self.process_interval = max(0.0, process_interval)
+        self._controller_features: List[str] = []
+        self.wire = wire
+        self._binary_wire = False
+        self._pool = AsyncWorkerPool(
+            max_workers, max_queue, name="agent-task", kill_grace=kill_grace, logger=logging.getLogger("pi-agent")
+        )
+        # Samples from its own thread, so it also sees the event loop's stack.
+        self._profiler = SamplingProfiler()
+        self.task_timeout = max(0.0, task_timeout)
+        self.register_only = register_only
+        self.logger = logging.getLogger("pi-agent")
+        self.active_task = "Idle"
+        self._stop_event: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._sio = socketio.AsyncClient(logger=self.logger, engineio_logger=False)
+        self._configure_handlers()
+        logging.basicConfig(
+            level=getattr(logging, log_level.upper(), logging.INFO),
+            format="%(asctime)s %(levelname)s %(message)s",
+            datefmt="%H:%M:%S",
+        )
+
+    def _configure_handlers(self) -> None:
+        handlers = {
+            "connect": self._on_connect,
+            "disconnect": self._on_disconnect,
+            "execute_task": self._handle_execute_task,
+            "execute_terminal": self._handle_terminal_command,
+            "cancel_task": self._handle_cancel_task,
+            "cancel_terminal": self._handle_cancel_terminal,
+            "profile": self._handle_profile,
+            "processes": self._handle_processes,
+        }
+        for event, handler in handlers.items():
+            self._sio.on(event, handler, namespace=PI_NAMESPACE)
+
+    async def _on_connect(self) -> None:
+        self.logger.info("Connected to controller; registering as %s", self.pi_id)
+        self._binary_wire = False
+        payload = register_payload(self.pi_id, self.label, self.active_task)
+        await self._sio.emit("register", payload, namespace=PI_NAMESPACE, callback=self._on_registered)
+
+    async def _on_disconnect(self, *_args: Any) -> None:
+        self.logger.warning("Disconnected from controller")
+
+    def _on_registered(self, reply: Any = None) -> None:
+        if isinstance(reply, dict) and reply.get("error"):
+            self.logger.error("Controller refused registration: %s", reply["error"])
+        features = reply.get("features") if isinstance(reply, dict) else None
+        self._controller_features = [str(item) for item in features] if isinstance(features, list) else []
+        self._binary_wire = self.wire != "json" and WIRE_FEATURE in self._controller_features
+        self.logger.debug("Controller features: %s", self._controller_features or "none")
+
+    async def _handle_execute_task(self, payload: dict) -> None:
+        if self.register_only:
+            self.logger.info("Ignoring task request because agent is in register-only mode")
+            return
+        request_id = (payload or {}).get("request_id")
+        command = (payload or {}).get("command")
+        task_id = (payload or {}).get("task_id")
+        label = (payload or {}).get("label") or task_id or "task"
+        if not request_id:
+            self.logger.error("Task payload missing request_id: %s", payload)
+            return
+        if not isinstance(command, Iterable) or isinstance(command, (str, bytes)):
+            self.logger.error("Task payload has invalid command: %s", payload)
+            await self._emit_task_error(request_id, label, "Invalid command payload")
+            return
+        cmd_list = [str(part) for part in command]
+        try:
+            position = self._pool.submit(
+                request_id,
+                lambda job: self._run_task(job, request_id, task_id or label, label, cmd_list),
+                priority=1,
+                timeout=_positive_float((payload or {}).get("timeout"), self.task_timeout),
+                max_output_bytes=_positive_int((payload or {}).get("max_output_bytes")),
+                on_error=lambda exc: self._emit_task_error(request_id, task_id or label, str(exc)),
+            )
+        except PoolFull:
+            self.logger.warning("Rejecting task %s: queue is full", request_id)
+            await self._emit_task_error(request_id, task_id or label, "Agent task queue is full")
+            return
+        if position:
+            await self._sio.emit(
+                "task_queued",
+                {"request_id": request_id, "task_id": task_id or label, "pi_id": self.pi_id, "position": position},
+                namespace=PI_NAMESPACE,
+            )
+
+    async def _handle_terminal_command(self, payload: dict) -> None:
+        if self.register_only:
+            self.logger.info("Ignoring terminal command because agent is in register-only mode")
+            return
+        request_id = (payload or {}).get("request_id")
+        raw_command = (payload or {}).get("command")
+        if not request_id:
+            self.logger.error("Terminal command missing request_id: %s", payload)
+            return
+        if not raw_command or not isinstance(raw_command, (str, list, tuple)):
+            self.logger.error("Terminal command payload invalid: %s", payload)
+            await self._emit_terminal_error(request_id, "Invalid command payload")
+            return
+        if isinstance(raw_command, (list, tuple)):
+            command_str = " ".join(str(part) for part in raw_command)
+        else:
+            command_str = str(raw_command)
+        self.logger.info("Executing terminal command %s: %s", request_id, command_str)
+        try:
+            position = self._pool.submit(
+                request_id,
+                lambda job: self._run_terminal_command(job, request_id, command_str),
+                priority=0,
+                timeout=_positive_float((payload or {}).get("timeout"), 0.0),
+                on_error=lambda exc: self._emit_terminal_error(request_id, str(exc)),
+            )
+        except PoolFull:
+            self.logger.warning("Rejecting terminal command %s: queue is full", request_id)
+            await self._emit_terminal_error(request_id, "Agent task queue is full")
+            return
+        if position:
+            await self._sio.emit(
+                "terminal_queued",
+                {"request_id": request_id, "pi_id": self.pi_id, "position": position},
+                namespace=PI_NAMESPACE,
+            )
+
+    async def _handle_cancel_task(self, payload: dict) -> None:
+        await self._handle_cancel(payload, terminal=False)
+
+    async def _handle_cancel_terminal(self, payload: dict) -> None:
+        await self._handle_cancel(payload, terminal=True)
+
+    async def _handle_cancel(self, payload: dict, terminal: bool) -> None:
+        request_id = (payload or {}).get("request_id")
+        if not request_id:
+            return
+        state = self._pool.cancel(str(request_id))
+        self.logger.info("Cancel %s: %s", request_id, state or "not found")
+        if state == "queued":
+            if terminal:
+                await self._emit_terminal_error(request_id, "Cancelled")
+            else:
+                await self._emit_task_error(request_id, (payload or {}).get("task_id") or "task", "Cancelled")
+
+    async def _handle_profile(self, payload: dict) -> None:
+        request_id = (payload or {}).get("request_id")
+        if not request_id:
+            return
+        action = str((payload or {}).get("action") or "")
+        # Stopping waits for at most one sampling interval.
+        result = self._profiler.command(action, (payload or {}).get("hz"))
+        self.logger.info("Profiler %s: %s", action, result.get("error") or f"{result.get('samples', 0)} samples")
+        await self._sio.emit(
+            "profile_result",
+            dict(result, request_id=request_id, pi_id=self.pi_id, action=action),
+            namespace=PI_NAMESPACE,
+        )
+
+    async def _handle_processes(self, payload: dict) -> None:
+        await self._report_processes((payload or {}).get("request_id"))
+
+    async def _report_processes(self, request_id: Optional[str] = None) -> None:
+        if not self._sio.connected:
+            return
+        # Walking the process table takes a few milliseconds; keep it off the loop.
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, self._processes.snapshot)
+        payload = dict(snapshot, pi_id=self.pi_id)
+        if request_id:
+            payload["request_id"] = request_id
+        await self._sio.emit("processes_report", payload, namespace=PI_NAMESPACE)
+
+    async def _run_task(self, job: PoolJob, request_id: str, task_id: str, label: str, command: List[str]) -> None:
+        self.logger.info("Running task %s: %s", request_id, " ".join(command))
+        self.active_task = label
+        await self._sio.emit(
+            "task_started",
+            {"request_id": request_id, "task_id": task_id, "pi_id": self.pi_id},
+            namespace=PI_NAMESPACE,
+        )
+        try:
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    limit=STREAM_LIMIT,
+                    **popen_group_kwargs(),
+                )
+            except FileNotFoundError:
+                self.logger.exception("Executable not found for task %s", request_id)
+                await self._emit_task_error(request_id, task_id, "Executable not found")
+                return
+            except Exception as exc:
+                self.logger.exception("Failed to start task %s", request_id)
+                await self._emit_task_error(request_id, task_id, str(exc))
+                return
+            job.attach(process)
+            base = {"request_id": request_id, "task_id": task_id, "pi_id": self.pi_id}
+            try:
+                await self._stream_output(job, process, "task_output", base)
+                exit_code = await self._wait_exit(job, process)
+            except Exception as exc:  # pragma: no cover - runtime safeguard
+                self.logger.exception("Task %s encountered runtime error", request_id)
+                await self._emit_task_error(request_id, task_id, str(exc))
+                return
+            stopped = job.stop_message()
+            if stopped:
+                self.logger.warning("Task %s stopped: %s", request_id, stopped)
+                await self._emit_task_error(request_id, task_id, stopped, exit_code)
+                return
+            await self._sio.emit(
+                "task_finished",
+                {"request_id": request_id, "task_id": task_id, "pi_id": self.pi_id, "exit_code": exit_code},
+                namespace=PI_NAMESPACE,
+            )
+        finally:
+            self.active_task = "Idle"
+
+    async def _emit_task_error(self, request_id: str, task_id: str, message: str, exit_code: int = -1) -> None:
+        await self._sio.emit(
+            "task_error",
+            {
+                "request_id": request_id,
+                "task_id": task_id,
+                "pi_id": self.pi_id,
+                "error": message,
+                "exit_code": exit_code,
+            },
+            namespace=PI_NAMESPACE,
+        )
+
+    async def _run_terminal_command(self, job: PoolJob, request_id: str, command: str) -> None:
+        await self._sio.emit(
+            "terminal_started",
+            {"request_id": request_id, "pi_id": self.pi_id, "command": command},
+            namespace=PI_NAMESPACE,
+        )
+        try:
+            process = await asyncio.create_subprocess_shell(
+                command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                limit=STREAM_LIMIT,
+                **popen_group_kwargs(),
+            )
+        except Exception as exc:  # pragma: no cover - safety
+            self.logger.exception("Failed to start terminal command %s", request_id)
+            await self._emit_terminal_error(request_id, str(exc))
+            return
+        job.attach(process)
+        try:
+            await self._stream_output(job, process, "terminal_output", {"request_id": request_id, "pi_id": self.pi_id})
+            exit_code = await self._wait_exit(job, process)
+        except Exception as exc:  # pragma: no cover - runtime safeguard
+            self.logger.exception("Terminal command %s encountered runtime error", request_id)
+            await self._emit_terminal_error(request_id, str(exc))
+            return
+        stopped = job.stop_message()
+        if stopped:
+            await self._emit_terminal_error(request_id, stopped, exit_code)
+            return
+        await self._sio.emit(
+            "terminal_finished",
+            {"request_id": request_id, "pi_id": self.pi_id, "exit_code": exit_code},
+            namespace=PI_NAMESPACE,
+        )
+
+    async def _emit_terminal_error(self, request_id: str, message: str, exit_code: int = -1) -> None:
+        await self._sio.emit(
+            "terminal_error",
+            {"request_id": request_id, "pi_id": self.pi_id, "error": message, "exit_code": exit_code},
+            namespace=PI_NAMESPACE,
+        )
+
+    async def _stream_output(self, job: PoolJob, process: Any, event: str, base: Dict[str, Any]) -> None:
+        """Read ``process`` stdout line by line and send it in batches, like :class:`OutputBatcher`.
+
+        A batch is sent when it holds ``output_batch_lines`` lines or its first
+        line is ``output_batch_ms`` old. Sending is awaited, so a slow link
+        slows reading instead of buffering without bound.
+        """
+        loop = asyncio.get_running_loop()
+        stdout = process.stdout
+        lines: List[str] = []
+        truncated = 0
+        deadline = 0.0
+
+        async def flush() -> None:
+            nonlocal lines, truncated
+            if not lines:
+                return
+            payload = dict(base, lines=lines)
+            if truncated:
+                payload["truncated"] = truncated
+            lines, truncated = [], 0
+            await self._emit_output(event, payload)
+
+        while True:
+            try:
+                if lines:
+                    raw = await asyncio.wait_for(stdout.readline(), max(0.0, deadline - loop.time()))
+                else:
+                    raw = await asyncio.wait_for(stdout.readline(), KILLED_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                # A process that left the killed group may hold the pipe open.
+                if job.killed:
+                    break
+                await flush()
+                continue
+            except ValueError:
+                # Longer than STREAM_LIMIT; the reader has already discarded it.
+                truncated += 1
+                continue
+            if not raw:
+                job.output_ended()
+                break
+            # Keep draining after a stop so the child never blocks on a full pipe.
+            if not job.count_output(len(raw)):
+                continue
+            line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            if not line:
+                continue
+            if len(line) > self.max_line_length:
+                line = line[: self.max_line_length]
+                truncated += 1
+            if not lines:
+                deadline = loop.time() + self.output_batch_delay
+            lines.append(line)
+            if len(lines) >= self.output_batch_lines:
+                await flush()
+        await flush()
+
+    async def _wait_exit(self, job: PoolJob, process: Any) -> Optional[int]:
+        """The exit code of ``process`` once it has been reaped.
+
+        Process.wait() also waits for the output pipe to close, which a process
+        that left a killed group may never do.
+        """
+        if not job.killed:
+            return await process.wait()
+        while process.returncode is None:
+            await asyncio.sleep(KILLED_POLL_SECONDS)
+        return process.returncode
+
+    async def _emit_output(self, event: str, payload: Dict[str, Any]) -> None:
+        """Send a batched output event, expanding it for controllers without batching."""
+        if not self._sio.connected:
+            return
+        if "output_batch" in self._controller_features:
+            await self._sio.emit(event, wire_payload(payload, self._binary_wire), namespace=PI_NAMESPACE)
+            return
+        base = {key: value for key, value in payload.items() if key not in {"lines", "dropped", "truncated"}}
+        for line in payload["lines"]:
+            await self._sio.emit(event, dict(base, line=line), namespace=PI_NAMESPACE)
+
+    async def _stats_loop(self) -> None:
+        assert self._stop_event is not None
+        self.logger.info(
+            "Starting stats loop: sampling every %ss, reporting every %ss",
+            self.sample_interval,
+            self.stats_interval,
+        )
+        # Collectors reread /proc with pread, which never blocks the loop for long.
+        collectors = CollectorSet(self._collector_spec, self.sample_interval, self.logger)
+        loop = asyncio.get_running_loop()
+        next_report = loop.time() + self.stats_interval
+        next_processes = loop.time() + self.process_interval
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), self.sample_interval)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+                self._samples.append(collectors.sample())
+                if loop.time() >= next_report:
+                    next_report = loop.time() + self.stats_interval
+                    # Sampling keeps going while a slow acknowledgement is pending.
+                    if self._flush_task is None or self._flush_task.done():
+                        self._flush_task = loop.create_task(self._report_stats())
+                if self.process_interval and loop.time() >= next_processes:
+                    next_processes = loop.time() + self.process_interval
+                    if "processes" in self._controller_features:
+                        await self._report_processes()
+        finally:
+            collectors.close()
+
+    async def _report_stats(self) -> None:
+        if not self._sio.connected:
+            return
+        if "stats_batch" not in self._controller_features:
+            # Older controllers only understand one stats_report per interval.
+            latest = self._samples[-1] if self._samples else None
+            self._samples.clear()
+            if latest is not None:
+                payload = {key: value for key, value in latest.items() if key != "ts"}
+                payload.update({"pi_id": self.pi_id, "active_task": self.active_task, "workers": self._pool.stats()})
+                await self._sio.emit("stats_report", payload, namespace=PI_NAMESPACE)
+            return
+        while self._samples and not (self._stop_event and self._stop_event.is_set()):
+            batch = [self._samples[idx] for idx in range(min(self.batch_size, len(self._samples)))]
+            payload = {
+                "pi_id": self.pi_id,
+                "active_task": self.active_task,
+                "workers": self._pool.stats(),
+                "samples": batch,
+            }
+            frame = wire_payload(payload, self._binary_wire)
+            try:
+                reply = await self._sio.call("stats_batch", frame, namespace=PI_NAMESPACE, timeout=10)
+            except (socketio.exceptions.TimeoutError, socketio.exceptions.SocketIOError):
+                self.logger.debug("stats_batch not acknowledged; keeping %s samples buffered", len(batch))
+                return
+            if isinstance(reply, dict) and reply.get("error"):
+                if isinstance(frame, bytes):
+                    self.logger.warning("Controller could not read a binary stats batch (%s); using JSON", reply["error"])
+                    self._binary_wire = False
+                    continue
+                self.logger.warning("Controller rejected stats batch: %s", reply["error"])
+            # The sampler may have evicted some of this batch while we waited.
+            for sample in batch:
+                if self._samples and self._samples[0] is sample:
+                    self._samples.popleft()
+
+    async def run(self) -> None:
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):  # pragma: no cover - Windows / not main thread
+                pass
+        self.logger.info(
+            "Connecting to %s as %s (register-only=%s, async)",
+            self.controller_url,
+            self.pi_id,
+            self.register_only,
+        )
+        try:
+            # WebSocket first: a clustered controller accepts nothing else, and
+            # it saves the long-polling handshake everywhere else.
+            await self._sio.connect(self.controller_url, namespaces=[PI_NAMESPACE], transports=["websocket"])
+        except socketio.exceptions.ConnectionError:
+            try:
+                await self._sio.connect(self.controller_url, namespaces=[PI_NAMESPACE])
+            except socketio.exceptions.ConnectionError:
+                self.logger.error("Unable to connect to %s", self.controller_url)
+                raise SystemExit(1)
+        stats = loop.create_task(self._stats_loop())
+        try:
+            await self._stop_event.wait()
+        finally:
+            self._stop_event.set()
+            await stats
+            if self._sio.connected:
+                await self._sio.disconnect()
+            self._processes.close()
+            self.logger.info("Agent stopped")
+
+    def start(self) -> None:
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            self.logger.info("Keyboard interrupt received; shutting down")
+
+    def stop(self) -> None:
+        if self._stop_event is not None:
+            self._stop_event.set()
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import _thread
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Samples per second when none is requested, and the accepted range.
+DEFAULT_HZ = 100.0
+MIN_HZ = 1.0
+MAX_HZ = 1000.0
+
+
+def _native_thread_api() -> Tuple[Callable[..., Any], Callable[[], int], Callable[[float], None], Callable[[], Any], bool]:
+    """start_new_thread, get_ident, sleep and allocate_lock that bypass gevent's monkey-patching.
+
+    Under gevent the sampler has to be a real OS thread: a greenlet would only
+    ever see itself running. The last item says whether ``threading`` may be
+    used from that thread to look up thread names (not under gevent).
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        monkey = None
+    if monkey is not None and monkey.is_module_patched("threading"):  # pragma: no cover - gevent mode
+        return (
+            monkey.get_original("_thread", "start_new_thread"),
+            monkey.get_original("_thread", "get_ident"),
+            monkey.get_original("time", "sleep"),
+            monkey.get_original("_thread", "allocate_lock"),
+            False,
+        )
+    return _thread.start_new_thread, _thread.get_ident, time.sleep, _thread.allocate_lock, True
+
+
+class SamplingProfiler:
+    """Statistical profiler that samples every thread's stack from a background thread.
+
+    While running, a sampler thread reads ``sys._current_frames()`` ``hz``
+    times per second and counts each distinct stack. :meth:`stop` returns the
+    counts as collapsed stacks (``thread;outer;...;inner count`` per line), the
+    format flamegraph.pl, speedscope and similar tools read. Frames are
+    identified by function, not line, so samples of one function aggregate.
+
+    At most ``max_stacks`` distinct stacks are kept; samples of new stacks
+    beyond that are counted as ``dropped``. Sampling stops by itself after
+    ``max_seconds`` and the results wait for :meth:`stop`, which returns the
+    busiest stacks that fit in ``max_output_bytes`` (Socket.IO drops larger
+    messages) and counts the rest as ``omitted``.
+    """
+
+    def __init__(
+        self,
+        max_stacks: int = 20000,
+        max_depth: int = 128,
+        max_seconds: float = 600.0,
+        max_output_bytes: int = 512 * 1024,
+    ) -> None:
+        self.max_stacks = max(1, max_stacks)
+        self.max_depth = max(1, max_depth)
+        self.max_seconds = max(1.0, max_seconds)
+        self.max_output_bytes = max(1024, max_output_bytes)
+        self._start_thread, self._get_ident, self._sleep, allocate_lock, self._thread_names = _native_thread_api()
+        self._lock = allocate_lock()
+        self._counts: Counter = Counter()
+        self._samples = 0
+        self._dropped = 0
+        self._hz = DEFAULT_HZ
+        self._started = 0.0
+        self._finished: Optional[float] = None
+        self._running = False
+        # Held by the sampler thread for as long as it runs.
+        self._done = allocate_lock()
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def command(self, action: str, hz: Any = None) -> Dict[str, Any]:
+        """Handle a ``start``/``stop``/``status`` request from the dashboard."""
+        if action == "start":
+            if self._running:
+                return {"error": "Profiler is already running.", **self.status()}
+            try:
+                rate = float(hz) if hz not in (None, "") else DEFAULT_HZ
+            except (TypeError, ValueError):
+                return {"error": "Sample rate must be a number."}
+            return self.start(rate)
+        if action == "stop":
+            if not self._running and not self._samples:
+                return {"error": "Profiler is not running."}
+            return self.stop()
+        if action == "status":
+            return self.status()
+        return {"error": f"Unknown profiler action '{action}'."}
+
+    def start(self, hz: float = DEFAULT_HZ) -> Dict[str, Any]:
+        # Also waits out a sampler that is still finishing its last sample.
+        self._done.acquire()
+        with self._lock:
+            if self._running:
+                self._done.release()
+                return self._status_locked()
+            self._hz = min(MAX_HZ, max(MIN_HZ, hz))
+            self._counts = Counter()
+            self._samples = 0
+            self._dropped = 0
+            self._started = time.monotonic()
+            self._finished = None
+            self._running = True
+        self._start_thread(self._run, ())
+        return self.status()
+
+    def stop(self) -> Dict[str, Any]:
+        """Stop sampling (if still running) and return the collapsed stacks."""
+        self._running = False
+        # Wait for the sampler to finish its current sample.
+        self._done.acquire()
+        self._done.release()
+        with self._lock:
+            result = self._status_locked()
+            counts = self._counts
+            self._counts = Counter()
+            self._samples = 0
+            self._dropped = 0
+        lines: List[str] = []
+        size = 0
+        omitted = 0
+        for stack, count in _collapse(counts):
+            line = f"{stack} {count}"
+            size += len(line) + 1
+            if size > self.max_output_bytes:
+                omitted += 1
+                continue
+            lines.append(line)
+        result["stacks"] = "\n".join(lines)
+        result["omitted"] = omitted
+        return result
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return self._status_locked()
+
+    def _status_locked(self) -> Dict[str, Any]:
+        end = self._finished if self._finished is not None else time.monotonic()
+        return {
+            "running": self._running,
+            "hz": self._hz,
+            "seconds": round(end - self._started, 3) if self._started else 0.0,
+            "samples": self._samples,
+            "stacks_seen": len(self._counts),
+            "dropped": self._dropped,
+        }
+
+    def _run(self) -> None:
+        own = self._get_ident()
+        interval = 1.0 / self._hz
+        deadline = self._started + self.max_seconds
+        next_sample = time.monotonic()
+        try:
+            while self._running and time.monotonic() < deadline:
+                self._sample(own)
+                next_sample += interval
+                delay = next_sample - time.monotonic()
+                if delay > 0:
+                    self._sleep(delay)
+                else:
+                    # Fell behind (GIL contention); skip the missed ticks.
+                    next_sample = time.monotonic()
+        finally:
+            with self._lock:
+                self._running = False
+                self._finished = time.monotonic()
+            self._done.release()
+
+    def _sample(self, own: int) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()} if self._thread_names else {}
+        stacks: List[Tuple[Any, ...]] = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            codes = []
+            while frame is not None and len(codes) < self.max_depth:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes.append(names.get(ident) or f"thread-{ident}")
+            # Root first, as collapsed stacks expect.
+            stacks.append(tuple(reversed(codes)))
+        with self._lock:
+            self._samples += 1
+            for stack in stacks:
+                if stack in self._counts or len(self._counts) < self.max_stacks:
+                    self._counts[stack] += 1
+                else:
+                    self._dropped += 1
+
+
+def _collapse(counts: Counter) -> List[Tuple[str, int]]:
+    """Render counted stacks (thread name, then code objects) busiest first."""
+    labels: Dict[Any, str] = {}
+
+    def label(code: Any) -> str:
+        text = labels.get(code)
+        if text is None:
+            text = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            # Semicolons separate frames.
+            text = labels[code] = text.replace(";", ":")
+        return text
+
+    rendered: Counter = Counter()
+    for stack, count in counts.items():
+        thread, codes = stack[0], stack[1:]
+        frames = [str(thread).replace(";", ":")] + [label(code) for code in codes]
+        rendered[";".join(frames)] += count
+    return rendered.most_common()
@@ -0,0 +1,620 @@
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from pathlib import Path
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Deque, Dict, List, Optional, Protocol, Sequence, Tuple
+
+logger = logging.getLogger("pistat-state")
+
+# Another connection holds the database; the whole batch is retried later.
+_BUSY_CODES = {getattr(sqlite3, "SQLITE_BUSY", 5), getattr(sqlite3, "SQLITE_LOCKED", 6)}
+
+
+def _is_busy(exc: sqlite3.Error) -> bool:
+    code = getattr(exc, "sqlite_errorcode", None)
+    if code is not None:
+        # Extended codes (e.g. SQLITE_BUSY_SNAPSHOT) keep the primary code in the low byte.
+        return (code & 0xFF) in _BUSY_CODES
+    return isinstance(exc, sqlite3.OperationalError) and ("locked" in str(exc) or "busy" in str(exc))
+
+
+class StateMapping(Protocol):
+    """Per-Pi string values (labels, assigned tasks) as used by ``PiRegistry``."""
+
+    def get(self, pi_id: str) -> Optional[str]: ...
+
+    def has(self, pi_id: str) -> bool: ...
+
+    def set(self, pi_id: str, value: Optional[str]) -> None: ...
+
+    def remove(self, pi_id: str) -> None: ...
+
+
+class JsonStateWriter:
+    """Write-behind persistence for a JSON state file.
+
+    Stores call :meth:`mark_dirty` after changing their in-memory data. A
+    background thread waits ``interval`` seconds after the first change, takes
+    one snapshot and replaces the file atomically, so a burst of changes costs a
+    single write. With ``fsync`` the data is flushed to disk before the rename.
+    Pending changes are written on :meth:`close`, which runs at interpreter exit.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        snapshot: Callable[[], Dict[str, Any]],
+        interval: float = 0.25,
+        fsync: bool = True,
+    ) -> None:
+        self._path = path
+        self._snapshot = snapshot
+        self._interval = max(0.01, interval)
+        self._fsync = fsync
+        self._cond = Condition()
+        self._dirty = False
+        self._closed = False
+        # Serializes writers so a final close() flush never races the thread.
+        self._write_lock = Lock()
+        Thread(target=self._run, daemon=True, name=f"state-writer-{path.stem}").start()
+        atexit.register(self.close)
+
+    def mark_dirty(self) -> None:
+        with self._cond:
+            if not self._dirty:
+                self._dirty = True
+                self._cond.notify()
+
+    def flush(self) -> None:
+        with self._write_lock:
+            with self._cond:
+                if not self._dirty:
+                    return
+                self._dirty = False
+            self._write(self._snapshot())
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self.flush()
+
+    def _write(self, data: Dict[str, Any]) -> None:
+        tmp_path = self._path.with_suffix(".tmp")
+        text = json.dumps(data, indent=2, sort_keys=True)
+        try:
+            with tmp_path.open("w", encoding="utf-8") as handle:
+                handle.write(text)
+                if self._fsync:
+                    handle.flush()
+                    os.fsync(handle.fileno())
+            tmp_path.replace(self._path)
+        except OSError:
+            # Best-effort persistence; keep in-memory state even if disk write fails.
+            pass
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._dirty and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            time.sleep(self._interval)
+            self.flush()
+
+
+class LabelStore:
+    """Minimal JSON-backed storage for Pi labels."""
+
+    def __init__(self, storage_path: Path, flush_interval: float = 0.25, fsync: bool = True) -> None:
+        self._path = storage_path
+        self._lock = Lock()
+        self._labels: Dict[str, str] = {}
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._load()
+        self._writer = JsonStateWriter(self._path, self._copy, flush_interval, fsync)
+
+    def _load(self) -> None:
+        if not self._path.exists():
+            self._labels = {}
+            return
+        try:
+            raw = self._path.read_text(encoding="utf-8")
+            self._labels = json.loads(raw) if raw else {}
+            if not isinstance(self._labels, dict):
+                self._labels = {}
+        except (OSError, json.JSONDecodeError):
+            self._labels = {}
+
+    def _copy(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._labels)
+
+    def _save(self) -> None:
+        self._writer.mark_dirty()
+
+    def flush(self) -> None:
+        self._writer.flush()
+
+    def get(self, pi_id: str) -> Optional[str]:
+        with self._lock:
+            return self._labels.get(pi_id)
+
+    def has(self, pi_id: str) -> bool:
+        with self._lock:
+            return pi_id in self._labels
+
+    def set(self, pi_id: str, label: str) -> None:
+        with self._lock:
+            self._labels[pi_id] = label
+            self._save()
+
+    def remove(self, pi_id: str) -> None:
+        with self._lock:
+            if pi_id in self._labels:
+                self._labels.pop(pi_id)
+                self._save()
+
+
+class TaskStore:
+    """JSON-backed storage for operator-assigned task labels."""
+
+    def __init__(self, storage_path: Path, flush_interval: float = 0.25, fsync: bool = True) -> None:
+        self._path = storage_path
+        self._lock = Lock()
+        self._tasks: Dict[str, str] = {}
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._load()
+        self._writer = JsonStateWriter(self._path, self._copy, flush_interval, fsync)
+
+    def _load(self) -> None:
+        if not self._path.exists():
+            self._tasks = {}
+            return
+        try:
+            raw = self._path.read_text(encoding="utf-8")
+            data = json.loads(raw) if raw else {}
+            if isinstance(data, dict):
+                self._tasks = {str(k): str(v) for k, v in data.items()}
+            else:
+                self._tasks = {}
+        except (OSError, json.JSONDecodeError):
+            self._tasks = {}
+
+    def _copy(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._tasks)
+
+    def _save(self) -> None:
+        self._writer.mark_dirty()
+
+    def flush(self) -> None:
+        self._writer.flush()
+
+    def get(self, pi_id: str) -> Optional[str]:
+        with self._lock:
+            return self._tasks.get(pi_id)
+
+    def has(self, pi_id: str) -> bool:
+        with self._lock:
+            return pi_id in self._tasks
+
+    def set(self, pi_id: str, task_label: Optional[str]) -> None:
+        with self._lock:
+            if task_label is None:
+                self._tasks.pop(pi_id, None)
+            else:
+                value = str(task_label).strip()
+                if value:
+                    self._tasks[pi_id] = value
+                else:
+                    self._tasks.pop(pi_id, None)
+            self._save()
+
+    def remove(self, pi_id: str) -> None:
+        self.set(pi_id, None)
+
+
+class JsonStateBackend:
+    """State kept in ``labels.json``/``tasks.json``/``schedules.json``.
+
+    Task run history and agent inventory are only kept in memory (the last
+    ``history_limit`` runs) with this backend.
+    """
+
+    def __init__(
+        self,
+        state_dir: Path,
+        flush_interval: float = 0.25,
+        fsync: bool = True,
+        history_limit: int = 1000,
+    ) -> None:
+        self.labels = LabelStore(state_dir / "labels.json", flush_interval, fsync)
+        self.tasks = TaskStore(state_dir / "tasks.json", flush_interval, fsync)
+        self._lock = Lock()
+        self._runs: Deque[Dict[str, Any]] = deque(maxlen=max(1, history_limit))
+        self._inventory: Dict[str, Dict[str, Any]] = {}
+        self._schedules_path = state_dir / "schedules.json"
+        self._schedules: Dict[str, Dict[str, Any]] = {}
+        try:
+            data = json.loads(self._schedules_path.read_text(encoding="utf-8") or "{}")
+            if isinstance(data, dict):
+                self._schedules = {str(key): value for key, value in data.items() if isinstance(value, dict)}
+        except (OSError, json.JSONDecodeError):
+            pass
+        self._schedule_writer = JsonStateWriter(self._schedules_path, self._copy_schedules, flush_interval, fsync)
+
+    def _copy_schedules(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {key: dict(value) for key, value in self._schedules.items()}
+
+    def load_schedules(self) -> List[Dict[str, Any]]:
+        return list(self._copy_schedules().values())
+
+    def save_schedule(self, schedule_id: str, spec: Dict[str, Any]) -> None:
+        with self._lock:
+            self._schedules[schedule_id] = dict(spec)
+        self._schedule_writer.mark_dirty()
+
+    def delete_schedule(self, schedule_id: str) -> None:
+        with self._lock:
+            self._schedules.pop(schedule_id, None)
+        self._schedule_writer.mark_dirty()
+
+    def record_task_run(self, run: Dict[str, Any]) -> None:
+        with self._lock:
+            for existing in self._runs:
+                if existing["request_id"] == run["request_id"]:
+                    _merge_run(existing, run)
+                    return
+            self._runs.append(_normalize_run(run))
+
+    def task_runs(
+        self,
+        pi_id: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 100,
+    ) -> List[Dict[str, Any]]:
+        with self._lock:
+            runs = [
+                dict(run)
+                for run in reversed(self._runs)
+                if (pi_id is None or run["pi_id"] == pi_id)
+                and (since is None or run["finished"] >= since)
+                and (until is None or run["finished"] < until)
+            ]
+        return runs[: max(1, limit)]
+
+    def update_inventory(self, pi_id: str, info: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            entry = self._inventory.setdefault(pi_id, {"pi_id": pi_id, "first_seen": now, "info": {}})
+            entry["last_seen"] = now
+            entry["info"] = dict(info)
+
+    def inventory(self, pi_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            if pi_id:
+                entries = [self._inventory[pi_id]] if pi_id in self._inventory else []
+            else:
+                entries = list(self._inventory.values())
+            return [dict(entry, info=dict(entry["info"])) for entry in entries]
+
+    def flush(self) -> None:
+        self.labels.flush()
+        self.tasks.flush()
+        self._schedule_writer.flush()
+
+    def close(self) -> None:
+        self.flush()
+
+
+def _normalize_run(run: Dict[str, Any]) -> Dict[str, Any]:
+    finished = float(run.get("finished") or time.time())
+    started = run.get("started")
+    return {
+        "request_id": str(run["request_id"]),
+        "pi_id": str(run.get("pi_id") or "unknown"),
+        "task_id": run.get("task_id"),
+        "exit_code": run.get("exit_code"),
+        "error": run.get("error"),
+        "started": started,
+        "finished": finished,
+        "duration": finished - float(started) if started is not None else None,
+    }
+
+
+def _merge_run(existing: Dict[str, Any], run: Dict[str, Any]) -> None:
+    # A failed run reports task_error then task_finished; keep the error text.
+    update = _normalize_run(run)
+    if update["error"] is None:
+        update["error"] = existing.get("error")
+    existing.update(update)
+
+
+class SqliteMapping:
+    """Cached view of one key/value table in :class:`SqliteStateBackend`.
+
+    The whole table is read when the mapping is created, so lookups never
+    touch the database (callers such as ``PiRegistry`` hold locks around
+    them). Writes update the cache immediately and are queued for the
+    backend's next batched transaction.
+    """
+
+    def __init__(self, backend: "SqliteStateBackend", table: str, column: str) -> None:
+        self._backend = backend
+        self._values: Dict[str, str] = {
+            str(pi_id): str(value) for pi_id, value in backend.fetchall(f"SELECT pi_id, {column} FROM {table}", ())
+        }
+        self._lock = Lock()
+        self._upsert = (
+            f"INSERT INTO {table} (pi_id, {column}) VALUES (?, ?) "
+            f"ON CONFLICT(pi_id) DO UPDATE SET {column} = excluded.{column}"
+        )
+        self._delete = f"DELETE FROM {table} WHERE pi_id = ?"
+
+    def get(self, pi_id: str) -> Optional[str]:
+        with self._lock:
+            return self._values.get(pi_id)
+
+    def has(self, pi_id: str) -> bool:
+        with self._lock:
+            return pi_id in self._values
+
+    def set(self, pi_id: str, value: Optional[str]) -> None:
+        text = str(value).strip() if value is not None else ""
+        with self._lock:
+            if text:
+                self._values[pi_id] = text
+                self._backend.queue(self._upsert, (pi_id, text))
+            else:
+                self._values.pop(pi_id, None)
+                self._backend.queue(self._delete, (pi_id,))
+
+    def remove(self, pi_id: str) -> None:
+        self.set(pi_id, None)
+
+    def cache(self, pi_id: str, value: Optional[str]) -> None:
+        """Update the cache for a value another process has already written."""
+        text = str(value).strip() if value is not None else ""
+        with self._lock:
+            if text:
+                self._values[pi_id] = text
+            else:
+                self._values.pop(pi_id, None)
+
+
+class SqliteStateBackend:
+    """State kept in a SQLite database (WAL mode) at ``path``.
+
+    Holds labels, assigned tasks, task run history, agent inventory and task
+    schedules. Writes
+    are queued and committed together in one transaction every ``flush_interval``
+    seconds by a background thread; history queries flush first and then run
+    against the ``(pi_id, finished)`` / ``finished`` indexes, so run history is
+    never loaded into memory. Labels and assigned tasks are small and are read
+    once at startup. On first use the legacy ``labels.json`` and
+    ``tasks.json`` next to the database are imported.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS labels (pi_id TEXT PRIMARY KEY, label TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS tasks (pi_id TEXT PRIMARY KEY, task TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS task_runs ("
+        " request_id TEXT PRIMARY KEY, pi_id TEXT NOT NULL, task_id TEXT, exit_code INTEGER,"
+        " error TEXT, started REAL, finished REAL NOT NULL, duration REAL)",
+        "CREATE INDEX IF NOT EXISTS task_runs_pi_finished ON task_runs (pi_id, finished)",
+        "CREATE INDEX IF NOT EXISTS task_runs_finished ON task_runs (finished)",
+        "CREATE TABLE IF NOT EXISTS inventory ("
+        " pi_id TEXT PRIMARY KEY, first_seen REAL NOT NULL, last_seen REAL NOT NULL, info TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS inventory_last_seen ON inventory (last_seen)",
+        "CREATE TABLE IF NOT EXISTS schedules (schedule_id TEXT PRIMARY KEY, spec TEXT NOT NULL)",
+    )
+    INSERT_RUN = (
+        "INSERT INTO task_runs (request_id, pi_id, task_id, exit_code, error, started, finished, duration)"
+        " VALUES (:request_id, :pi_id, :task_id, :exit_code, :error, :started, :finished, :duration)"
+        " ON CONFLICT(request_id) DO UPDATE SET exit_code = excluded.exit_code,"
+        " error = COALESCE(excluded.error, task_runs.error), finished = excluded.finished,"
+        " duration = excluded.duration"
+    )
+    UPSERT_INVENTORY = (
+        "INSERT INTO inventory (pi_id, first_seen, last_seen, info) VALUES (?, ?, ?, ?)"
+        " ON CONFLICT(pi_id) DO UPDATE SET last_seen = excluded.last_seen, info = excluded.info"
+    )
+
+    def __init__(self, path: Path, flush_interval: float = 0.25, fsync: bool = True) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._path = path
+        self._interval = max(0.01, flush_interval)
+        # One connection shared by all threads; statements are cached by sqlite3.
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, cached_statements=64)
+        self._db_lock = Lock()
+        self._cond = Condition()
+        self._pending: List[Tuple[str, Sequence[Any]]] = []
+        self._closed = False
+        with self._db_lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+        self._import_json(path.parent)
+        self.labels = SqliteMapping(self, "labels", "label")
+        self.tasks = SqliteMapping(self, "tasks", "task")
+        Thread(target=self._run, daemon=True, name="state-sqlite").start()
+        atexit.register(self.close)
+
+    def _import_json(self, state_dir: Path) -> None:
+        for table, column, filename in (("labels", "label", "labels.json"), ("tasks", "task", "tasks.json")):
+            source = state_dir / filename
+            if not source.exists() or self.fetchone(f"SELECT 1 FROM {table} LIMIT 1", ()):
+                continue
+            try:
+                data = json.loads(source.read_text(encoding="utf-8") or "{}")
+            except (OSError, json.JSONDecodeError):
+                continue
+            if not isinstance(data, dict):
+                continue
+            rows = [(str(key), str(value)) for key, value in data.items() if str(value).strip()]
+            with self._db_lock:
+                self._conn.execute("BEGIN")
+                self._conn.executemany(f"INSERT OR IGNORE INTO {table} (pi_id, {column}) VALUES (?, ?)", rows)
+                self._conn.execute("COMMIT")
+
+    def queue(self, sql: str, params: Sequence[Any]) -> None:
+        with self._cond:
+            self._pending.append((sql, params))
+            if len(self._pending) == 1:
+                self._cond.notify()
+
+    def fetchone(self, sql: str, params: Sequence[Any]) -> Optional[Tuple[Any, ...]]:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params: Any) -> List[Tuple[Any, ...]]:
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def flush(self) -> None:
+        with self._db_lock:
+            with self._cond:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                self._conn.execute("BEGIN")
+                for sql, params in pending:
+                    # A savepoint per statement lets one bad write fail alone.
+                    self._conn.execute("SAVEPOINT write")
+                    try:
+                        self._conn.execute(sql, params)
+                    except sqlite3.Error as exc:
+                        if _is_busy(exc):
+                            raise
+                        self._conn.execute("ROLLBACK TO write")
+                        logger.error("Dropping state write %s %r: %s", sql.split(" (", 1)[0], params, exc)
+                    self._conn.execute("RELEASE write")
+                self._conn.execute("COMMIT")
+            except sqlite3.Error as exc:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                if not _is_busy(exc) or self._closed:
+                    # In-memory caches keep serving the new values until restart.
+                    logger.error("Could not write %d state changes: %s", len(pending), exc)
+                    return
+                logger.warning("State database is busy (%s); retrying %d changes", exc, len(pending))
+                with self._cond:
+                    self._pending[:0] = pending
+                    self._cond.notify()
+
+    def close(self) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self.flush()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            time.sleep(self._interval)
+            self.flush()
+
+    def record_task_run(self, run: Dict[str, Any]) -> None:
+        self.queue(self.INSERT_RUN, _normalize_run(run))
+
+    def task_runs(
+        self,
+        pi_id: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 100,
+    ) -> List[Dict[str, Any]]:
+        self.flush()
+        clauses: List[str] = []
+        params: List[Any] = []
+        if pi_id is not None:
+            clauses.append("pi_id = ?")
+            params.append(pi_id)
+        if since is not None:
+            clauses.append("finished >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("finished < ?")
+            params.append(until)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(max(1, int(limit)))
+        rows = self.fetchall(
+            "SELECT request_id, pi_id, task_id, exit_code, error, started, finished, duration"
+            f" FROM task_runs{where} ORDER BY finished DESC LIMIT ?",
+            params,
+        )
+        keys = ("request_id", "pi_id", "task_id", "exit_code", "error", "started", "finished", "duration")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def update_inventory(self, pi_id: str, info: Dict[str, Any]) -> None:
+        now = time.time()
+        self.queue(self.UPSERT_INVENTORY, (pi_id, now, now, json.dumps(info, sort_keys=True, default=str)))
+
+    def inventory(self, pi_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        self.flush()
+        sql = "SELECT pi_id, first_seen, last_seen, info FROM inventory"
+        rows = self.fetchall(sql + " WHERE pi_id = ?", (pi_id,)) if pi_id else self.fetchall(sql + " ORDER BY pi_id", ())
+        result: List[Dict[str, Any]] = []
+        for key, first_seen, last_seen, info in rows:
+            try:
+                decoded = json.loads(info)
+            except json.JSONDecodeError:
+                decoded = {}
+            result.append({"pi_id": key, "first_seen": first_seen, "last_seen": last_seen, "info": decoded})
+        return result
+
+    def load_schedules(self) -> List[Dict[str, Any]]:
+        self.flush()
+        schedules: List[Dict[str, Any]] = []
+        for (spec,) in self.fetchall("SELECT spec FROM schedules ORDER BY schedule_id", ()):
+            try:
+                decoded = json.loads(spec)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(decoded, dict):
+                schedules.append(decoded)
+        return schedules
+
+    def save_schedule(self, schedule_id: str, spec: Dict[str, Any]) -> None:
+        self.queue(
+            "INSERT INTO schedules (schedule_id, spec) VALUES (?, ?)"
+            " ON CONFLICT(schedule_id) DO UPDATE SET spec = excluded.spec",
+            (schedule_id, json.dumps(spec, sort_keys=True)),
+        )
+
+    def delete_schedule(self, schedule_id: str) -> None:
+        self.queue("DELETE FROM schedules WHERE schedule_id = ?", (schedule_id,))
+
+
+def open_state_backend(
+    kind: str,
+    state_dir: Path,
+    flush_interval: float = 0.25,
+    fsync: bool = True,
+) -> Any:
+    """Create the state backend named ``kind`` ("sqlite" or "json")."""
+    kind = (kind or "sqlite").strip().lower()
+    if kind == "json":
+        return JsonStateBackend(state_dir, flush_interval, fsync)
+    if kind == "sqlite":
+        return SqliteStateBackend(state_dir / "state.db", flush_interval, fsync)
+    raise ValueError(f"Unknown state backend '{kind}' (expected 'sqlite' or 'json').")
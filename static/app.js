@@ -5,11 +5,16 @@ document.addEventListener('DOMContentLoaded', () => {
   const terminal = document.getElementById('terminal-output');
   const logList = document.getElementById('log-list');
   console.log('app.js: found', buttons.length, 'buttons and', panels.length, 'panels');
-  const socket = window.io ? window.io('/ui') : null;
+  // A clustered controller only accepts WebSocket connections (see cluster.py).
+  const socketOptions = document.body.dataset.socketTransport === 'websocket' ? { transports: ['websocket'] } : {};
+  const socket = window.io ? window.io('/ui', socketOptions) : null;
   const socketState = { isConnected: false };
   const knownTasks = new Map();
   const pendingTasks = new Map();
+  const jobProgressLines = new Map();
   const pendingTerminal = new Map();
+  const piStates = new Map();
+  let statsVersion = 0;
   const TERMINAL_CHANNEL_GLOBAL = 'global';
   const TERMINAL_CHANNEL_META = 'meta';
   const channelForPi = piId => (piId ? `pi:${piId}` : TERMINAL_CHANNEL_GLOBAL);
@@ -156,71 +161,320 @@ document.addEventListener('DOMContentLoaded', () => {
   let holdIdCounter = 1;
   const HOLD_INTERVAL_MS = 1000;
 
-  function scrollTerminalToBottom(){
-    if(!terminal) return;
-    const container = terminal.parentElement;
-    if(container){
-      container.scrollTop = container.scrollHeight;
+  // Terminal lines live in bounded per-view ring buffers. Only the rows inside the
+  // scroll viewport are rendered, so DOM size and channel switches stay O(visible).
+  const TERMINAL_MAX_LINES = 5000;
+  const TERMINAL_MAX_VIEWS = 64;
+  const TERMINAL_OVERSCAN = 12;
+  const terminalViews = new Map();
+  const scrollbackState = new Map();
+  const terminalRows = [];
+  const terminalWindow = terminal ? document.createElement('div') : null;
+  const terminalScroller = terminal ? terminal.parentElement : null;
+  let terminalLineHeight = 21;
+  let terminalRenderQueued = false;
+
+  if(terminal && terminalWindow){
+    terminal.textContent = '';
+    terminal.classList.add('terminal-virtual');
+    terminalWindow.className = 'terminal-window';
+    terminal.appendChild(terminalWindow);
+  }
+
+  function createRing(capacity){
+    return { items: new Array(capacity), start: 0, length: 0, own: 0 };
+  }
+
+  function ringPush(ring, record, viewChannel){
+    const capacity = ring.items.length;
+    if(ring.length < capacity){
+      ring.items[(ring.start + ring.length) % capacity] = record;
+      ring.length += 1;
+    }else{
+      const evicted = ring.items[ring.start];
+      if(evicted && evicted.channel === viewChannel) ring.own -= 1;
+      ring.items[ring.start] = record;
+      ring.start = (ring.start + 1) % capacity;
+    }
+    if(record.channel === viewChannel) ring.own += 1;
+  }
+
+  function ringAt(ring, index){
+    return ring.items[(ring.start + index) % ring.items.length];
+  }
+
+  function ringFilter(ring, keep, viewChannel){
+    const kept = [];
+    for(let i = 0; i < ring.length; i++){
+      const record = ringAt(ring, i);
+      if(keep(record)) kept.push(record);
+    }
+    if(kept.length === ring.length) return false;
+    ring.items = new Array(ring.items.length);
+    ring.start = 0;
+    ring.length = 0;
+    ring.own = 0;
+    kept.forEach(record => ringPush(ring, record, viewChannel));
+    return true;
+  }
+
+  function getTerminalView(channel, { create = true } = {}){
+    let view = terminalViews.get(channel);
+    if(view || !create) return view || null;
+    if(terminalViews.size >= TERMINAL_MAX_VIEWS){
+      // Evict the least recently written Pi view; the global view is never dropped.
+      let oldestKey = null;
+      let oldestAt = Infinity;
+      terminalViews.forEach((candidate, key) => {
+        if(key === TERMINAL_CHANNEL_GLOBAL || key === activeTerminalChannel) return;
+        if(candidate.touched < oldestAt){
+          oldestAt = candidate.touched;
+          oldestKey = key;
+        }
+      });
+      if(oldestKey !== null){
+        terminalViews.delete(oldestKey);
+        if(oldestKey.startsWith('pi:')) scrollbackState.delete(oldestKey.slice(3));
+      }
+    }
+    view = createRing(TERMINAL_MAX_LINES);
+    view.touched = 0;
+    terminalViews.set(channel, view);
+    return view;
+  }
+
+  function viewsForChannel(channel){
+    if(channel === TERMINAL_CHANNEL_META){
+      // Meta banners show in every view that already exists, plus the one on screen.
+      getTerminalView(TERMINAL_CHANNEL_GLOBAL);
+      getTerminalView(activeTerminalChannel);
+      return Array.from(terminalViews.entries());
+    }
+    return [[channel, getTerminalView(channel)]];
+  }
+
+  function measureTerminalLineHeight(){
+    if(!terminalWindow) return;
+    const probe = document.createElement('span');
+    probe.className = 'terminal-line';
+    probe.textContent = 'M';
+    terminalWindow.appendChild(probe);
+    const height = probe.getBoundingClientRect().height;
+    terminalWindow.removeChild(probe);
+    if(height > 0) terminalLineHeight = height;
+  }
+
+  function renderTerminal(){
+    terminalRenderQueued = false;
+    if(!terminal || !terminalWindow || !terminalScroller) return;
+    const view = getTerminalView(activeTerminalChannel, { create: false });
+    const total = view ? view.length : 0;
+    terminal.style.height = `${total * terminalLineHeight}px`;
+    const offset = Math.max(0, terminalScroller.getBoundingClientRect().top - terminal.getBoundingClientRect().top);
+    const first = Math.max(0, Math.floor(offset / terminalLineHeight) - TERMINAL_OVERSCAN);
+    const visible = Math.ceil(terminalScroller.clientHeight / terminalLineHeight) + TERMINAL_OVERSCAN * 2;
+    const last = Math.min(total, first + visible);
+    const count = Math.max(0, last - first);
+    while(terminalRows.length < count){
+      const row = document.createElement('span');
+      terminalRows.push(row);
+      terminalWindow.appendChild(row);
+    }
+    for(let i = 0; i < terminalRows.length; i++){
+      const row = terminalRows[i];
+      if(i >= count){
+        row.style.display = 'none';
+        continue;
+      }
+      const record = ringAt(view, first + i);
+      row.style.display = '';
+      row.textContent = record.text;
+      row.title = record.text.length > 120 ? record.text : '';
+      row.className = record.className ? `terminal-line ${record.className}` : 'terminal-line';
+      row.style.color = record.color || '';
     }
+    terminalWindow.style.transform = `translateY(${first * terminalLineHeight}px)`;
   }
 
+  function scheduleTerminalRender(){
+    if(terminalRenderQueued) return;
+    terminalRenderQueued = true;
+    requestAnimationFrame(renderTerminal);
+  }
+
+  function scrollTerminalToBottom(){
+    if(!terminal || !terminalScroller) return;
+    const view = getTerminalView(activeTerminalChannel, { create: false });
+    terminal.style.height = `${(view ? view.length : 0) * terminalLineHeight}px`;
+    terminalScroller.scrollTop = terminalScroller.scrollHeight;
+    scheduleTerminalRender();
+  }
+
+  // Accepts a single line or an array of lines (batched output) sharing the same options.
+  // Returns the stored record of the last line so callers can update it in place.
   function writeTerminalLine(text = '', options = {}){
-    if(!terminal) return;
-    const line = document.createElement('span');
-    const content = `${text ?? ''}`;
+    if(!terminal) return null;
+    const items = Array.isArray(text) ? text : [text];
+    if(!items.length) return null;
     const channel = options.channel || TERMINAL_CHANNEL_GLOBAL;
-    line.dataset.channel = channel;
-    line.textContent = options.noNewline ? content : `${content}\n`;
-    if(options.className) line.className = options.className;
-    if(options.color) line.style.color = options.color;
-    terminal.appendChild(line);
-    applyTerminalFilterToLine(line);
-    scrollTerminalToBottom();
+    const targets = viewsForChannel(channel);
+    const now = Date.now();
+    let record = null;
+    items.forEach(item => {
+      record = {
+        text: `${item ?? ''}`,
+        channel,
+        className: options.className || '',
+        color: options.color || ''
+      };
+      targets.forEach(([viewChannel, view]) => {
+        ringPush(view, record, viewChannel);
+        view.touched = now;
+      });
+    });
+    if(targets.some(([viewChannel]) => viewChannel === activeTerminalChannel)){
+      scrollTerminalToBottom();
+    }
+    return record;
   }
 
-  function applyTerminalFilterToLine(node){
-    if(!node || node.nodeType !== 1) return;
-    const channel = node.dataset.channel || TERMINAL_CHANNEL_GLOBAL;
-    if(activeTerminalChannel === TERMINAL_CHANNEL_GLOBAL){
-      if(channel === TERMINAL_CHANNEL_GLOBAL || channel === TERMINAL_CHANNEL_META){
-        node.style.display = '';
-      }else{
-        node.style.display = 'none';
-      }
-      return;
+  function updateTerminalRecord(record, text){
+    if(!record) return;
+    record.text = `${text ?? ''}`;
+    scheduleTerminalRender();
+  }
+
+  function outputLines(payload){
+    if(!payload) return [];
+    if(Array.isArray(payload.lines)) return payload.lines;
+    return payload.line ? [payload.line] : [];
+  }
+
+  function reportDroppedOutput(payload, channel){
+    if(!payload) return;
+    const notes = [];
+    if(payload.dropped) notes.push(`${payload.dropped} line(s) dropped`);
+    if(payload.truncated) notes.push(`${payload.truncated} line(s) truncated`);
+    if(notes.length){
+      writeTerminalLine(`[output] ${notes.join(', ')} because output arrived faster than it could be sent.`, { channel, className: 'terminal-banner' });
     }
-    if(channel === activeTerminalChannel || channel === TERMINAL_CHANNEL_META){
-      node.style.display = '';
-    }else{
-      node.style.display = 'none';
+  }
+
+  // Older output is fetched from the controller's scrollback one page at a time.
+  // liveSeq is the sequence number of the first line that arrived live, so a page
+  // never repeats lines the view already holds.
+  const SCROLLBACK_PAGE_LINES = 200;
+
+  function scrollbackFor(piId){
+    let state = scrollbackState.get(piId);
+    if(!state){
+      state = { loading: false, oldestSeq: null, liveSeq: null, exhausted: false };
+      scrollbackState.set(piId, state);
     }
+    return state;
   }
 
-  function applyTerminalFilterToAll(){
-    if(!terminal) return;
-    Array.from(terminal.children).forEach(applyTerminalFilterToLine);
+  function noteLiveSeq(piId, payload){
+    if(!payload || typeof payload.seq !== 'number') return;
+    const state = scrollbackFor(piId);
+    if(state.liveSeq === null || payload.seq < state.liveSeq) state.liveSeq = payload.seq;
+  }
+
+  function prependTerminalLines(channel, records){
+    const view = getTerminalView(channel);
+    const existing = [];
+    for(let i = 0; i < view.length; i++) existing.push(ringAt(view, i));
+    const capacity = view.items.length;
+    const combined = records.concat(existing).slice(-capacity);
+    const added = combined.length - existing.length;
+    view.items = new Array(capacity);
+    view.start = 0;
+    view.length = 0;
+    view.own = 0;
+    combined.forEach(record => ringPush(view, record, channel));
+    if(channel === activeTerminalChannel && terminalScroller && added > 0){
+      terminal.style.height = `${view.length * terminalLineHeight}px`;
+      terminalScroller.scrollTop += added * terminalLineHeight;
+      scheduleTerminalRender();
+    }
+    return added;
+  }
+
+  function requestScrollback(piId){
+    if(!piId || !socket || !socketState.isConnected) return;
+    const state = scrollbackFor(piId);
+    if(state.loading || state.exhausted) return;
+    state.loading = true;
+    const before = state.oldestSeq !== null ? state.oldestSeq : state.liveSeq;
+    socket.emit('scrollback:request', { pi_id: piId, before, limit: SCROLLBACK_PAGE_LINES }, ack => {
+      state.loading = false;
+      if(!ack || ack.error || !Array.isArray(ack.chunks)){
+        state.exhausted = true;
+        return;
+      }
+      if(state.liveSeq === null && typeof ack.next_seq === 'number') state.liveSeq = ack.next_seq;
+      const channel = channelForPi(piId);
+      const records = [];
+      let oldest = state.oldestSeq;
+      ack.chunks.forEach(chunk => {
+        (chunk.lines || []).forEach((line, index) => {
+          const seq = chunk.first_seq + index;
+          if(state.liveSeq !== null && seq >= state.liveSeq) return;
+          if(state.oldestSeq !== null && seq >= state.oldestSeq) return;
+          if(oldest === null || seq < oldest) oldest = seq;
+          records.push({ text: `${line ?? ''}`, channel, className: 'task-output', color: '' });
+        });
+      });
+      state.oldestSeq = oldest;
+      state.exhausted = !ack.more || !records.length;
+      if(!records.length) return;
+      removeEmptyBanner(channel);
+      const added = prependTerminalLines(channel, records);
+      if(added < records.length) state.exhausted = true;
+    });
+  }
+
+  function maybeLoadOlderOutput(){
+    if(!terminalScroller || !activePiSelection) return;
+    if(activeTerminalChannel !== channelForPi(activePiSelection.id)) return;
+    const offset = terminalScroller.getBoundingClientRect().top - terminal.getBoundingClientRect().top;
+    if(offset < terminalLineHeight * TERMINAL_OVERSCAN) requestScrollback(activePiSelection.id);
   }
 
   function setActiveTerminalChannel(channel, { force = false } = {}){
     const resolved = channel || TERMINAL_CHANNEL_GLOBAL;
     if(!force && resolved === activeTerminalChannel) return;
     activeTerminalChannel = resolved;
-    applyTerminalFilterToAll();
     scrollTerminalToBottom();
   }
 
   function hasLinesForChannel(channel){
-    if(!terminal) return false;
-    return Array.from(terminal.children || []).some(node => node.dataset && node.dataset.channel === channel);
+    const view = getTerminalView(channel, { create: false });
+    return Boolean(view && view.own > 0);
   }
 
   function removeEmptyBanner(channel){
-    if(!terminal || !channel) return;
-    Array.from(terminal.querySelectorAll('.terminal-banner--empty')).forEach(node => {
-      if(node.dataset && node.dataset.channel === channel){
-        node.remove();
-      }
+    if(!channel) return;
+    const view = getTerminalView(channel, { create: false });
+    if(!view) return;
+    const removed = ringFilter(
+      view,
+      record => !(record.channel === channel && record.className.includes('terminal-banner--empty')),
+      channel
+    );
+    if(removed && channel === activeTerminalChannel) scheduleTerminalRender();
+  }
+
+  if(terminalScroller){
+    terminalScroller.addEventListener('scroll', ()=>{
+      scheduleTerminalRender();
+      maybeLoadOlderOutput();
+    }, { passive: true });
+    window.addEventListener('resize', ()=>{
+      measureTerminalLineHeight();
+      scheduleTerminalRender();
     });
+    measureTerminalLineHeight();
   }
 
   function clearPiSelection({ showBanner = true } = {}){
@@ -275,6 +529,37 @@ document.addEventListener('DOMContentLoaded', () => {
     });
   }
 
+  function lastPendingFor(map, piId){
+    let found = null;
+    map.forEach((info, requestId) => {
+      if(!piId || (info && info.piId === piId)) found = requestId;
+    });
+    return found;
+  }
+
+  // Ctrl+C while a Pi is selected: stop its most recent terminal command.
+  function cancelTerminalCommand(){
+    if(!activePiSelection) return false;
+    const piId = activePiSelection.id;
+    const channel = channelForPi(piId);
+    const requestId = lastPendingFor(pendingTerminal, piId);
+    if(!requestId){
+      writeTerminalLine('[terminal] Nothing running to cancel.', { channel, className: 'terminal-banner' });
+      return true;
+    }
+    if(!socket || !socketState.isConnected){
+      writeTerminalLine('Controller connection unavailable; cancel not sent.', { channel, className: 'terminal-banner' });
+      return true;
+    }
+    writeTerminalLine(`[terminal] Cancelling ${requestId.slice(0, 8)}…`, { channel, className: 'terminal-banner' });
+    socket.emit('cancel_terminal', { request_id: requestId }, ack => {
+      if(ack && ack.error){
+        writeTerminalLine(`Controller rejected cancel: ${ack.error}`, { channel, className: 'terminal-banner' });
+      }
+    });
+    return true;
+  }
+
   function selectPiCard(card, piId, label){
     if(!piId) return;
     document.querySelectorAll('.pi-card.selected').forEach(node => {
@@ -299,11 +584,15 @@ document.addEventListener('DOMContentLoaded', () => {
     if(!hasLinesForChannel(channel)){
       writeTerminalLine('No console output received yet for this device.', { className: 'terminal-banner terminal-banner--empty', channel });
     }
+    const history = scrollbackState.get(piId);
+    if(!history || history.oldestSeq === null) requestScrollback(piId);
   }
 
   function clearTerminal(){
     if(!terminal) return;
-    terminal.textContent = '';
+    terminalViews.clear();
+    // Cleared output stays cleared; scrollback only fills views opened afterwards.
+    scrollbackState.forEach(state => { state.exhausted = true; });
     scrollTerminalToBottom();
   }
 
@@ -453,6 +742,22 @@ document.addEventListener('DOMContentLoaded', () => {
     return card;
   }
 
+  // One-line summary of the extra collector readings an agent reports, for the card tooltip.
+  function describeTelemetry(telemetry){
+    if(!telemetry || typeof telemetry !== 'object') return '';
+    const rate = bytes => bytes >= 1048576 ? `${(bytes / 1048576).toFixed(1)} MB/s` : `${(bytes / 1024).toFixed(1)} KB/s`;
+    const parts = [];
+    if(Number.isFinite(telemetry.load_1)) parts.push(`Load ${telemetry.load_1.toFixed(2)} ${Number(telemetry.load_5).toFixed(2)} ${Number(telemetry.load_15).toFixed(2)}`);
+    if(Number.isFinite(telemetry.temp_c)) parts.push(`${telemetry.temp_c.toFixed(1)} °C`);
+    if(telemetry.throttled) parts.push(`throttled 0x${telemetry.throttled.toString(16)}`);
+    if(Number.isFinite(telemetry.cpu_iowait_percent)) parts.push(`iowait ${telemetry.cpu_iowait_percent.toFixed(1)}%`);
+    if(Number.isFinite(telemetry.swap_percent)) parts.push(`swap ${telemetry.swap_percent.toFixed(0)}%`);
+    if(Number.isFinite(telemetry.net_rx_bytes_per_sec)) parts.push(`net ↓${rate(telemetry.net_rx_bytes_per_sec)} ↑${rate(telemetry.net_tx_bytes_per_sec || 0)}`);
+    if(Number.isFinite(telemetry.disk_read_bytes_per_sec)) parts.push(`disk r ${rate(telemetry.disk_read_bytes_per_sec)} w ${rate(telemetry.disk_write_bytes_per_sec || 0)}`);
+    if(Number.isFinite(telemetry.collect_cpu_ms)) parts.push(`sampling ${telemetry.collect_cpu_ms.toFixed(2)} ms CPU`);
+    return parts.join(' · ');
+  }
+
   function applyPiStat(card, stat){
     const changed = [];
     if(!card || !stat) return changed;
@@ -495,23 +800,59 @@ document.addEventListener('DOMContentLoaded', () => {
       changed.push(ramEl);
     }
 
+    const metricsEl = card.querySelector('.pi-metrics');
+    if(metricsEl){
+      const details = describeTelemetry(stat.telemetry);
+      if(details){
+        metricsEl.title = details;
+      }else{
+        metricsEl.removeAttribute('title');
+      }
+    }
+
     const online = stat.online !== false;
     card.dataset.online = online ? '1' : '0';
     return changed;
   }
 
+  // Accepts a legacy full list or a stats_delta payload ({full, base, version, entries}).
+  // Deltas carry only changed fields; null means the field was removed.
   function handleStatsSnapshot(payload){
     if(!payload) return;
-    const items = Array.isArray(payload) ? payload : Object.values(payload);
+    let items;
+    if(Array.isArray(payload)){
+      items = payload;
+    }else if(Array.isArray(payload.entries)){
+      if(payload.full){
+        piStates.clear();
+      }else if(typeof payload.base === 'number' && payload.base > statsVersion){
+        // We missed an update; ask for the whole fleet rather than apply a gap.
+        if(socket && socketState.isConnected) socket.emit('stats_resync');
+        return;
+      }
+      items = payload.entries;
+    }else{
+      items = Object.values(payload);
+    }
     const nodes = [];
     items.forEach(stat => {
       if(!stat || stat.pi_id === undefined || stat.pi_id === null) return;
-      const card = ensurePiCard(stat.pi_id, stat.label);
+      const key = String(stat.pi_id);
+      const merged = Object.assign({}, piStates.get(key), stat);
+      Object.keys(stat).forEach(field => {
+        if(stat[field] === null) delete merged[field];
+      });
+      piStates.set(key, merged);
+      const card = ensurePiCard(merged.pi_id, merged.label);
       if(!card) return;
-      const changed = applyPiStat(card, stat);
+      const changed = applyPiStat(card, merged);
       if(changed.length) nodes.push(...changed);
     });
     if(nodes.length) animateStats(nodes);
+    if(typeof payload.version === 'number' && (payload.full || payload.version > statsVersion)){
+      statsVersion = payload.version;
+      if(socket && socketState.isConnected) socket.emit('stats_ack', { version: statsVersion });
+    }
   }
 
   function handleTaskCatalog(payload){
@@ -737,6 +1078,7 @@ document.addEventListener('DOMContentLoaded', () => {
           ctx.write(`Refresh interval: ${refreshSeconds}s`);
           ctx.write(listLine);
           ctx.write('Use release to clear all holds.');
+          ctx.write('Recurring backend tasks run on the controller instead: schedule add <task-id> <seconds>');
           ctx.write('Example: hold stats');
         };
 
@@ -887,7 +1229,7 @@ document.addEventListener('DOMContentLoaded', () => {
     },
     task: {
       description: 'List or run backend tasks',
-      usage: 'task [list|run <task-id> [pi-id]|assign <machine> <task-label>]',
+      usage: 'task [list|run <task-id> [pi-id|all|label:<pattern>|task:<label>] [concurrency]|cancel [request-id]|assign <machine> <task-label>]',
       action(ctx){
         if(!socket){
           ctx.write('Socket interface unavailable.');
@@ -908,7 +1250,34 @@ document.addEventListener('DOMContentLoaded', () => {
             ctx.write(`  ${id}${desc}`);
           });
           ctx.write('Run with: task run <task-id> [pi-id]');
+          ctx.write('Run on many Pis: task run <task-id> all|label:<pattern>|task:<label> [concurrency]');
           ctx.write('Assign label: task assign <machine> <task-label>');
+          ctx.write('Stop a task: task cancel [request-id]');
+          return;
+        }
+
+        if(sub === 'cancel'){
+          const requestId = ctx.args[1] || lastPendingFor(pendingTasks);
+          if(!requestId){
+            ctx.write('No running task to cancel.');
+            return;
+          }
+          if(!socketState.isConnected){
+            ctx.write('Controller connection offline; cannot cancel task.');
+            return;
+          }
+          ctx.write(`Cancelling task ${requestId}...`);
+          socket.emit('cancel_task', { request_id: requestId }, ack => {
+            if(!ack){
+              ctx.write('No acknowledgement from controller.');
+              return;
+            }
+            if(ack.error){
+              ctx.write(`Controller rejected cancel: ${ack.error}`);
+              return;
+            }
+            ctx.write(ack.message || 'Cancel requested.');
+          });
           return;
         }
 
@@ -929,7 +1298,11 @@ document.addEventListener('DOMContentLoaded', () => {
             return;
           }
           ctx.write(`Dispatching task '${taskId}' to ${targetPi}...`);
-          socket.emit('run_task', { task: taskId, pi_id: targetPi }, ack => {
+          const targets = fanoutTargets(targetPi);
+          const request = targets
+            ? { task: taskId, targets, concurrency: Number(ctx.args[3]) || undefined }
+            : { task: taskId, pi_id: targetPi };
+          socket.emit('run_task', request, ack => {
             if(!ack){
               ctx.write('No acknowledgement from controller.');
               return;
@@ -976,7 +1349,162 @@ document.addEventListener('DOMContentLoaded', () => {
           return;
         }
 
-        ctx.write('Usage: task [list|run <task-id> [pi-id]|assign <machine> <task-label>]');
+        ctx.write('Usage: task [list|run <task-id> [pi-id]|cancel [request-id]|assign <machine> <task-label>]');
+      }
+    },
+    schedule: {
+      description: 'Run backend tasks on a recurring schedule from the controller',
+      usage: 'schedule [list|add <task-id> <seconds> [pi-id|all|label:<pattern>|task:<label>] [jitter]|cancel <id>]',
+      action(ctx){
+        if(!socket || !socketState.isConnected){
+          ctx.write('Controller connection offline; schedules unavailable.');
+          return;
+        }
+        const sub = (ctx.args[0] || 'list').toLowerCase();
+        const reply = (label, ack, onOk) => {
+          if(!ack){
+            ctx.write('No acknowledgement from controller.');
+            return;
+          }
+          if(ack.error){
+            ctx.write(`Controller rejected ${label}: ${ack.error}`);
+            return;
+          }
+          onOk(ack);
+        };
+        if(sub === 'list'){
+          socket.emit('schedule:list', ack => reply('request', ack, ({ schedules }) => {
+            if(!schedules || !schedules.length){
+              ctx.write('No schedules. Add one with: schedule add <task-id> <seconds> [target]');
+              return;
+            }
+            schedules.forEach(item => {
+              const target = item.targets ? JSON.stringify(item.targets) : (item.pi_id || 'local');
+              const state = item.running ? 'running' : `${item.runs} runs, ${item.skipped} skipped`;
+              ctx.write(`#${item.schedule_id} ${item.task_id} on ${target} every ${item.interval}s (${state})`);
+            });
+          }));
+          return;
+        }
+        if(sub === 'add'){
+          const taskId = ctx.args[1];
+          const interval = Number(ctx.args[2]);
+          if(!taskId || !Number.isFinite(interval)){
+            ctx.write('Usage: schedule add <task-id> <seconds> [pi-id|all|label:<pattern>|task:<label>] [jitter]');
+            return;
+          }
+          const target = ctx.args[3] || 'local';
+          const targets = fanoutTargets(target);
+          const request = { task: taskId, interval, jitter: Number(ctx.args[4]) || 0 };
+          if(targets){
+            request.targets = targets;
+          }else{
+            request.pi_id = target;
+          }
+          socket.emit('schedule:create', request, ack => reply('schedule', ack, done => ctx.write(done.message || 'Schedule created.')));
+          return;
+        }
+        if(sub === 'cancel'){
+          if(!ctx.args[1]){
+            ctx.write('Usage: schedule cancel <id>');
+            return;
+          }
+          socket.emit('schedule:cancel', { schedule_id: ctx.args[1] }, ack => reply('cancel', ack, done => ctx.write(done.message || 'Schedule cancelled.')));
+          return;
+        }
+        ctx.write('Usage: schedule [list|add <task-id> <seconds> [target] [jitter]|cancel <id>]');
+      }
+    },
+    diagnostics: {
+      description: 'Show controller handler timings, lock waits and in-flight requests',
+      usage: 'diagnostics [count]',
+      action(ctx){
+        if(!socket || !socketState.isConnected){
+          ctx.write('Controller connection offline; diagnostics unavailable.');
+          return;
+        }
+        const count = Math.max(1, Math.min(50, Number(ctx.args[0]) || 10));
+        const ms = seconds => `${(seconds * 1000).toFixed(seconds < 0.01 ? 2 : 1)}ms`;
+        socket.emit('diagnostics', ack => {
+          if(!ack || !ack.metrics){
+            ctx.write('No acknowledgement from controller.');
+            return;
+          }
+          const metrics = ack.metrics;
+          const rows = name => metrics[name] || [];
+          const errors = new Map(rows('pistat_handler_errors_total').map(row => [row.labels.handler, row.value]));
+          const handlers = rows('pistat_handler_seconds').filter(row => row.count).sort((a, b) => b.sum - a.sum);
+          ctx.write(`Controller worker ${ack.worker}: ${handlers.length} handlers called, busiest first.`);
+          handlers.slice(0, count).forEach(row => {
+            const failed = errors.get(row.labels.handler) ? `, ${errors.get(row.labels.handler)} errors` : '';
+            ctx.write(`${row.labels.handler}: ${row.count} calls, ${ms(row.sum)} total, p50 ≤${ms(row.p50)}, p99 ≤${ms(row.p99)}${failed}`);
+          });
+          const contended = new Map(rows('pistat_lock_contended_total').map(row => [row.labels.lock, row.value]));
+          rows('pistat_lock_wait_seconds').forEach(row => {
+            const acquired = (rows('pistat_lock_acquired_total').find(item => item.labels.lock === row.labels.lock) || {}).value || 0;
+            ctx.write(`lock ${row.labels.lock}: ${contended.get(row.labels.lock) || 0} of ${acquired} acquisitions waited, ${ms(row.sum)} total, p99 ≤${ms(row.p99)}`);
+          });
+          const inflight = rows('pistat_inflight').map(row => `${row.labels.map} ${row.value}`);
+          if(inflight.length) ctx.write(`in flight: ${inflight.join(', ')}`);
+          const sent = rows('pistat_socketio_packet_bytes').filter(row => row.labels.direction === 'out').sort((a, b) => b.sum - a.sum);
+          sent.slice(0, 5).forEach(row => {
+            ctx.write(`sent ${row.labels.event}: ${row.count} packets, ${(row.sum / 1024).toFixed(1)} KB, p50 ≤${row.p50} B`);
+          });
+        });
+      }
+    },
+    profile: {
+      description: 'Sample the controller or a Pi to find hot code paths; stop saves collapsed stacks for flame graphs',
+      usage: 'profile <start|stop|status> [local|pi-id] [samples-per-second]',
+      action(ctx){
+        if(!socket || !socketState.isConnected){
+          ctx.write('Controller connection offline; profiler unavailable.');
+          return;
+        }
+        const sub = (ctx.args[0] || 'status').toLowerCase();
+        if(!['start', 'stop', 'status'].includes(sub)){
+          ctx.write('Usage: profile <start|stop|status> [local|pi-id] [samples-per-second]');
+          return;
+        }
+        const request = { action: sub, target: ctx.args[1] || 'local' };
+        if(sub === 'start' && ctx.args[2]) request.hz = Number(ctx.args[2]);
+        socket.emit('profile', request, ack => {
+          if(!ack){
+            ctx.write('No acknowledgement from controller.');
+            return;
+          }
+          if(ack.status === 'forwarded'){
+            ctx.write(ack.message || `Profiler ${sub} sent; waiting for ${ack.pi_id}...`);
+            return;
+          }
+          reportProfile(ack, ctx.write);
+        });
+      }
+    },
+    processes: {
+      description: 'Show per-core usage and the busiest processes the controller last heard from a machine',
+      usage: 'processes [local|pi-id] [refresh]',
+      action(ctx){
+        if(!socket || !socketState.isConnected){
+          ctx.write('Controller connection offline; process view unavailable.');
+          return;
+        }
+        const request = { target: ctx.args[0] || 'local', refresh: (ctx.args[1] || '').toLowerCase() === 'refresh' };
+        socket.emit('processes', request, ack => {
+          if(!ack){
+            ctx.write('No acknowledgement from controller.');
+            return;
+          }
+          if(ack.error){
+            ctx.write(`Process view unavailable: ${ack.error}`);
+            return;
+          }
+          if(ack.status === 'forwarded'){
+            ctx.write(ack.message || `Waiting for ${ack.pi_id}...`);
+            return;
+          }
+          reportProcesses(ack, ctx.write);
+        });
       }
     },
     assign: {
@@ -1028,6 +1556,76 @@ document.addEventListener('DOMContentLoaded', () => {
     
   };
 
+  function reportProfile(result, write){
+    const who = result.pi_id === 'local' ? 'controller' : (result.pi_id || 'Pi');
+    if(result.error){
+      write(`Profiler on ${who}: ${result.error}`);
+      return;
+    }
+    const state = result.running ? 'sampling' : 'stopped';
+    write(`Profiler on ${who}: ${state} at ${result.hz} Hz, ${result.samples} samples over ${result.seconds}s.`);
+    if(typeof result.stacks !== 'string') return;
+    if(!result.stacks){
+      write('No stacks were recorded.');
+      return;
+    }
+    // Self time: samples whose innermost frame is the function.
+    const leaves = new Map();
+    let total = 0;
+    result.stacks.split('\n').forEach(line => {
+      const split = line.lastIndexOf(' ');
+      const count = Number(line.slice(split + 1)) || 0;
+      const frames = line.slice(0, split).split(';');
+      const leaf = frames[frames.length - 1];
+      leaves.set(leaf, (leaves.get(leaf) || 0) + count);
+      total += count;
+    });
+    write('Busiest functions (share of all thread samples, including idle waits):');
+    Array.from(leaves.entries()).sort((a, b) => b[1] - a[1]).slice(0, 10).forEach(([leaf, count]) => {
+      write(`  ${((count / total) * 100).toFixed(1).padStart(5)}%  ${leaf}`);
+    });
+    const filename = `pistat-profile-${who}-${new Date().toISOString().replace(/[:.]/g, '-')}.folded`;
+    const link = document.createElement('a');
+    link.href = URL.createObjectURL(new Blob([result.stacks + '\n'], { type: 'text/plain' }));
+    link.download = filename;
+    document.body.appendChild(link);
+    link.click();
+    link.remove();
+    setTimeout(() => URL.revokeObjectURL(link.href), 0);
+    const omitted = result.omitted ? ` (${result.omitted} rarest stacks left out)` : '';
+    write(`Saved collapsed stacks to ${filename}${omitted}; open it with speedscope or flamegraph.pl.`);
+  }
+
+  function reportProcesses(view, write){
+    const who = view.pi_id === 'local' ? 'controller' : (view.pi_id || 'Pi');
+    const age = Number.isFinite(view.received) ? Math.max(0, Math.round(Date.now() / 1000 - view.received)) : null;
+    write(`Processes on ${who}: ${view.process_count} running${age === null ? '' : `, as of ${age}s ago`}.`);
+    const cores = Array.isArray(view.cores) ? view.cores : [];
+    if(cores.length) write(`Cores: ${cores.map((value, idx) => `${idx}:${Number(value).toFixed(0)}%`).join(' ')}`);
+    const columns = Array.isArray(view.columns) ? view.columns : [];
+    const at = name => columns.indexOf(name);
+    const [pid, name, cpu, mem, rss, threads] = ['pid', 'name', 'cpu_percent', 'memory_percent', 'rss_mb', 'threads'].map(at);
+    write(`${'PID'.padStart(7)} ${'CPU%'.padStart(6)} ${'MEM%'.padStart(5)} ${'RSS MB'.padStart(8)} ${'THR'.padStart(4)}  NAME`);
+    (view.processes || []).forEach(row => {
+      const number = (idx, digits) => (idx >= 0 && Number.isFinite(Number(row[idx])) ? Number(row[idx]).toFixed(digits) : '-');
+      write(`${number(pid, 0).padStart(7)} ${number(cpu, 1).padStart(6)} ${number(mem, 1).padStart(5)} ${number(rss, 1).padStart(8)} ${number(threads, 0).padStart(4)}  ${name >= 0 ? row[name] : '?'}`);
+    });
+  }
+
+  // 'all', 'label:<glob>' and 'task:<assigned label>' run a task across the fleet.
+  function fanoutTargets(target){
+    const value = `${target || ''}`;
+    if(value.toLowerCase() === 'all') return { all: true };
+    if(value.toLowerCase().startsWith('label:')) return { label: value.slice(6) };
+    if(value.toLowerCase().startsWith('task:')) return { assigned_task: value.slice(5) };
+    return null;
+  }
+
+  function formatJobProgress(payload){
+    const running = payload.running ? `, ${payload.running} running` : '';
+    return `[job] ${payload.task_id}: ${payload.done}/${payload.total} done (${payload.ok} ok, ${payload.failed} failed${running})`;
+  }
+
   function executeCommand(inputRaw){
     const trimmed = inputRaw.trim();
     if(!trimmed) return;
@@ -1124,24 +1722,13 @@ document.addEventListener('DOMContentLoaded', () => {
     if(idx>=lines.length) return appendLog('Terminal ready.');
     const line = lines[idx];
     let i=0;
-    const span = document.createElement('span');
-    span.dataset.channel = TERMINAL_CHANNEL_GLOBAL;
-    el.appendChild(span);
-    applyTerminalFilterToLine(span);
+    const record = writeTerminalLine('', { channel: TERMINAL_CHANNEL_GLOBAL });
 
     const tick = setInterval(()=>{
-      span.textContent = line.substring(0,i+1);
-      scrollTerminalToBottom();
+      updateTerminalRecord(record, line.substring(0,i+1));
       i++;
       if(i>=line.length){
         clearInterval(tick);
-        const newline = document.createElement('span');
-        newline.className = 'terminal-break';
-        newline.dataset.channel = TERMINAL_CHANNEL_GLOBAL;
-        newline.textContent = '\n';
-        el.appendChild(newline);
-        applyTerminalFilterToLine(newline);
-        scrollTerminalToBottom();
         setTimeout(()=>typeLines(el, idx+1), 300);
       }
     }, 28 + Math.random()*40);
@@ -1224,14 +1811,17 @@ document.addEventListener('DOMContentLoaded', () => {
       pendingTasks.clear();
       appendLog('Connected to controller.');
       socket.emit('catalog:request');
+      socket.emit('schedule:subscribe');
     });
 
     socket.on('disconnect', ()=>{
       socketState.isConnected = false;
+      statsVersion = 0;
       appendLog('Disconnected from controller.');
     });
 
     socket.on('stats_snapshot', handleStatsSnapshot);
+    socket.on('stats_delta', handleStatsSnapshot);
     socket.on('task_catalog', handleTaskCatalog);
 
     socket.on('pi_console', payload => {
@@ -1244,6 +1834,14 @@ document.addEventListener('DOMContentLoaded', () => {
       writeTerminalLine(line, { className: 'pi-console-line', channel });
     });
 
+    socket.on('terminal_queued', payload => {
+      if(!payload) return;
+      const piId = payload.pi_id || 'unknown';
+      const channel = channelForPi(piId);
+      removeEmptyBanner(channel);
+      writeTerminalLine(`[terminal] ${piId} busy; command queued (position ${payload.position}).`, { channel, className: 'terminal-banner' });
+    });
+
     socket.on('terminal_started', payload => {
       if(!payload) return;
       const piId = payload.pi_id || 'unknown';
@@ -1256,11 +1854,14 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     socket.on('terminal_output', payload => {
-      if(!payload || !payload.line) return;
+      const lines = outputLines(payload);
+      if(!lines.length) return;
       const piId = payload.pi_id || 'unknown';
       const channel = channelForPi(piId);
+      noteLiveSeq(piId, payload);
       removeEmptyBanner(channel);
-      writeTerminalLine(payload.line, { channel });
+      reportDroppedOutput(payload, channel);
+      writeTerminalLine(lines, { channel });
     });
 
     socket.on('terminal_finished', payload => {
@@ -1272,6 +1873,7 @@ document.addEventListener('DOMContentLoaded', () => {
       const exitCode = payload.exit_code;
       const ok = exitCode === 0 || exitCode === null || exitCode === undefined;
       const message = ok ? 'completed successfully' : `exited with code ${exitCode}`;
+      reportDroppedOutput(payload, channel);
       writeTerminalLine(`[terminal] ${piId} ${message}`, { channel, className: 'terminal-banner' });
     });
 
@@ -1291,6 +1893,75 @@ document.addEventListener('DOMContentLoaded', () => {
       }
     });
 
+    socket.on('schedule_run', payload => {
+      if(!payload || !payload.schedule_id) return;
+      const prefix = `[schedule #${payload.schedule_id}] ${payload.task_id}`;
+      if(payload.status === 'skipped'){
+        writeTerminalLine(`${prefix} skipped: ${payload.reason || 'previous run still in progress.'}`, { className: 'terminal-banner' });
+        return;
+      }
+      if(payload.status !== 'finished' || !payload.result) return;
+      const result = payload.result;
+      // Fleet runs already reported through job_finished.
+      if(typeof result.total === 'number') return;
+      if(result.error){
+        writeTerminalLine(`${prefix} failed: ${result.error}`, { className: 'terminal-banner' });
+      }else if(result.exit_code !== 0){
+        writeTerminalLine(`${prefix} exited with code ${result.exit_code}`, { className: 'terminal-banner' });
+      }
+    });
+
+    socket.on('profile_result', payload => {
+      if(!payload) return;
+      reportProfile(payload, text => writeTerminalLine(text, { className: 'terminal-banner' }));
+    });
+
+    socket.on('processes_result', payload => {
+      if(!payload) return;
+      reportProcesses(payload, text => writeTerminalLine(text, { className: 'terminal-banner' }));
+    });
+
+    socket.on('job_progress', payload => {
+      if(!payload || !payload.job_id) return;
+      const text = formatJobProgress(payload);
+      const record = jobProgressLines.get(payload.job_id);
+      if(record){
+        updateTerminalRecord(record, text);
+      }else{
+        jobProgressLines.set(payload.job_id, writeTerminalLine(text, { className: 'terminal-banner' }));
+      }
+    });
+
+    socket.on('job_finished', payload => {
+      if(!payload || !payload.job_id) return;
+      const record = jobProgressLines.get(payload.job_id);
+      jobProgressLines.delete(payload.job_id);
+      const seconds = typeof payload.duration === 'number' ? ` in ${payload.duration.toFixed(1)}s` : '';
+      const text = `${formatJobProgress(payload)}${seconds}`;
+      if(record){
+        updateTerminalRecord(record, text);
+      }else{
+        writeTerminalLine(text, { className: 'terminal-banner' });
+      }
+      const failures = Object.entries(payload.results || {}).filter(([, result]) => result && result.exit_code !== 0);
+      failures.slice(0, 20).forEach(([piId, result]) => {
+        const reason = result.error || `exit code ${result.exit_code}`;
+        writeTerminalLine(`[job]   ${piId}: ${reason}`, { className: 'terminal-banner' });
+      });
+      if(failures.length > 20){
+        writeTerminalLine(`[job]   …and ${failures.length - 20} more failures.`, { className: 'terminal-banner' });
+      }
+    });
+
+    socket.on('task_queued', payload => {
+      if(!payload) return;
+      const label = resolveTaskLabel(payload);
+      const piId = payload.pi_id || 'local';
+      const channel = channelForPi(piId);
+      removeEmptyBanner(channel);
+      writeTerminalLine(`[task] ${label} queued on ${piId} (position ${payload.position}).`, { channel, className: 'terminal-banner' });
+    });
+
     socket.on('task_started', payload => {
       if(!payload) return;
       const label = resolveTaskLabel(payload);
@@ -1304,11 +1975,14 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     socket.on('task_output', payload => {
-      if(!payload || !payload.line) return;
+      const lines = outputLines(payload);
+      if(!lines.length) return;
       const piId = payload.pi_id || (payload.request_id && pendingTasks.get(payload.request_id)?.piId) || 'local';
       const channel = channelForPi(piId);
+      noteLiveSeq(piId, payload);
       removeEmptyBanner(channel);
-      writeTerminalLine(payload.line, { className: 'task-output', channel });
+      reportDroppedOutput(payload, channel);
+      writeTerminalLine(lines, { className: 'task-output', channel });
     });
 
     socket.on('task_finished', payload => {
@@ -1321,6 +1995,7 @@ document.addEventListener('DOMContentLoaded', () => {
       const message = ok ? 'completed successfully' : `exited with code ${exitCode}`;
       const channel = channelForPi(piId);
       removeEmptyBanner(channel);
+      reportDroppedOutput(payload, channel);
       writeTerminalLine(`[task] ${label} on ${piId} ${message}.`, { channel });
     });
 
@@ -1364,6 +2039,11 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   }
   if(cmdForm && cmdInput){
+    cmdInput.addEventListener('keydown', (ev)=>{
+      if(ev.ctrlKey && (ev.key === 'c' || ev.key === 'C') && !cmdInput.value && cancelTerminalCommand()){
+        ev.preventDefault();
+      }
+    });
     cmdForm.addEventListener('submit', (ev)=>{
       ev.preventDefault();
       const rawValue = cmdInput.value;
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import threading
+
+import pytest
+
+os.environ.setdefault("PISTAT_STATE_DIR", tempfile.mkdtemp(prefix="pistat-test-"))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def emitted(monkeypatch):
+    events = []
+    monkeypatch.setattr(main.socketio, "emit", lambda event, *args, **kwargs: events.append(event))
+    monkeypatch.setattr(main, "broadcast_snapshot", lambda *args, **kwargs: events.append("snapshot"))
+    return events
+
+
+def online(monkeypatch, *pi_ids):
+    for pi_id in pi_ids:
+        monkeypatch.setitem(main.pi_sessions, pi_id, f"sid-{pi_id}")
+
+
+def test_concurrent_completions_finish_job_once(monkeypatch, emitted):
+    monkeypatch.setattr(main.registry, "upsert", lambda *args, **kwargs: None)
+    online(monkeypatch, "pi-a", "pi-b")
+
+    finished = []
+    dispatcher = main.FanoutDispatcher(max_concurrency=2)
+    job = dispatcher.start("uptime", {"command": ["uptime"]}, ["pi-a", "pi-b"], "ui-sid", on_finished=finished.append)
+    request_ids = list(dispatcher._jobs[job["job_id"]]["running"])
+    for request_id in request_ids:
+        main.remote_requests.pop(request_id, None)
+        main.remote_meta.pop(request_id, None)
+
+    # Both completions record their result before either pumps the job.
+    pump = dispatcher._pump
+    both_recorded = threading.Barrier(2, timeout=5)
+
+    def racing_pump(job, changed=False):
+        both_recorded.wait()
+        pump(job, changed)
+
+    dispatcher._pump = racing_pump
+    threads = [threading.Thread(target=dispatcher.complete, args=(request_id, 0)) for request_id in request_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert len(finished) == 1
+    assert finished[0]["ok"] == 2
+    assert emitted.count("job_finished") == 1
+
+
+def test_finished_members_go_back_to_idle(monkeypatch, emitted):
+    pi_ids = ["fleet-a", "fleet-b", "fleet-c"]
+    online(monkeypatch, *pi_ids)
+    for pi_id in pi_ids:
+        main.registry.upsert(pi_id, {"active_task": "Idle", "source": "pi"})
+    monkeypatch.setattr(main, "fanout", main.FanoutDispatcher(max_concurrency=3))
+
+    job = main.fanout.start("uptime", {"command": ["uptime"], "label": "Uptime"}, pi_ids, "ui-sid")
+    assert [main.registry.get(pi_id)["active_task"] for pi_id in pi_ids] == ["Uptime"] * 3
+    assert emitted.count("snapshot") == 1
+
+    running = dict(main.fanout._jobs[job["job_id"]]["running"])
+    emitted.clear()
+    for request_id, pi_id in running.items():
+        main.relay_to_ui("task_finished", {"request_id": request_id, "pi_id": pi_id, "exit_code": 0})
+
+    assert [main.registry.get(pi_id)["active_task"] for pi_id in pi_ids] == ["Idle"] * 3
+    # One snapshot per completion, not one per Pi plus one per pump.
+    assert emitted.count("snapshot") == 3
+    assert emitted.count("job_finished") == 1
@@ -0,0 +1,94 @@
+import time
+
+import metrics_store
+from metrics_store import MetricsSegmentStore, RollupRing
+
+
+def test_rollup_ring_ignores_samples_older_than_their_slot():
+    ring = RollupRing(step=1, slots=10)
+    ring.add(105.0, 1.0)
+    # Bucket 95 shares slot 5 with bucket 105 and must not evict it.
+    ring.add(95.0, 9.0)
+    ring.add(105.5, 3.0)
+    assert ring.read(95.0, 95.0, 1) == [[95, None]]
+    assert ring.read(105.0, 105.0, 1) == [[105, 2.0]]
+
+    ring.add(115.0, 4.0)
+    assert ring.read(105.0, 105.0, 1) == [[105, None]]
+    assert ring.read(115.0, 115.0, 1) == [[115, 4.0]]
+
+
+def test_followers_see_pis_added_after_they_started(tmp_path):
+    now = time.time()
+    leader = MetricsSegmentStore(tmp_path)
+    leader.append("pi-old", {"cpu_percent": 10.0}, now - 20)
+    leader.flush()
+    follower = MetricsSegmentStore(tmp_path)
+
+    leader.append("pi-new", {"cpu_percent": 20.0}, now - 10)
+    leader.flush()
+    result = follower.query("pi-new", "cpu_percent", now - 60, now, step=3600)
+    assert result is not None
+    assert [value for _bucket, value in result["points"] if value is not None] == [20.0]
+    assert [pi_id for _ts, pi_id, _values in follower.read(now - 60)] == ["pi-old", "pi-new"]
+
+
+def test_unknown_pi_rescans_are_rate_limited(tmp_path, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(metrics_store, "PIS_RESCAN_SECONDS", 3600.0)
+    leader = MetricsSegmentStore(tmp_path)
+    follower = MetricsSegmentStore(tmp_path)
+    assert follower.query("pi-new", "cpu_percent", now - 60, now) is None
+
+    leader.append("pi-new", {"cpu_percent": 20.0}, now - 10)
+    leader.flush()
+    assert follower.query("pi-new", "cpu_percent", now - 60, now) is None
+    monkeypatch.setattr(metrics_store, "PIS_RESCAN_SECONDS", 0.0)
+    assert follower.query("pi-new", "cpu_percent", now - 60, now) is not None
+
+
+def minute_store(tmp_path):
+    return MetricsSegmentStore(tmp_path, segment_seconds=60, compact_after=60, retention=120)
+
+
+def test_append_and_read_back(tmp_path):
+    store = minute_store(tmp_path)
+    now = time.time()
+    store.append("pi-a", {"cpu_percent": 12.5, "ram_percent": 40.0}, now - 2)
+    store.append_many("pi-b", [(now - 1, {"cpu_percent": 50.0}), (now, {"ram_used_gb": "bad"})])
+    rows = list(store.read(now - 5, now + 1))
+    assert rows == [
+        (now - 2, "pi-a", {"cpu_percent": 12.5, "ram_percent": 40.0}),
+        (now - 1, "pi-b", {"cpu_percent": 50.0}),
+        (now, "pi-b", {}),
+    ]
+    assert [row[1] for row in store.read(now - 5, now + 1, pi_id="pi-b")] == ["pi-b", "pi-b"]
+    assert list(store.read(now - 5, now + 1, pi_id="pi-unknown")) == []
+    assert store.query("pi-a", "temp_c", now - 5) is None
+
+
+def test_compaction_averages_each_minute(tmp_path):
+    store = minute_store(tmp_path)
+    minute = int(time.time() // 60) * 60
+    store.append_many("pi-a", [(minute + 1, {"cpu_percent": 10.0}), (minute + 2, {"cpu_percent": 20.0})])
+    store.append("pi-b", {"cpu_percent": 5.0, "ram_percent": 30.0}, minute + 3)
+
+    store.maintain(now=minute + 60 + 61, interval=0)
+    assert not (tmp_path / f"raw-{minute}.seg").exists()
+    assert (tmp_path / f"min-{minute}.seg").exists()
+    assert list(store.read(minute, minute + 59)) == [
+        (minute, "pi-a", {"cpu_percent": 15.0}),
+        (minute, "pi-b", {"cpu_percent": 5.0, "ram_percent": 30.0}),
+    ]
+
+    store.maintain(now=minute + 60 + 120 + 1, interval=0)
+    assert not (tmp_path / f"min-{minute}.seg").exists()
+
+
+def test_appends_to_compacted_segments_are_refused(tmp_path):
+    store = minute_store(tmp_path)
+    old = int(time.time() // 60) * 60 - 600
+    store.append("pi-a", {"cpu_percent": 10.0}, old)
+    store.flush()
+    assert not (tmp_path / f"raw-{old}.seg").exists()
+    assert list(store.read(old - 60, old + 60)) == []
@@ -0,0 +1,36 @@
+import logging
+import time
+
+from output_batcher import OutputBatcher
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_failed_batches_are_logged_and_counted_as_dropped(caplog):
+    sent = []
+
+    def emit(event, payload, target):
+        if event == "broken":
+            raise TypeError("not serializable")
+        sent.append((event, payload))
+
+    batcher = OutputBatcher(emit, max_lines=2, max_delay=0.01, logger=logging.getLogger("test-batcher"))
+    with caplog.at_level(logging.ERROR, logger="test-batcher"):
+        for line in ("a", "b", "c"):
+            batcher.write("bad", "broken", {}, line)
+        batcher.close("bad")
+        batcher.write("good", "task_output", {"request_id": "good"}, "ok")
+        batcher.close("good", "task_finished", {"request_id": "good"})
+        wait_for(lambda: any(event == "task_finished" for event, _ in sent))
+    batcher.stop()
+
+    assert [event for event, _ in sent] == ["task_output", "task_finished"]
+    stats = batcher.stats()
+    assert stats["dropped"] == 3
+    assert stats["buffered"] == 0
+    assert "Could not send broken" in caplog.text
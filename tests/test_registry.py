@@ -0,0 +1,83 @@
+import os
+import tempfile
+
+os.environ.setdefault("PISTAT_STATE_DIR", tempfile.mkdtemp(prefix="pistat-test-"))
+
+from main import PiRegistry  # noqa: E402
+
+
+def test_changes_since_reports_only_newer_fields():
+    registry = PiRegistry()
+    registry.upsert("pi-a", {"label": "Kitchen", "cpu_percent": 1.0})
+    registry.upsert("pi-b", {"label": "Garage"})
+    version, changes = registry.changes_since(0)
+    assert {change["pi_id"] for change in changes} == {"pi-a", "pi-b"}
+    assert changes[0]["label"] == "Kitchen"
+
+    registry.upsert("pi-a", {"cpu_percent": 55.0})
+    current, changes = registry.changes_since(version)
+    assert current == version + 1
+    assert changes == [
+        {"pi_id": "pi-a", "version": current, "cpu_percent": 55.0, "last_seen": registry.get("pi-a")["last_seen"]}
+    ]
+    assert registry.changes_since(current) == (current, [])
+
+
+def test_removed_fields_are_reported_as_none():
+    registry = PiRegistry()
+    registry.upsert("pi-a", {})
+    registry.set_assigned_task("pi-a", "backup")
+    version, _ = registry.changes_since(0)
+    registry.set_assigned_task("pi-a", None)
+    _, changes = registry.changes_since(version)
+    assert changes[0]["assigned_task"] is None
+    assert "assigned_task" not in registry.get("pi-a")
+
+
+def test_replicated_changes_are_applied_without_notifying():
+    notified = []
+    registry = PiRegistry(on_change=lambda pi_id, fields, removed: notified.append((pi_id, fields, removed)))
+    registry.upsert("pi-a", {"label": "Kitchen"})
+    assert notified[0][0] == "pi-a" and notified[0][1]["label"] == "Kitchen"
+
+    notified.clear()
+    version, _ = registry.changes_since(0)
+    registry.apply_changes("pi-a", {"active_task": "Backup"}, ["source"])
+    assert notified == []
+    _, changes = registry.changes_since(version)
+    assert changes == [{"pi_id": "pi-a", "version": version + 1, "active_task": "Backup", "source": None}]
+    # Applying the same change again is not a change.
+    registry.apply_changes("pi-a", {"active_task": "Backup"}, [])
+    assert registry.changes_since(version + 1) == (version + 1, [])
+
+
+def test_resolve_ref_by_id_label_prefix_and_substring():
+    registry = PiRegistry()
+    registry.upsert("pi-kitchen", {"label": "Kitchen Display"})
+    registry.upsert("pi-garage", {"label": "Garage Door"})
+    registry.upsert("pi-garden", {"label": "Garden Sensor"})
+
+    assert registry.resolve_ref("pi-kitchen")[0] == "pi-kitchen"
+    assert registry.resolve_ref("kitchen display")[0] == "pi-kitchen"
+    assert registry.resolve_ref("GARAGE")[0] == "pi-garage"
+    assert registry.resolve_ref("sensor")[0] == "pi-garden"
+    # "gar" starts both Garage and Garden; "pi-" starts every id.
+    assert registry.resolve_ref("gar") is None
+    assert registry.resolve_ref("pi-") is None
+    assert registry.resolve_ref("") is None
+    assert registry.resolve_ref("cellar") is None
+
+
+def test_relabel_updates_the_index():
+    registry = PiRegistry()
+    registry.upsert("pi-1", {"label": "Kitchen"})
+    registry.upsert("pi-1", {"label": "Pantry"})
+    assert registry.resolve_ref("kitchen") is None
+    assert registry.resolve_ref("pantry")[0] == "pi-1"
+
+    # A label shared by two Pis resolves to the first until it moves away.
+    registry.upsert("pi-2", {"label": "Pantry"})
+    assert registry.resolve_ref("pantry")[0] == "pi-1"
+    registry.upsert("pi-1", {"label": "Hall"})
+    assert registry.resolve_ref("pantry")[0] == "pi-2"
+    assert registry.resolve_ref("hall")[0] == "pi-1"
@@ -0,0 +1,72 @@
+import os
+import tempfile
+
+os.environ.setdefault("PISTAT_STATE_DIR", tempfile.mkdtemp(prefix="pistat-test-"))
+
+from main import ScrollbackStore  # noqa: E402
+
+
+def lines(prefix, count):
+    return [f"{prefix} {index}" for index in range(count)]
+
+
+def test_pages_walk_back_across_requests():
+    store = ScrollbackStore()
+    assert store.append("pi-1", "r1", lines("one", 10)) == 0
+    assert store.append("pi-1", "r2", lines("two", 5)) == 10
+
+    newest = store.page("pi-1", limit=4)
+    assert newest["chunks"] == [{"request_id": "r2", "first_seq": 11, "lines": lines("two", 5)[1:]}]
+    assert newest["more"] and newest["next_seq"] == 15
+
+    older = store.page("pi-1", before=11, limit=4)
+    assert older["chunks"] == [
+        {"request_id": "r1", "first_seq": 7, "lines": lines("one", 10)[7:]},
+        {"request_id": "r2", "first_seq": 10, "lines": ["two 0"]},
+    ]
+    assert older["more"]
+
+    oldest = store.page("pi-1", before=7, limit=100)
+    assert oldest["chunks"] == [{"request_id": "r1", "first_seq": 0, "lines": lines("one", 7)}]
+    assert not oldest["more"]
+    assert store.page("pi-1", before=0)["chunks"] == []
+
+
+def test_page_filters_by_request():
+    store = ScrollbackStore()
+    store.append("pi-1", "r1", ["a"])
+    store.append("pi-1", "r2", ["b"])
+    store.append("pi-1", "r1", ["c"])
+    page = store.page("pi-1", request_id="r1")
+    assert [chunk["lines"] for chunk in page["chunks"]] == [["a"], ["c"]]
+    assert store.page("pi-unknown") == {"pi_id": "pi-unknown", "chunks": [], "more": False, "next_seq": 0}
+
+
+def test_oldest_chunks_are_dropped_past_the_byte_limit():
+    store = ScrollbackStore(max_bytes_per_pi=1024, chunk_bytes=256)
+    for _ in range(20):
+        store.append("pi-1", "r1", ["x" * 99])
+    page = store.page("pi-1", limit=5000)
+    kept = [line for chunk in page["chunks"] for line in chunk["lines"]]
+    assert len(kept) * 100 <= 1024 + 256
+    assert page["chunks"][0]["first_seq"] == 20 - len(kept)
+    assert page["next_seq"] == 20 and not page["more"]
+
+
+def test_replicated_numbering_skips_missed_lines():
+    store = ScrollbackStore()
+    store.append("pi-1", "r1", ["a", "b"])
+    assert store.append("pi-1", "r1", ["k"], first_seq=10) == 10
+    page = store.page("pi-1")
+    assert [(chunk["first_seq"], chunk["lines"]) for chunk in page["chunks"]] == [(0, ["a", "b"]), (10, ["k"])]
+    assert store.page("pi-1", before=10)["chunks"] == [{"request_id": "r1", "first_seq": 0, "lines": ["a", "b"]}]
+
+
+def test_least_recently_written_pi_is_evicted():
+    store = ScrollbackStore(max_pis=2)
+    store.append("pi-1", None, ["a"])
+    store.append("pi-2", None, ["b"])
+    store.append("pi-1", None, ["c"])
+    store.append("pi-3", None, ["d"])
+    assert store.page("pi-2")["chunks"] == []
+    assert store.page("pi-1")["next_seq"] == 2
@@ -0,0 +1,56 @@
+import sqlite3
+
+from state_store import SqliteStateBackend
+
+
+def open_backend(tmp_path):
+    # The writer thread never gets a chance to flush before the test does.
+    return SqliteStateBackend(tmp_path / "state.db", flush_interval=60)
+
+
+def stored_labels(tmp_path):
+    with sqlite3.connect(str(tmp_path / "state.db")) as conn:
+        return dict(conn.execute("SELECT pi_id, label FROM labels"))
+
+
+def test_a_failing_write_does_not_drop_the_batch(tmp_path, caplog):
+    backend = open_backend(tmp_path)
+    backend.labels.set("pi-1", "One")
+    backend.queue("INSERT INTO labels (pi_id, label) VALUES (?, ?)", ("pi-bad", None))
+    backend.labels.set("pi-2", "Two")
+    backend.flush()
+    assert stored_labels(tmp_path) == {"pi-1": "One", "pi-2": "Two"}
+    assert "Dropping state write" in caplog.text
+    backend.close()
+
+
+def test_busy_database_keeps_the_batch_for_a_retry(tmp_path, caplog):
+    backend = open_backend(tmp_path)
+    backend._conn.execute("PRAGMA busy_timeout = 50")
+    other = sqlite3.connect(str(tmp_path / "state.db"), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    backend.labels.set("pi-1", "One")
+    backend.flush()
+    assert "busy" in caplog.text
+    other.execute("ROLLBACK")
+    other.close()
+
+    backend.labels.set("pi-2", "Two")
+    backend.flush()
+    assert stored_labels(tmp_path) == {"pi-1": "One", "pi-2": "Two"}
+    backend.close()
+
+
+def test_labels_are_loaded_up_front_and_has_means_stored(tmp_path):
+    backend = open_backend(tmp_path)
+    backend.labels.set("pi-1", "One")
+    backend.labels.set("pi-2", "Two")
+    backend.labels.remove("pi-2")
+    backend.close()
+
+    reopened = open_backend(tmp_path)
+    assert reopened.labels.get("pi-1") == "One"
+    assert reopened.labels.has("pi-1")
+    assert not reopened.labels.has("pi-2")
+    assert not reopened.labels.has("pi-3")
+    reopened.close()
@@ -0,0 +1,181 @@
+import json
+import math
+import random
+import zlib
+
+import pytest
+
+from wire import _MAP, _TABLE, COMPRESS_MIN_BYTES, FLAG_ZLIB, WIRE_VERSION, decode, encode
+
+
+def sample(ts, **extra):
+    return dict({"ts": ts, "cpu_percent": 12.5, "ram_percent": 40.25, "ram_used_gb": 1.234, "ram_total_gb": 3.7}, **extra)
+
+
+def test_stats_batch_round_trip():
+    payload = {
+        "active_task": "Idle",
+        "workers": {"running": 0, "queued": 0, "wait_avg_ms": 0.0, "wait_max_ms": 1.5},
+        "samples": [sample(1700000000.0 + index * 0.5) for index in range(300)],
+    }
+    assert decode(encode(payload)) == payload
+
+
+def test_stats_batch_with_missing_and_extra_keys():
+    samples = [sample(1.0), sample(2.0, temp_c=51.3), {"ts": 3.0}, sample(4.0, throttled=True, custom_metric="x")]
+    del samples[0]["ram_used_gb"]
+    payload = {"samples": samples}
+    assert decode(encode(payload)) == payload
+
+
+def test_floats_that_need_full_precision():
+    values = [0.1 + 0.2, 1e-9, -2.5e300, 1234567.891, 3.0]
+    payload = {"samples": [{"ts": float(index), "value": value} for index, value in enumerate(values)], "one": 0.1 + 0.2}
+    assert decode(encode(payload)) == payload
+
+
+def test_nan_and_infinity():
+    payload = {"samples": [{"temp_c": 40.5}, {"temp_c": float("nan")}, {"temp_c": float("inf")}], "load_1": float("nan")}
+    decoded = decode(encode(payload))
+    temps = [row["temp_c"] for row in decoded["samples"]]
+    assert temps[0] == 40.5 and math.isnan(temps[1]) and temps[2] == float("inf")
+    assert math.isnan(decoded["load_1"])
+
+
+def test_large_ints():
+    big = [0, 2**31, -(2**31) - 1, 2**63 - 1, -(2**63)]
+    huge = 2**80
+    payload = {"samples": [{"bytes": value} for value in big], "total": huge, "column": [{"n": 1}, {"n": huge}]}
+    assert decode(encode(payload)) == payload
+
+
+def test_bools_and_none_stay_distinct_from_ints():
+    payload = {"samples": [{"flag": True, "n": 1}, {"flag": False, "n": 0}, {"flag": None, "n": None}]}
+    decoded = decode(encode(payload))
+    assert decoded == payload
+    assert [type(row["flag"]) for row in decoded["samples"]] == [bool, bool, type(None)]
+
+
+def test_output_lines_round_trip():
+    lines = ["plain", "", "tab\tseparated", "unicode ✓ π", "carriage\rreturn"]
+    payload = {"request_id": "r1", "task_id": "uptime", "lines": lines, "truncated": 2}
+    assert decode(encode(payload)) == payload
+
+
+def test_output_lines_with_embedded_newlines():
+    lines = ["first\nsecond", "third", "\n"]
+    payload = {"request_id": "r1", "lines": lines}
+    assert decode(encode(payload))["lines"] == lines
+
+
+def test_output_lines_with_undecodable_bytes():
+    # Bytes that are not UTF-8 arrive as lone surrogates (surrogateescape).
+    raw = b"ok \xff\xfe bytes"
+    lines = [raw.decode("utf-8", "surrogateescape"), "fine"]
+    decoded = decode(encode({"lines": lines}))["lines"]
+    assert decoded == lines
+    assert decoded[0].encode("utf-8", "surrogateescape") == raw
+
+
+def test_omitted_keys_are_left_out():
+    frame = encode({"pi_id": "pi-1", "lines": ["a", "b"]}, omit=("pi_id",))
+    assert decode(frame) == {"lines": ["a", "b"]}
+
+
+def test_small_frames_are_not_compressed():
+    frame = encode({"lines": ["short"]})
+    assert frame[0] == WIRE_VERSION
+    assert not frame[1] & FLAG_ZLIB
+
+
+def test_large_frames_are_compressed():
+    payload = {"lines": [f"line {index} of repetitive output" for index in range(200)]}
+    frame = encode(payload)
+    assert frame[1] & FLAG_ZLIB
+    assert len(frame) < COMPRESS_MIN_BYTES
+    assert decode(frame) == payload
+
+
+def test_strings_are_interned_per_frame():
+    rows = [{"custom_metric_name": index} for index in range(50)]
+    frame = encode({"samples": rows, "other": [{"custom_metric_name": 1}, {"custom_metric_name": 2}]})
+    assert frame.count(b"custom_metric_name") == 1
+    assert decode(frame)["other"] == [{"custom_metric_name": 1}, {"custom_metric_name": 2}]
+
+
+def test_unencodable_values_raise_value_error():
+    with pytest.raises(ValueError):
+        encode({"value": object()})
+
+
+def test_smaller_than_json():
+    payload = {"samples": [sample(1700000000.0 + index) for index in range(300)]}
+    assert len(encode(payload)) * 3 < len(json.dumps(payload))
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [
+        b"",
+        b"\x01",
+        bytes((WIRE_VERSION + 1, 0)) + encode({"lines": ["a", "b"]})[2:],
+        bytes((WIRE_VERSION, FLAG_ZLIB)) + b"not zlib data",
+        bytes((WIRE_VERSION, 0, 99)),
+        bytes((WIRE_VERSION, 0)) + json.dumps({"a": 1}).encode(),
+    ],
+    ids=["empty", "header-only", "wrong-version", "bad-zlib", "unknown-tag", "json-text"],
+)
+def test_malformed_frames_raise_value_error(frame):
+    with pytest.raises(ValueError):
+        decode(frame)
+
+
+def test_truncated_frames_raise_value_error():
+    frame = encode({"pi_id": "x", "samples": [sample(float(index), temp_c=40.0 + index) for index in range(5)]})
+    assert not frame[1] & FLAG_ZLIB
+    for size in range(2, len(frame)):
+        with pytest.raises(ValueError):
+            decode(frame[:size])
+
+
+def test_trailing_data_raises_value_error():
+    with pytest.raises(ValueError):
+        decode(encode({"lines": ["a", "b"]}) + b"\x00")
+
+
+def test_corrupted_frames_never_raise_anything_else():
+    rng = random.Random(1234)
+    frames = [
+        encode({"samples": [sample(float(index), temp_c=41.5) for index in range(20)], "active_task": "Idle"}),
+        encode({"request_id": "r", "lines": [f"line {index}" for index in range(20)]}),
+        encode({"workers": {"running": 1}, "samples": [{"ts": 1.0}, {"ts": 2.0, "x": "y"}]}),
+    ]
+    for frame in frames:
+        for _ in range(300):
+            corrupted = bytearray(frame)
+            for _ in range(rng.randint(1, 4)):
+                corrupted[rng.randrange(2, len(corrupted))] = rng.randrange(256)
+            try:
+                decode(bytes(corrupted))
+            except ValueError:
+                pass
+
+
+def test_corrupted_compressed_frame():
+    frame = bytearray(encode({"lines": [f"line {index}" for index in range(300)]}))
+    assert frame[1] & FLAG_ZLIB
+    frame[len(frame) // 2] ^= 0xFF
+    with pytest.raises(ValueError):
+        decode(bytes(frame))
+
+
+def test_row_counts_larger_than_the_frame_are_rejected():
+    # A table header claiming 2**40 rows and no columns.
+    frame = bytes((WIRE_VERSION, 0, _MAP, 1, 7)) + bytes((_TABLE,)) + b"\x80\x80\x80\x80\x80\x20" + b"\x00"
+    with pytest.raises(ValueError):
+        decode(frame)
+
+
+def test_lists_of_empty_dicts_round_trip():
+    payload = {"samples": [{} for _ in range(1000)]}
+    assert decode(encode(payload)) == payload
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault("PISTAT_STATE_DIR", tempfile.mkdtemp(prefix="pistat-test-"))
+
+import main  # noqa: E402
+import pi_agent  # noqa: E402
+import pi_agent_async  # noqa: E402
+from wire import WIRE_FEATURE, WIRE_VERSION, decode, encode  # noqa: E402
+
+
+@pytest.fixture
+def agent_client():
+    client = main.socketio.test_client(main.app, namespace="/pi")
+    reply = client.emit("register", {"pi_id": "wire-test", "label": "Wire"}, namespace="/pi", callback=True)
+    assert WIRE_FEATURE in reply["features"]
+    yield client
+    client.disconnect(namespace="/pi")
+
+
+def test_controller_accepts_binary_stats_batch(agent_client):
+    frame = encode({"active_task": "Idle", "samples": [{"ts": 1.0, "cpu_percent": 5.5}, {"ts": 2.0, "cpu_percent": 6.5}]})
+    reply = agent_client.emit("stats_batch", frame, namespace="/pi", callback=True)
+    assert reply == {"status": "ok", "accepted": 2}
+    assert main.registry.get("wire-test")["cpu_percent"] == 6.5
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [bytes((WIRE_VERSION + 1, 0, 0)), bytes((WIRE_VERSION, 0, 99)), encode({"samples": [{"ts": 1.0}] * 4})[:-3]],
+    ids=["wrong-version", "unknown-tag", "truncated"],
+)
+def test_controller_rejects_malformed_stats_batch(agent_client, frame):
+    errors = main.wire_errors.value
+    reply = agent_client.emit("stats_batch", frame, namespace="/pi", callback=True)
+    assert "error" in reply
+    assert main.wire_errors.value == errors + 1
+
+
+class RejectingBinary:
+    """Stands in for the agent's socket: replies like a controller that cannot read binary frames."""
+
+    connected = True
+
+    def __init__(self):
+        self.frames = []
+
+    def reply(self, frame):
+        self.frames.append(frame)
+        return {"error": "Invalid payload."} if isinstance(frame, bytes) else {"status": "ok"}
+
+    def call(self, event, frame, namespace=None, timeout=None):
+        return self.reply(frame)
+
+
+class AsyncRejectingBinary(RejectingBinary):
+    async def call(self, event, frame, namespace=None, timeout=None):
+        return self.reply(frame)
+
+
+def buffer_samples(agent):
+    agent._controller_features = ["stats_batch", WIRE_FEATURE]
+    agent._binary_wire = True
+    agent._samples.extend({"ts": float(index), "cpu_percent": 1.0} for index in range(3))
+
+
+def test_threaded_agent_falls_back_to_json():
+    agent = pi_agent.PiAgent("http://controller", "pi-1", "Pi", log_level="WARNING")
+    agent._sio = RejectingBinary()
+    buffer_samples(agent)
+    agent._report_stats()
+    first, second = agent._sio.frames
+    assert isinstance(first, bytes) and decode(first)["samples"] == second["samples"]
+    assert not agent._binary_wire
+    assert not agent._samples
+
+
+def test_async_agent_falls_back_to_json():
+    agent = pi_agent_async.AsyncPiAgent("http://controller", "pi-1", "Pi", log_level="WARNING")
+    agent._sio = AsyncRejectingBinary()
+    buffer_samples(agent)
+    asyncio.run(agent._report_stats())
+    first, second = agent._sio.frames
+    assert isinstance(first, bytes) and decode(first)["samples"] == second["samples"]
+    assert not agent._binary_wire
+    assert not agent._samples
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from worker_pool import AsyncWorkerPool, PoolFull, WorkerPool, popen_group_kwargs
+
+
+def test_failed_job_is_logged_and_reported(caplog):
+    reported = []
+    done = threading.Event()
+    pool = WorkerPool(max_workers=1, logger=logging.getLogger("test-pool"))
+
+    def fail(job):
+        raise RuntimeError("boom")
+
+    def on_error(exc):
+        reported.append(str(exc))
+        done.set()
+
+    with caplog.at_level(logging.ERROR, logger="test-pool"):
+        pool.submit("job-1", fail, on_error=on_error)
+        assert done.wait(5)
+    assert reported == ["boom"]
+    assert "Job job-1 failed" in caplog.text
+
+
+def test_async_failed_job_awaits_its_report(caplog):
+    reported = []
+
+    async def main():
+        pool = AsyncWorkerPool(max_workers=1, logger=logging.getLogger("test-pool"))
+
+        async def fail(job):
+            raise RuntimeError("boom")
+
+        async def on_error(exc):
+            reported.append(str(exc))
+
+        pool.submit("job-1", fail, on_error=on_error)
+        while pool.stats()["completed"] < 1:
+            await asyncio.sleep(0.01)
+
+    with caplog.at_level(logging.ERROR, logger="test-pool"):
+        asyncio.run(main())
+    assert reported == ["boom"]
+    assert "Job job-1 failed" in caplog.text
+
+
+def blocked_pool(**kwargs):
+    """A one-worker pool whose worker is held by a job until the returned event is set."""
+    pool = WorkerPool(max_workers=1, **kwargs)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(job):
+        started.set()
+        release.wait(5)
+
+    assert pool.submit("blocker", block) == 0
+    assert started.wait(5)
+    return pool, release
+
+
+def wait_for_completed(pool, count):
+    for _ in range(500):
+        if pool.stats()["completed"] >= count:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError(f"only {pool.stats()['completed']} of {count} jobs completed")
+
+
+def test_queued_jobs_run_by_priority_then_arrival():
+    pool, release = blocked_pool()
+    ran = []
+    assert pool.submit("low", lambda job: ran.append("low"), priority=5) == 1
+    assert pool.submit("high", lambda job: ran.append("high"), priority=1) == 1
+    assert pool.submit("high-2", lambda job: ran.append("high-2"), priority=1) == 2
+    assert pool.submit("normal", lambda job: ran.append("normal")) == 1
+    release.set()
+    wait_for_completed(pool, 5)
+    assert ran == ["normal", "high", "high-2", "low"]
+
+
+def test_full_queue_rejects_submissions():
+    pool, release = blocked_pool(max_queue=1)
+    pool.submit("waiting", lambda job: None)
+    with pytest.raises(PoolFull):
+        pool.submit("rejected", lambda job: None)
+    release.set()
+    wait_for_completed(pool, 2)
+    assert pool.stats()["rejected"] == 1
+
+
+def test_cancel_queued_job_never_runs():
+    pool, release = blocked_pool()
+    ran = []
+    pool.submit("queued", lambda job: ran.append("queued"))
+    pool.submit("kept", lambda job: ran.append("kept"))
+    assert pool.cancel("queued") == "queued"
+    assert pool.cancel("queued") is None
+    release.set()
+    wait_for_completed(pool, 2)
+    assert ran == ["kept"]
+    assert pool.stats()["cancelled"] == 1
+
+
+def test_cancel_running_job_stops_its_process():
+    pool = WorkerPool(max_workers=1, kill_grace=0.5)
+    attached = threading.Event()
+    result = {}
+
+    def run(job):
+        process = subprocess.Popen(
+            [sys.executable, "-c", "import time; time.sleep(30)"], stdout=subprocess.PIPE, text=True, **popen_group_kwargs()
+        )
+        job.attach(process)
+        attached.set()
+        result["lines"] = list(job.read_lines(process))
+        result["exit_code"] = process.wait(5)
+        result["message"] = job.stop_message()
+
+    pool.submit("job-1", run)
+    assert attached.wait(5)
+    assert pool.cancel("job-1") == "running"
+    wait_for_completed(pool, 1)
+    assert result["lines"] == []
+    assert result["exit_code"] != 0
+    assert result["message"] == "Cancelled"
+    assert pool.stats()["cancelled"] == 1
@@ -0,0 +1,440 @@
+from __future__ import annotations
+
+import json
+import math
+import struct
+import zlib
+from itertools import accumulate
+from operator import itemgetter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+# First byte of every frame. Changing the layout or STATIC_STRINGS needs a new version.
+WIRE_VERSION = 1
+# Advertised in CONTROLLER_FEATURES; agents only send frames to controllers that list it.
+WIRE_FEATURE = f"binary_wire_v{WIRE_VERSION}"
+# Bodies at least this big are zlib-compressed when that makes them smaller.
+COMPRESS_MIN_BYTES = 1024
+FLAG_ZLIB = 1
+
+# Strings both ends know, so frames refer to them by position instead of sending them.
+STATIC_STRINGS: Tuple[str, ...] = (
+    "ts",
+    "pi_id",
+    "request_id",
+    "task_id",
+    "active_task",
+    "workers",
+    "samples",
+    "lines",
+    "line",
+    "dropped",
+    "truncated",
+    "cpu_percent",
+    "ram_percent",
+    "ram_used_gb",
+    "ram_total_gb",
+    "cpu_iowait_percent",
+    "swap_percent",
+    "load_1",
+    "load_5",
+    "load_15",
+    "net_rx_bytes_per_sec",
+    "net_tx_bytes_per_sec",
+    "disk_read_bytes_per_sec",
+    "disk_write_bytes_per_sec",
+    "temp_c",
+    "throttled",
+    "collect_cpu_ms",
+    "completed",
+    "rejected",
+    "cancelled",
+    "timed_out",
+    "max_workers",
+    "running",
+    "queued",
+    "wait_avg_ms",
+    "wait_max_ms",
+    "Idle",
+)
+_STATIC_REFS = {text: index + 1 for index, text in enumerate(STATIC_STRINGS)}
+
+# Value tags.
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _DECIMAL, _STR, _LIST, _MAP, _TABLE, _STRINGS, _JSON, _LINES = range(13)
+# Table column layouts.
+_COL_INT32, _COL_INT64, _COL_SCALED32, _COL_FLOAT64, _COL_VALUES = range(5)
+_INT32 = (-(2**31), 2**31 - 1)
+_INT64 = (-(2**63), 2**63 - 1)
+
+
+def encode(payload: Dict[str, Any], omit: Iterable[str] = ()) -> bytes:
+    """Encode a /pi event payload as a binary frame, leaving out the ``omit`` keys.
+
+    Raises ValueError for values the format cannot carry; send those as JSON.
+    """
+    skip = set(omit)
+    encoder = _Encoder()
+    encoder.value({key: value for key, value in payload.items() if key not in skip})
+    body = bytes(encoder.out)
+    flags = 0
+    if len(body) >= COMPRESS_MIN_BYTES:
+        packed = zlib.compress(body, 1)
+        if len(packed) < len(body):
+            body, flags = packed, FLAG_ZLIB
+    return bytes((WIRE_VERSION, flags)) + body
+
+
+def decode(data: bytes) -> Dict[str, Any]:
+    """Decode a frame made by :func:`encode`. Raises ValueError if it is malformed."""
+    if len(data) < 2 or data[0] != WIRE_VERSION:
+        raise ValueError("not a binary_wire frame of a supported version")
+    body = bytes(data[2:])
+    if data[1] & FLAG_ZLIB:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as exc:
+            raise ValueError(f"corrupt frame: {exc}") from None
+    decoder = _Decoder(body)
+    try:
+        payload = decoder.value()
+    except (IndexError, KeyError, struct.error, UnicodeDecodeError, json.JSONDecodeError) as exc:
+        raise ValueError(f"corrupt frame: {exc!r}") from None
+    if not isinstance(payload, dict) or decoder.pos != len(body):
+        raise ValueError("corrupt frame: trailing data or no payload")
+    return payload
+
+
+def _decimal_digits(value: float) -> int:
+    """Fewest decimals (0-3) that represent ``value`` exactly, or -1."""
+    if not math.isfinite(value) or abs(value) >= 2**31:
+        return -1
+    for digits in range(4):
+        scale = 10**digits
+        if round(value * scale) / scale == value:
+            return digits
+    return -1
+
+
+def _scaled(values: List[float]) -> Optional[Tuple[int, List[int]]]:
+    """The column as int32s scaled by 10**digits (0-3), if that round-trips exactly."""
+    first = _decimal_digits(values[0])
+    if first < 0:
+        return None
+    for digits in range(first, 4):
+        scale = 10**digits
+        try:
+            scaled = [round(item * scale) for item in values]
+        except (OverflowError, ValueError):
+            # inf or nan
+            return None
+        if min(scaled) >= _INT32[0] and max(scaled) <= _INT32[1] and [number / scale for number in scaled] == values:
+            return digits, scaled
+    return None
+
+
+class _Encoder:
+    """Writes tagged values; strings used as keys are sent once per frame and then referenced."""
+
+    def __init__(self) -> None:
+        self.out = bytearray()
+        self._refs = dict(_STATIC_REFS)
+
+    def varint(self, number: int) -> None:
+        out = self.out
+        while number >= 0x80:
+            out.append((number & 0x7F) | 0x80)
+            number >>= 7
+        out.append(number)
+
+    def zigzag(self, number: int) -> None:
+        self.varint(number * 2 if number >= 0 else -number * 2 - 1)
+
+    def text(self, value: str) -> None:
+        data = value.encode("utf-8", "surrogatepass")
+        self.varint(len(data))
+        self.out += data
+
+    def ref(self, value: str) -> None:
+        ref = self._refs.get(value)
+        if ref is not None:
+            self.varint(ref)
+            return
+        # 0 introduces a new string; it takes the next reference number.
+        self.varint(0)
+        self.text(value)
+        self._refs[value] = len(self._refs) + 1
+
+    def value(self, value: Any) -> None:
+        out = self.out
+        if value is None:
+            out.append(_NONE)
+        elif value is True or value is False:
+            out.append(_TRUE if value else _FALSE)
+        elif isinstance(value, int):
+            if not _INT64[0] <= value <= _INT64[1]:
+                self._json(value)
+                return
+            out.append(_INT)
+            self.zigzag(value)
+        elif isinstance(value, float):
+            digits = _decimal_digits(value)
+            if digits < 0:
+                out.append(_FLOAT)
+                out += struct.pack("<d", value)
+            else:
+                out.append(_DECIMAL)
+                out.append(digits)
+                self.zigzag(round(value * 10**digits))
+        elif isinstance(value, str):
+            out.append(_STR)
+            self.text(value)
+        elif isinstance(value, dict):
+            if not all(isinstance(key, str) for key in value):
+                self._json(value)
+                return
+            out.append(_MAP)
+            self.varint(len(value))
+            for key, item in value.items():
+                self.ref(key)
+                self.value(item)
+        elif isinstance(value, (list, tuple)):
+            if len(value) > 1 and all(isinstance(item, dict) for item in value):
+                self._table(value)
+            elif len(value) > 1 and all(isinstance(item, str) for item in value):
+                self._strings(value)
+            else:
+                out.append(_LIST)
+                self.varint(len(value))
+                for item in value:
+                    self.value(item)
+        else:
+            self._json(value)
+
+    def _json(self, value: Any) -> None:
+        try:
+            data = json.dumps(value).encode("utf-8")
+        except (TypeError, ValueError) as exc:
+            raise ValueError(f"cannot encode {type(value).__name__}: {exc}") from None
+        self.out.append(_JSON)
+        self.varint(len(data))
+        self.out += data
+
+    def _strings(self, values: List[str]) -> None:
+        joined = "\n".join(values)
+        if joined.count("\n") == len(values) - 1:
+            # Output lines never contain a newline: one blob the decoder splits.
+            self.out.append(_LINES)
+            self.text(joined)
+            return
+        # Otherwise one UTF-8 blob plus character lengths: the decoder decodes once and slices.
+        self.out.append(_STRINGS)
+        self.varint(len(values))
+        self.out += struct.pack(f"<{len(values)}I", *(len(item) for item in values))
+        self.text("".join(values))
+
+    def _table(self, rows: List[Dict[str, Any]]) -> None:
+        """A list of dicts (stats samples) as columns: keys once, numbers as packed arrays."""
+        first = rows[0].keys()
+        # Samples from one agent usually all carry the same fields.
+        uniform = all(row.keys() == first for row in rows)
+        keys = list(first) if uniform else list(dict.fromkeys(key for row in rows for key in row))
+        if not keys:
+            # Columns carry the rows; rows of nothing go as a plain list.
+            self.out.append(_LIST)
+            self.varint(len(rows))
+            self.out += bytes((_MAP, 0)) * len(rows)
+            return
+        if not all(isinstance(key, str) for key in keys):
+            self._json(rows)
+            return
+        self.out.append(_TABLE)
+        self.varint(len(rows))
+        self.varint(len(keys))
+        for key in keys:
+            self.ref(key)
+            if uniform:
+                values = list(map(itemgetter(key), rows))
+                self.out.append(0)
+                self._column(values)
+                continue
+            present = [key in row for row in rows]
+            values = [row[key] for row in rows if key in row]
+            if all(present):
+                self.out.append(0)
+            else:
+                self.out.append(1)
+                bitmap = bytearray((len(rows) + 7) // 8)
+                for index, flag in enumerate(present):
+                    if flag:
+                        bitmap[index // 8] |= 1 << (index % 8)
+                self.out += bitmap
+            self._column(values)
+
+    def _column(self, values: List[Any]) -> None:
+        out = self.out
+        count = len(values)
+        types = set(map(type, values))
+        if types == {int}:
+            low, high = min(values), max(values)
+            if low >= _INT32[0] and high <= _INT32[1]:
+                out.append(_COL_INT32)
+                out += struct.pack(f"<{count}i", *values)
+                return
+            if low >= _INT64[0] and high <= _INT64[1]:
+                out.append(_COL_INT64)
+                out += struct.pack(f"<{count}q", *values)
+                return
+        elif types == {float}:
+            scaled = _scaled(values)
+            if scaled is not None:
+                out.append(_COL_SCALED32)
+                out.append(scaled[0])
+                out += struct.pack(f"<{count}i", *scaled[1])
+            else:
+                out.append(_COL_FLOAT64)
+                out += struct.pack(f"<{count}d", *values)
+            return
+        out.append(_COL_VALUES)
+        for item in values:
+            self.value(item)
+
+
+class _Decoder:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.pos = 0
+        self._strings: List[str] = list(STATIC_STRINGS)
+
+    def varint(self) -> int:
+        data = self.data
+        byte = data[self.pos]
+        if byte < 0x80:
+            self.pos += 1
+            return byte
+        result = shift = 0
+        while True:
+            byte = data[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def zigzag(self) -> int:
+        number = self.varint()
+        return number >> 1 if not number & 1 else -((number + 1) >> 1)
+
+    def text(self) -> str:
+        size = self.varint()
+        start = self.pos
+        self.pos += size
+        if self.pos > len(self.data):
+            raise IndexError("string runs past the end of the frame")
+        return self.data[start : self.pos].decode("utf-8", "surrogatepass")
+
+    def ref(self) -> str:
+        ref = self.varint()
+        if ref == 0:
+            value = self.text()
+            self._strings.append(value)
+            return value
+        if ref > len(self._strings):
+            raise KeyError(f"unknown string reference {ref}")
+        return self._strings[ref - 1]
+
+    def unpack(self, fmt: str, count: int) -> Tuple[Any, ...]:
+        layout = f"<{count}{fmt}"
+        values = struct.unpack_from(layout, self.data, self.pos)
+        self.pos += struct.calcsize(layout)
+        return values
+
+    def value(self) -> Any:
+        tag = self.data[self.pos]
+        self.pos += 1
+        # Most frequent tags first.
+        if tag == _DECIMAL:
+            digits = self.data[self.pos]
+            self.pos += 1
+            return self.zigzag() / 10**digits
+        if tag == _INT:
+            return self.zigzag()
+        if tag == _MAP:
+            count = self.varint()
+            result: Dict[str, Any] = {}
+            for _ in range(count):
+                key = self.ref()
+                result[key] = self.value()
+            return result
+        if tag == _STR:
+            return self.text()
+        if tag == _FLOAT:
+            return self.unpack("d", 1)[0]
+        if tag == _NONE:
+            return None
+        if tag == _FALSE:
+            return False
+        if tag == _TRUE:
+            return True
+        if tag == _LIST:
+            return [self.value() for _ in range(self.varint())]
+        if tag == _LINES:
+            return self.text().split("\n")
+        if tag == _STRINGS:
+            count = self.varint()
+            lengths = self.unpack("I", count)
+            blob = self.text()
+            ends = list(accumulate(lengths))
+            if ends and ends[-1] != len(blob):
+                raise IndexError("string lengths do not match their text")
+            return [blob[end - size : end] for size, end in zip(lengths, ends)]
+        if tag == _TABLE:
+            return self._table()
+        if tag == _JSON:
+            return json.loads(self.text())
+        raise KeyError(f"unknown value tag {tag}")
+
+    def _table(self) -> List[Dict[str, Any]]:
+        count = self.varint()
+        # Every row takes at least a bit of the frame, so a corrupt count
+        # cannot make us allocate rows that were never sent.
+        if count > len(self.data) * 8:
+            raise IndexError("table has more rows than the frame can hold")
+        keys: List[str] = []
+        columns: List[Sequence[Any]] = []
+        # Columns some rows lack: key, the rows that have it, their values.
+        sparse: List[Tuple[str, List[int], Sequence[Any]]] = []
+        for _ in range(self.varint()):
+            key = self.ref()
+            full = self.data[self.pos] == 0
+            self.pos += 1
+            if full:
+                keys.append(key)
+                columns.append(self._column(count))
+                continue
+            size = (count + 7) // 8
+            bitmap = self.data[self.pos : self.pos + size]
+            self.pos += size
+            indexes = [index for index in range(count) if bitmap[index // 8] >> (index % 8) & 1]
+            sparse.append((key, indexes, self._column(len(indexes))))
+        rows = [dict(zip(keys, values)) for values in zip(*columns)] if columns else [{} for _ in range(count)]
+        for key, indexes, values in sparse:
+            for index, item in zip(indexes, values):
+                rows[index][key] = item
+        return rows
+
+    def _column(self, count: int) -> Sequence[Any]:
+        layout = self.data[self.pos]
+        self.pos += 1
+        if layout == _COL_INT32:
+            return self.unpack("i", count)
+        if layout == _COL_INT64:
+            return self.unpack("q", count)
+        if layout == _COL_SCALED32:
+            scale = 10 ** self.data[self.pos]
+            self.pos += 1
+            return [item / scale for item in self.unpack("i", count)]
+        if layout == _COL_FLOAT64:
+            return self.unpack("d", count)
+        if layout == _COL_VALUES:
+            return [self.value() for _ in range(count)]
+        raise KeyError(f"unknown column layout {layout}")
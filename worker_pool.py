@@ -0,0 +1,440 @@
+from __future__ import annotations
+
+import asyncio
+import codecs
+import heapq
+import inspect
+import io
+import itertools
+import logging
+import os
+import selectors
+import signal
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+# How often a reader blocked on an idle pipe checks whether its job was killed.
+KILLED_POLL_SECONDS = 0.5
+
+
+def popen_group_kwargs() -> Dict[str, Any]:
+    """Popen arguments that put the child in its own process group (POSIX only)."""
+    return {"start_new_session": True} if os.name == "posix" else {}
+
+
+def _send_signal(process: Any, sig: int) -> None:
+    try:
+        if os.name == "posix":
+            # Children started with popen_group_kwargs() lead their own group.
+            os.killpg(process.pid, sig)
+        elif sig == getattr(signal, "SIGKILL", None):
+            process.kill()
+        else:
+            process.terminate()
+    except (ProcessLookupError, PermissionError):
+        try:
+            process.send_signal(sig)
+        except OSError:
+            pass
+    except OSError:
+        pass
+
+
+def _is_alive(process: Any) -> bool:
+    # subprocess.Popen needs poll(); asyncio processes update returncode themselves.
+    poll = getattr(process, "poll", None)
+    return (poll() if poll is not None else process.returncode) is None
+
+
+def terminate_process(
+    process: Any,
+    grace: float = 5.0,
+    on_killed: Optional[Callable[[], None]] = None,
+    output_done: Optional[Callable[[], bool]] = None,
+) -> None:
+    """Send SIGTERM to the process group, then SIGKILL to the group after ``grace`` seconds.
+
+    ``process`` may be a :class:`subprocess.Popen` or an asyncio subprocess.
+    The group is killed even if its leader has exited, since children that
+    ignore SIGTERM would otherwise keep the output pipe open, unless
+    ``output_done()`` says the pipe has reached EOF as well: the group may be
+    empty by then and its id reused. ``on_killed`` is called once the grace
+    period is over.
+    """
+    posix = os.name == "posix"
+
+    def finished() -> bool:
+        # With the pipe at EOF and the leader gone there is nothing left to
+        # stop, and the group id may already belong to a new session.
+        return output_done is not None and output_done() and not _is_alive(process)
+
+    if finished() or (not posix and not _is_alive(process)):
+        return
+    # Children started with popen_group_kwargs() lead their own group.
+    pgid = process.pid
+    _send_signal(process, signal.SIGTERM)
+
+    def escalate() -> None:
+        if not finished():
+            if posix:
+                try:
+                    os.killpg(pgid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    pass
+            elif _is_alive(process):
+                _send_signal(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+        if on_killed is not None:
+            on_killed()
+
+    timer = threading.Timer(max(0.0, grace), escalate)
+    timer.daemon = True
+    timer.start()
+
+
+class PoolFull(RuntimeError):
+    """Raised by :meth:`WorkerPool.submit` when the queue is already at ``max_queue``."""
+
+
+class PoolJob:
+    """Handle passed to a job function while it runs.
+
+    The function registers its subprocess with :meth:`attach` so the pool can
+    stop its process group when the job times out, is cancelled, or produces
+    more than ``max_output_bytes`` (see :meth:`count_output`).
+    """
+
+    def __init__(
+        self,
+        key: str,
+        timeout: Optional[float],
+        max_output_bytes: Optional[int] = None,
+        kill_grace: float = 5.0,
+    ) -> None:
+        self.key = key
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self.kill_grace = kill_grace
+        self.waited = 0.0
+        self.output_bytes = 0
+        # Called with the exception if the job function raises.
+        self.on_error: Optional[Callable[[Exception], Any]] = None
+        # "timeout", "cancelled" or "output_limit" once the job has been stopped.
+        self.stop_reason: Optional[str] = None
+        self._process: Any = None
+        self._lock = threading.Lock()
+        self._killed = threading.Event()
+        self._output_done = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.stop_reason == "cancelled"
+
+    @property
+    def timed_out(self) -> bool:
+        return self.stop_reason == "timeout"
+
+    @property
+    def killed(self) -> bool:
+        """True once the job's process group has been sent SIGKILL."""
+        return self._killed.is_set()
+
+    def output_ended(self) -> None:
+        """Record that the attached process's output pipe has reached EOF."""
+        self._output_done.set()
+
+    def attach(self, process: Any) -> None:
+        with self._lock:
+            self._process = process
+            stopped = self.stop_reason is not None
+        if stopped:
+            terminate_process(process, self.kill_grace, self._killed.set, self._output_done.is_set)
+
+    def stop(self, reason: str) -> None:
+        with self._lock:
+            if self.stop_reason is None:
+                self.stop_reason = reason
+            process = self._process
+        if process is not None:
+            terminate_process(process, self.kill_grace, self._killed.set, self._output_done.is_set)
+
+    def count_output(self, size: int) -> bool:
+        """Account ``size`` bytes of output; returns False once the limit is exceeded."""
+        self.output_bytes += size
+        if self.max_output_bytes and self.output_bytes > self.max_output_bytes:
+            self.stop("output_limit")
+            return False
+        return self.stop_reason is None
+
+    def read_lines(self, process: Any) -> Iterator[str]:
+        """Yield the lines of a text-mode :class:`subprocess.Popen`'s stdout until EOF.
+
+        Reading also ends once the job has been killed and the pipe is idle: a
+        process that left the group (a daemonizing grandchild, say) could hold
+        it open for good. The pipe is closed when reading ends.
+        """
+        stream = process.stdout
+        if os.name != "posix":
+            yield from stream
+            self.output_ended()
+            return
+        fd = stream.fileno()
+        # Decode like the text stream would, universal newlines included.
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(stream.encoding)(stream.errors), True)
+        partial = ""
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(fd, selectors.EVENT_READ)
+                while True:
+                    if not selector.select(KILLED_POLL_SECONDS):
+                        if self.killed:
+                            break
+                        continue
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        self.output_ended()
+                        break
+                    lines = (partial + decoder.decode(chunk)).split("\n")
+                    partial = lines.pop()
+                    for line in lines:
+                        yield line + "\n"
+            partial += decoder.decode(b"", True)
+            if partial:
+                yield partial
+        finally:
+            stream.close()
+
+    def stop_message(self) -> Optional[str]:
+        if self.stop_reason == "timeout":
+            return f"Timed out after {self.timeout:g}s"
+        if self.stop_reason == "cancelled":
+            return "Cancelled"
+        if self.stop_reason == "output_limit":
+            return f"Output limit of {self.max_output_bytes} bytes exceeded"
+        return None
+
+
+class _BasePool:
+    """Queue bookkeeping shared by :class:`WorkerPool` and :class:`AsyncWorkerPool`."""
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_queue: int,
+        name: str,
+        kill_grace: float,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.kill_grace = max(0.0, kill_grace)
+        self.logger = logger or logging.getLogger("pistat-worker-pool")
+        self._name = name
+        self._cond = threading.Condition()
+        self._queue: List[Tuple[int, int, str, Callable[[PoolJob], Any], PoolJob, float]] = []
+        self._queued: Dict[str, PoolJob] = {}
+        self._running: Dict[str, PoolJob] = {}
+        self._order = itertools.count()
+        self._stats = {"completed": 0, "rejected": 0, "cancelled": 0, "timed_out": 0}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._started = 0
+
+    def submit(
+        self,
+        key: str,
+        fn: Callable[[PoolJob], Any],
+        priority: int = 0,
+        timeout: Optional[float] = None,
+        max_output_bytes: Optional[int] = None,
+        on_error: Optional[Callable[[Exception], Any]] = None,
+    ) -> int:
+        """Queue ``fn`` under ``key``; returns its 1-based place in the queue, or 0 if it starts now.
+
+        If ``fn`` raises, the error is logged and passed to ``on_error`` (which
+        may be a coroutine function in :class:`AsyncWorkerPool`), so the
+        requester can still be told that the job ended.
+        """
+        job = PoolJob(
+            key,
+            timeout if timeout and timeout > 0 else None,
+            max_output_bytes if max_output_bytes and max_output_bytes > 0 else None,
+            self.kill_grace,
+        )
+        job.on_error = on_error
+        with self._cond:
+            free = self.max_workers - len(self._running)
+            if len(self._queue) - free >= self.max_queue:
+                self._stats["rejected"] += 1
+                raise PoolFull(f"{len(self._queue)} requests already waiting")
+            order = next(self._order)
+            ahead = sum(1 for entry in self._queue if (entry[0], entry[1]) < (priority, order))
+            heapq.heappush(self._queue, (priority, order, key, fn, job, time.monotonic()))
+            self._queued[key] = job
+            self._wake()
+            return max(0, ahead - free + 1)
+
+    def cancel(self, key: str) -> Optional[str]:
+        """Cancel ``key``: returns "queued" or "running" for what was stopped, else None."""
+        with self._cond:
+            job = self._queued.pop(key, None)
+            if job is not None:
+                self._queue = [entry for entry in self._queue if entry[2] != key]
+                heapq.heapify(self._queue)
+                job.stop_reason = "cancelled"
+                self._stats["cancelled"] += 1
+                return "queued"
+            job = self._running.get(key)
+            if job is None:
+                return None
+            self._stats["cancelled"] += 1
+        job.stop("cancelled")
+        return "running"
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats.update(
+                {
+                    "max_workers": self.max_workers,
+                    "running": len(self._running),
+                    "queued": len(self._queue),
+                    "wait_avg_ms": round(self._wait_total / self._started * 1000.0, 1) if self._started else 0.0,
+                    "wait_max_ms": round(self._wait_max * 1000.0, 1),
+                }
+            )
+            return stats
+
+    def _wake(self) -> None:
+        """Called with the lock held after a job is queued."""
+        raise NotImplementedError
+
+    def _take(self) -> Optional[Tuple[str, Callable[[PoolJob], Any], PoolJob]]:
+        """Move the next queued job to running; call with the lock held."""
+        if not self._queue:
+            return None
+        _, _, key, fn, job, queued_at = heapq.heappop(self._queue)
+        self._queued.pop(key, None)
+        self._running[key] = job
+        job.waited = time.monotonic() - queued_at
+        self._started += 1
+        self._wait_total += job.waited
+        self._wait_max = max(self._wait_max, job.waited)
+        return key, fn, job
+
+    def _failed(self, key: str, job: PoolJob, exc: Exception) -> Any:
+        """Log a job that raised and hand the error to its ``on_error``; returns what that returned."""
+        self.logger.error("Job %s failed", key, exc_info=exc)
+        if job.on_error is None:
+            return None
+        try:
+            return job.on_error(exc)
+        except Exception:
+            self.logger.exception("Could not report the failure of job %s", key)
+            return None
+
+    def _finish(self, key: str, job: PoolJob) -> None:
+        """Record a finished job; call with the lock held."""
+        self._running.pop(key, None)
+        self._stats["completed"] += 1
+        if job.timed_out:
+            self._stats["timed_out"] += 1
+
+
+class WorkerPool(_BasePool):
+    """Run submitted jobs on at most ``max_workers`` threads.
+
+    Waiting jobs are ordered by priority (lower first) and then by arrival. At
+    most ``max_queue`` jobs may wait; further submissions raise :class:`PoolFull`.
+    Each job may have a ``timeout`` after which its attached process group gets
+    SIGTERM, then SIGKILL ``kill_grace`` seconds later. Worker threads are
+    started on demand and exit when the queue is empty.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        max_queue: int = 100,
+        name: str = "worker",
+        kill_grace: float = 5.0,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        super().__init__(max_workers, max_queue, name, kill_grace, logger)
+        self._workers = 0
+
+    def _wake(self) -> None:
+        if self._workers < self.max_workers and len(self._queue) > self._workers - len(self._running):
+            self._workers += 1
+            threading.Thread(target=self._work, daemon=True, name=f"{self._name}-{self._workers}").start()
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                taken = self._take()
+                if taken is None:
+                    self._workers -= 1
+                    return
+            key, fn, job = taken
+            timer: Optional[threading.Timer] = None
+            if job.timeout:
+                timer = threading.Timer(job.timeout, job.stop, args=("timeout",))
+                timer.daemon = True
+                timer.start()
+            try:
+                fn(job)
+            except Exception as exc:  # job failures must not kill the worker
+                self._failed(key, job, exc)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                with self._cond:
+                    self._finish(key, job)
+
+
+class AsyncWorkerPool(_BasePool):
+    """asyncio counterpart of :class:`WorkerPool`.
+
+    Jobs are coroutine functions run as tasks on the event loop that calls
+    :meth:`submit`; at most ``max_workers`` run at once. Queueing, priorities,
+    timeouts and :meth:`stats` behave exactly as in :class:`WorkerPool`.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        max_queue: int = 100,
+        name: str = "worker",
+        kill_grace: float = 5.0,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        super().__init__(max_workers, max_queue, name, kill_grace, logger)
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    def _wake(self) -> None:
+        while len(self._running) < self.max_workers:
+            taken = self._take()
+            if taken is None:
+                return
+            task = asyncio.get_running_loop().create_task(self._run(*taken), name=f"{self._name}-{taken[0]}")
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key: str, fn: Callable[[PoolJob], Awaitable[None]], job: PoolJob) -> None:
+        handle: Optional[asyncio.TimerHandle] = None
+        if job.timeout:
+            handle = asyncio.get_running_loop().call_later(job.timeout, job.stop, "timeout")
+        try:
+            await fn(job)
+        except Exception as exc:  # job failures must not stop the pool
+            reported = self._failed(key, job, exc)
+            if inspect.isawaitable(reported):
+                try:
+                    await reported
+                except Exception:
+                    self.logger.exception("Could not report the failure of job %s", key)
+        finally:
+            if handle is not None:
+                handle.cancel()
+            with self._cond:
+                self._finish(key, job)
+                self._wake()